@@ -0,0 +1,249 @@
+# encoding: utf-8
+
+''' API actions that let a browser upload a resource file straight
+to S3, as a multipart upload with a presigned URL for each part.
+
+The browser starts an upload with `s3filestore_initiate_multipart`,
+requests part URLs with `s3filestore_sign_multipart_parts`, PUTs each
+part to S3, then calls `s3filestore_complete_multipart` with the ETag
+of each part. Completion updates the resource as a normal upload would,
+including the visibility of its S3 objects.
+'''
+
+import datetime
+import logging
+import mimetypes
+
+from botocore.exceptions import ClientError
+import ckantoolkit as toolkit
+import six
+from s3transfer.utils import ChunksizeAdjuster
+
+from ckan.lib import munge
+
+from ckanext.s3filestore import tasks
+from ckanext.s3filestore.model import clear_visibility_state
+from ckanext.s3filestore.redis_helper import LockTimeout
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+log = logging.getLogger(__name__)
+
+MAX_PARTS = 10000
+# most part URLs that can be requested in one call
+MAX_SIGNED_PARTS = 1000
+# how long completing an upload waits for a staged upload to finish
+UPLOAD_LOCK_WAIT = 30
+
+
+def _get_upload(context, data_dict):
+    ''' Return the uploader for the resource, its id,
+    and the munged name of the file being uploaded.
+    '''
+    resource_id, name = toolkit.get_or_bust(data_dict, ['id', 'name'])
+    resource = toolkit.get_action('resource_show')(dict(context), {'id': resource_id})
+    name = munge.munge_filename(name)
+    return S3ResourceUploader(resource), resource['id'], name
+
+
+def _get_int(data_dict, field, minimum, maximum=None):
+    try:
+        value = int(data_dict.get(field))
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({field: ['Must be an integer']})
+    if value < minimum or (maximum is not None and value > maximum):
+        raise toolkit.ValidationError({field: ['Out of range']})
+    return value
+
+
+def _raise_client_error(e, upload_id):
+    ''' Report an S3 error as the matching CKAN API error.
+    '''
+    error_code = e.response['Error']['Code']
+    if error_code == 'NoSuchUpload':
+        raise toolkit.ObjectNotFound('Upload {0} not found'.format(upload_id))
+    raise toolkit.ValidationError({'upload_id': [e.response['Error'].get('Message') or error_code]})
+
+
+def initiate_multipart(context, data_dict):
+    ''' Start a multipart upload of a new file for a resource.
+
+    :param id: the id of the resource
+    :type id: string
+    :param name: the file name
+    :type name: string
+    :param size: the size of the file in bytes
+    :type size: int
+    :param content_type: the MIME type of the file (optional,
+        guessed from the name if omitted)
+    :type content_type: string
+
+    :returns: the upload id, the S3 key, and the size and number of
+        the parts that the file must be split into
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_initiate_multipart', context, data_dict)
+    upload, resource_id, name = _get_upload(context, data_dict)
+    size = _get_int(data_dict, 'size', 0)
+    content_type = data_dict.get('content_type') \
+        or mimetypes.guess_type(name, strict=False)[0] or 'application/octet-stream'
+
+    key = upload.get_path(resource_id, name)
+    acl = upload._get_target_acl(resource_id)
+    # S3 needs parts of at least 5MB, and allows at most 10,000 of them
+    part_size = ChunksizeAdjuster().adjust_chunksize(upload.multipart_chunksize, size)
+    kwargs = upload.get_upload_args(key, acl, content_type, upload._get_resource_metadata())
+    try:
+        response = upload.get_s3_client().create_multipart_upload(
+            Bucket=upload.bucket_name, Key=key, **kwargs)
+    except ClientError as e:
+        log.error("Failed to start multipart upload to %s: %s", key, e)
+        raise toolkit.ValidationError({'id': ['Unable to start upload']})
+    log.info("Started multipart upload %s to %s", response['UploadId'], key)
+    return {
+        'upload_id': response['UploadId'],
+        'key': key,
+        'part_size': part_size,
+        'part_count': max(1, (size + part_size - 1) // part_size),
+    }
+
+
+def sign_multipart_parts(context, data_dict):
+    ''' Return presigned URLs for uploading parts of a multipart upload.
+    Each part must be sent to its URL as a PUT request, and the ETag
+    header of the response kept for completing the upload.
+
+    :param id: the id of the resource
+    :type id: string
+    :param name: the file name, as given when starting the upload
+    :type name: string
+    :param upload_id: the id of the upload
+    :type upload_id: string
+    :param part_numbers: the numbers of the parts, starting from 1
+    :type part_numbers: list of ints
+
+    :returns: the URL for each part number
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_sign_multipart_parts', context, data_dict)
+    upload, resource_id, name = _get_upload(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    part_numbers = data_dict.get('part_numbers')
+    if not isinstance(part_numbers, list) or not part_numbers:
+        raise toolkit.ValidationError({'part_numbers': ['Must be a list of part numbers']})
+    if len(part_numbers) > MAX_SIGNED_PARTS:
+        raise toolkit.ValidationError({'part_numbers': [
+            'At most {0} parts can be signed at once'.format(MAX_SIGNED_PARTS)]})
+    part_numbers = [_get_int({'part_numbers': number}, 'part_numbers', 1, MAX_PARTS)
+                    for number in part_numbers]
+
+    key = upload.get_path(resource_id, name)
+    client = upload.get_s3_client()
+    urls = {}
+    for part_number in part_numbers:
+        urls[six.text_type(part_number)] = client.generate_presigned_url(
+            'upload_part',
+            Params={'Bucket': upload.bucket_name, 'Key': key,
+                    'UploadId': upload_id, 'PartNumber': part_number},
+            ExpiresIn=upload.signed_url_expiry)
+    return {'urls': urls}
+
+
+def complete_multipart(context, data_dict):
+    ''' Complete a multipart upload and make the uploaded file
+    the current file of the resource.
+
+    :param id: the id of the resource
+    :type id: string
+    :param name: the file name, as given when starting the upload
+    :type name: string
+    :param upload_id: the id of the upload
+    :type upload_id: string
+    :param parts: the number and ETag of each uploaded part,
+        eg ``[{"part_number": 1, "etag": "\\"d41d8...\\""}]``
+    :type parts: list of dictionaries
+
+    :returns: the updated resource
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_complete_multipart', context, data_dict)
+    upload, resource_id, name = _get_upload(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    parts = data_dict.get('parts')
+    if not isinstance(parts, list) or not parts:
+        raise toolkit.ValidationError({'parts': ['Must be a list of parts']})
+    try:
+        parts = sorted(
+            ({'PartNumber': int(part['part_number']), 'ETag': part['etag']} for part in parts),
+            key=lambda part: part['PartNumber'])
+    except (KeyError, TypeError, ValueError):
+        raise toolkit.ValidationError({'parts': ['Each part needs a part_number and an etag']})
+
+    key = upload.get_path(resource_id, name)
+    client = upload.get_s3_client()
+    # the lock stops a job for an earlier asynchronous upload
+    # overwriting the new object with its staged file
+    try:
+        with upload.redis.lock(resource_id + tasks.UPLOAD_LOCK, tasks.UPLOAD_LOCK_TIMEOUT,
+                               blocking_timeout=UPLOAD_LOCK_WAIT):
+            try:
+                client.complete_multipart_upload(
+                    Bucket=upload.bucket_name, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+            except ClientError as e:
+                log.error("Failed to complete multipart upload %s to %s: %s", upload_id, key, e)
+                _raise_client_error(e, upload_id)
+            upload.discard_staged_upload(resource_id)
+    except LockTimeout:
+        raise toolkit.ValidationError({'id': ['Another file is being uploaded, please try again later']})
+    log.info("Completed multipart upload %s to %s", upload_id, key)
+    # the key now holds the file itself, rather than pointing at a blob
+    upload.detach_blob(key)
+    metadata = upload.index_uploaded_object(client, key)
+    # the ACL was chosen when the upload started, and the package
+    # may have changed since, so the objects must be checked again
+    clear_visibility_state(resource_id)
+
+    # the resource update applies the visibility of the package
+    # to the new object and to the previous ones
+    return toolkit.get_action('resource_patch')(context, {
+        'id': resource_id,
+        'url': name,
+        'url_type': 'upload',
+        'size': metadata.get('ContentLength'),
+        'mimetype': metadata.get('ContentType'),
+        # the SHA-256 digest of the parts is not known here
+        'hash': '',
+        'last_modified': datetime.datetime.utcnow().isoformat(),
+    })
+
+
+def abort_multipart(context, data_dict):
+    ''' Abort a multipart upload, discarding any uploaded parts.
+
+    :param id: the id of the resource
+    :type id: string
+    :param name: the file name, as given when starting the upload
+    :type name: string
+    :param upload_id: the id of the upload
+    :type upload_id: string
+    '''
+    toolkit.check_access('s3filestore_abort_multipart', context, data_dict)
+    upload, resource_id, name = _get_upload(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    key = upload.get_path(resource_id, name)
+    try:
+        upload.get_s3_client().abort_multipart_upload(
+            Bucket=upload.bucket_name, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        log.error("Failed to abort multipart upload %s to %s: %s", upload_id, key, e)
+        _raise_client_error(e, upload_id)
+    log.info("Aborted multipart upload %s to %s", upload_id, key)
+
+
+def get_actions():
+    return {
+        's3filestore_initiate_multipart': initiate_multipart,
+        's3filestore_sign_multipart_parts': sign_multipart_parts,
+        's3filestore_complete_multipart': complete_multipart,
+        's3filestore_abort_multipart': abort_multipart,
+    }
@@ -0,0 +1,20 @@
+# encoding: utf-8
+
+''' Authorisation for the direct upload actions. Uploading a file
+to a resource needs the same permission as updating the resource.
+'''
+
+from ckan import authz
+
+
+def _resource_update(context, data_dict):
+    return authz.is_authorized('resource_update', context, {'id': data_dict.get('id')})
+
+
+def get_auth_functions():
+    return {
+        's3filestore_initiate_multipart': _resource_update,
+        's3filestore_sign_multipart_parts': _resource_update,
+        's3filestore_complete_multipart': _resource_update,
+        's3filestore_abort_multipart': _resource_update,
+    }
@@ -5,15 +5,35 @@ from builtins import str
 from builtins import range
 from builtins import object
 from botocore.exceptions import ClientError
+import datetime
+import json
 import os
 import sys
+import time
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from ckan.lib import munge
-from ckan.plugins.toolkit import config, get_action, ValidationError
+from ckan.lib.uploader import get_resource_uploader
+from ckan.plugins.toolkit import asbool, config, get_action
+from ckanext.s3filestore import model as s3_model
+from ckanext.s3filestore import tasks
 from ckanext.s3filestore import uploader
-from ckanext.s3filestore.uploader import get_s3_session, S3FileStoreException
+from ckanext.s3filestore.migration import MigrationEngine
+from ckanext.s3filestore.redis_helper import LockTimeout
+from ckanext.s3filestore.uploader import S3FileStoreException
+from ckanext.s3filestore.visibility import update_resources_visibility
+
+
+# number of values bound to each ANY(...) lookup
+QUERY_BATCH_SIZE = 10000
+# files staged more recently than this are left for their job
+STAGED_UPLOAD_MIN_AGE = 60
+
+
+def _chunks(values, size=QUERY_BATCH_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
 
 class DBConnection(object):
@@ -60,7 +80,7 @@ class S3FilestoreCommands(object):
 
         print('Configuration OK!')
 
-    def upload_all(self):
+    def upload_all(self, **options):
         BASE_PATH = config.get('ckan.storage_path', '/var/lib/ckan/default/resources')
         resource_ids_and_paths = {}
 
@@ -75,29 +95,29 @@ class S3FilestoreCommands(object):
         with DBConnection(config) as connection:
             resource_ids_and_names = {}
 
-            for resource_id, file_path in resource_ids_and_paths.items():
-                resource = connection.execute(text('''
+            for resource_ids in _chunks(list(resource_ids_and_paths.keys())):
+                for _id, url in connection.execute(text('''
                     SELECT id, url
                     FROM resource
-                    WHERE id = :id
+                    WHERE id = ANY(:ids)
                     AND state = 'active'
                     AND url IS NOT NULL
                     AND url <> ''
                     AND url_type = 'upload'
-                '''), id=resource_id)
-                if resource.rowcount:
-                    _id, url = resource.first()
+                '''), ids=resource_ids):
                     file_name = url.split('/')[-1] if '/' in url else url
                     resource_ids_and_names[_id] = file_name.lower()
-                else:
+
+            for resource_id, file_path in resource_ids_and_paths.items():
+                if resource_id not in resource_ids_and_names:
                     print("{} is an orphan; no resource points to it".format(file_path))
 
         print('{0} resources matched on the database'.format(
             len(list(resource_ids_and_names.keys()))))
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths, **options)
 
-    def upload_single(self, id):
+    def upload_single(self, id, **options):
         with DBConnection(config) as connection:
             resource_ids_and_names = {}
             for resource in connection.execute(text('''
@@ -128,9 +148,9 @@ class S3FilestoreCommands(object):
         print('Found {0} resource files in the file system'.format(
             len(list(resource_ids_and_paths.keys()))))
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths, **options)
 
-    def upload_pairtree(self):
+    def upload_pairtree(self, **options):
         def _to_pairtree_path(path):
             return os.path.join(*[path[i:i + 2] for i in range(0, len(path), 2)])
 
@@ -159,23 +179,25 @@ class S3FilestoreCommands(object):
 
             SITE_URL = config.get('ckan.site_url')
             BASE_URL = SITE_URL + '/storage/f/'
-            for file_path in resource_paths:
-                pairtree_url = BASE_URL + file_path.replace(':', '%3A')
-                resource = connection.execute(text('''
+            urls_and_paths = dict(
+                (BASE_URL + file_path.replace(':', '%3A'), file_path) for file_path in resource_paths)
+            matched_urls = set()
+            for urls in _chunks(list(urls_and_paths.keys())):
+                for _id, url in connection.execute(text('''
                     SELECT id, url
                     FROM resource
-                    WHERE url = :url
+                    WHERE url = ANY(:urls)
                     AND state = 'active'
                     AND url IS NOT NULL
                     AND url <> ''
-                '''), url=pairtree_url)
-                if resource.rowcount:
-                    _id, url = resource.first()
-                    if url:
-                        file_name = url.split('/')[-1] if '/' in url else url
-                        resource_ids_and_names[_id] = file_name.lower()
-                        resource_ids_and_paths[_id] = BASE_PATH + '/' + file_path
-                else:
+                '''), urls=urls):
+                    matched_urls.add(url)
+                    file_name = url.split('/')[-1] if '/' in url else url
+                    resource_ids_and_names[_id] = file_name.lower()
+                    resource_ids_and_paths[_id] = BASE_PATH + '/' + urls_and_paths[url]
+
+            for url, file_path in urls_and_paths.items():
+                if url not in matched_urls:
                     print("{} is an orphan; no resource points to it".format(file_path))
 
         resource_count = len(list(resource_ids_and_names.keys()))
@@ -183,75 +205,292 @@ class S3FilestoreCommands(object):
         if resource_count == 0:
             return
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths, **options)
+
+    def update_all_visibility(self, since=None, concurrency=None):
+        ''' Set the visibility of the files of every uploaded resource to
+        match its package, reading the packages and resources directly
+        from the database rather than patching each package.
 
-    def update_all_visibility(self):
+        :param since: only update packages modified since this date
+        :param concurrency: number of resources to update in parallel;
+            defaults to the ckanext.s3filestore.acl.update_concurrency setting
+        '''
         if config.get('ckanext.s3filestore.acl', None) != 'auto':
             print("ckanext.s3filestore.acl must be set to 'auto' to execute update_all_visibility")
             return
-
-        print("Updating the visibility of all datasets")
-
-        packages_ids = []
+        if concurrency is None:
+            concurrency = int(config.get('ckanext.s3filestore.acl.update_concurrency', '4'))
+
+        if since:
+            print("Updating the visibility of datasets modified since {}".format(since))
+        else:
+            print("Updating the visibility of all datasets")
+
+        track_state = asbool(config.get('ckanext.s3filestore.acl.track_state', True))
+        if track_state:
+            s3_model.setup()
+        query = '''
+            SELECT r.id, r.url, r.url_type, r.package_id, p.private, {state_columns}
+            FROM resource r
+            JOIN package p ON p.id = r.package_id
+            {state_join}
+            WHERE r.state = 'active'
+            AND p.state = 'active'
+            AND r.url IS NOT NULL
+            AND r.url <> ''
+            AND r.url_type = 'upload'
+        '''.format(
+            state_columns='s.object_key, s.acl' if track_state else 'NULL, NULL',
+            state_join='LEFT JOIN s3filestore_visibility_state s ON s.resource_id = r.id' if track_state else '')
+        if since:
+            query += '''
+            AND p.metadata_modified >= :since
+            '''
+        query += '''
+            ORDER BY r.package_id
+        '''
+
+        storage_path = os.path.join(config.get('ckanext.s3filestore.aws_storage_path', ''), 'resources')
+        visibility_mode = config.get('ckanext.s3filestore.visibility_mode', 'acl')
+        unchanged = [0]
+
+        def _resources(rows):
+            package_ids = set()
+            for count, (_id, url, url_type, package_id, private, state_key, state_acl) in enumerate(rows, 1):
+                package_ids.add(package_id)
+                acl = 'private' if private else 'public-read'
+                current_key = os.path.join(storage_path, _id, munge.munge_filename(os.path.basename(url)))
+                if (state_key, state_acl) == (current_key, uploader._get_state_acl(acl, visibility_mode)):
+                    # already applied, according to the recorded state
+                    unchanged[0] += 1
+                else:
+                    yield ({'id': _id, 'url': url, 'url_type': url_type, 'package_id': package_id}, acl)
+                if count % 1000 == 0:
+                    print('Checked {0} resources in {1} datasets'.format(count, len(package_ids)))
 
         with DBConnection(config) as connection:
+            rows = connection.execution_options(stream_results=True).execute(text(query), since=since)
+            summary = update_resources_visibility(_resources(rows), get_resource_uploader, concurrency=concurrency)
+
+        for resource_id, error in summary.failed.items():
+            print("Unable to update the visibility of resource '{}': {}".format(resource_id, error))
+        print('Done, {0} already up to date, {1}'.format(unchanged[0], summary))
+
+    def prewarm_urls(self, limit=None):
+        ''' Regenerate the cached URLs of the most requested files
+        before they expire. Intended to be run periodically, eg by cron.
+        '''
+        base_uploader = uploader.BaseS3Uploader()
+        if not limit and base_uploader.prewarm_top_keys <= 0:
+            print("Set ckanext.s3filestore.prewarm.top_keys to track requests and prewarm URLs")
+            return
+        print('Regenerated {0} URLs'.format(base_uploader.prewarm_signed_urls(limit)))
+
+    def bucket_policy(self, apply=False):
+        ''' Print the bucket policy needed by the 'tag' visibility mode:
+        the current policy, with a statement granting public read access
+        to objects tagged as public added or replaced.
+        If `apply` is True, also update the bucket policy.
+        '''
+        base_uploader = uploader.BaseS3Uploader()
+        client = base_uploader.get_s3_client()
+        statement = base_uploader.get_bucket_policy_statement()
+        try:
+            policy = json.loads(client.get_bucket_policy(Bucket=base_uploader.bucket_name)['Policy'])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchBucketPolicy':
+                raise
+            policy = {'Version': '2012-10-17', 'Statement': []}
+        policy['Statement'] = [
+            existing for existing in policy.get('Statement', [])
+            if existing.get('Sid') != statement['Sid']] + [statement]
+        print(json.dumps(policy, indent=2))
+        if apply:
+            client.put_bucket_policy(Bucket=base_uploader.bucket_name, Policy=json.dumps(policy))
+            print('Bucket policy of {0} updated'.format(base_uploader.bucket_name))
+
+    def prune(self, days=None, dry_run=False):
+        ''' Delete objects that are not the current file of their
+        resource and are older than `days`, across the whole bucket.
+        Defaults to the ckanext.s3filestore.delete_non_current_days setting.
+        '''
+        if days is None:
+            days = int(config.get('ckanext.s3filestore.delete_non_current_days', '-1'))
+        if days < 0:
+            print("Specify the number of days, or set ckanext.s3filestore.delete_non_current_days, to prune")
+            return
 
-            packages = connection.execute(text('''
-                    SELECT distinct package_id
+        storage_path = os.path.join(config.get('ckanext.s3filestore.aws_storage_path', ''), 'resources')
+        current_keys = {}
+        query = text('''
+            SELECT id, url
+            FROM resource
+            WHERE state = 'active'
+            AND url IS NOT NULL
+            AND url <> ''
+            AND url_type = 'upload'
+        ''')
+        with DBConnection(config) as connection:
+            for _id, url in connection.execution_options(stream_results=True).execute(query):
+                current_keys[_id] = os.path.join(
+                    storage_path, _id, munge.munge_filename(os.path.basename(url)))
+        print('{0} active uploaded resources found on the database'.format(len(current_keys)))
+
+        base_uploader = uploader.BaseS3Uploader()
+        paginator = base_uploader.get_s3_client().get_paginator('list_objects_v2')
+        expired_keys = []
+        scanned = pruned = 0
+        for page in paginator.paginate(Bucket=base_uploader.bucket_name, Prefix=storage_path + '/'):
+            for upload in page.get('Contents', []):
+                scanned += 1
+                resource_id = upload['Key'][len(storage_path) + 1:].split('/')[0]
+                # objects of deleted or unknown resources are left alone
+                if resource_id not in current_keys or upload['Key'] == current_keys[resource_id]:
+                    continue
+                if uploader._get_object_age_days(upload) >= days:
+                    expired_keys.append(upload['Key'])
+            if len(expired_keys) >= uploader.DELETE_BATCH_SIZE or not page.get('IsTruncated'):
+                pruned += len(expired_keys)
+                if dry_run:
+                    for key in expired_keys:
+                        print("Would remove {}".format(key))
+                elif expired_keys:
+                    base_uploader.clear_keys(expired_keys)
+                print('Scanned {0} objects, {1} pruned'.format(scanned, pruned))
+                expired_keys = []
+
+        resource_uploader = uploader.S3ResourceUploader({'url': ''})
+        if resource_uploader.content_addressed:
+            pruned += self._prune_blobs(resource_uploader, storage_path, current_keys, days, dry_run)
+
+        print('Done, {0} {1} non-current objects older than {2} days'.format(
+            'would remove' if dry_run else 'removed', pruned, days))
+
+    def _prune_blobs(self, resource_uploader, storage_path, current_keys, days, dry_run):
+        ''' In the content-addressed layout, remove references from keys
+        that are not the current file of their resource and are older
+        than `days`, then delete blobs older than `days` that nothing
+        refers to. Returns the number of references and blobs removed.
+        '''
+        now = datetime.datetime.utcnow()
+        expired = []
+        referenced = set()
+        for object_key, blob_key, updated in s3_model.iter_blob_references(storage_path + '/'):
+            resource_id = object_key[len(storage_path) + 1:].split('/')[0]
+            if resource_id in current_keys and object_key != current_keys[resource_id] \
+                    and (now - updated).days >= days:
+                expired.append((object_key, blob_key))
+            else:
+                referenced.add(blob_key)
+        for object_key, blob_key in expired:
+            if dry_run:
+                print("Would remove {0}, stored as {1}".format(object_key, blob_key))
+            else:
+                resource_uploader._release_blob(object_key, blob_key)
+        print('{0} non-current references to blobs pruned'.format(len(expired)))
+
+        # blobs left behind by interrupted uploads or deletions;
+        # blobs of the references just removed have been handled already
+        referenced.update(blob_key for object_key, blob_key in expired)
+        orphaned = 0
+        candidates = []
+        paginator = resource_uploader.get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=resource_uploader.bucket_name,
+                                       Prefix=resource_uploader.blob_storage_path + '/'):
+            for blob in page.get('Contents', []):
+                blob_key = blob['Key']
+                if blob_key in referenced or uploader._get_object_age_days(blob) < days:
+                    continue
+                if dry_run:
+                    print("Would remove {0} if unreferenced".format(blob_key))
+                    orphaned += 1
+                    continue
+                candidates.append(blob_key)
+            if len(candidates) >= uploader.DELETE_BATCH_SIZE or not page.get('IsTruncated'):
+                orphaned += self._delete_orphaned_blobs(resource_uploader, candidates)
+                candidates = []
+        print('{0} unreferenced blobs pruned'.format(orphaned))
+        return len(expired) + orphaned
+
+    def _delete_orphaned_blobs(self, resource_uploader, blob_keys):
+        ''' Delete those of `blob_keys` that nothing refers to, in one
+        batch. Returns the number of blobs deleted.
+        '''
+        if not blob_keys:
+            return 0
+        # hold the lock of each blob, as it may be uploaded again
+        # while the references are checked
+        held = []
+        try:
+            for blob_key in sorted(blob_keys):
+                lock = resource_uploader.redis.lock(blob_key + uploader.BLOB_LOCK, uploader.BLOB_LOCK_TIMEOUT)
+                lock.__enter__()
+                held.append(lock)
+            referenced = s3_model.get_referenced_blob_keys(blob_keys)
+            orphaned = [blob_key for blob_key in blob_keys if blob_key not in referenced]
+            if orphaned:
+                resource_uploader.clear_keys(orphaned)
+        finally:
+            for lock in reversed(held):
+                lock.__exit__(None, None, None)
+        return len(orphaned)
+
+    def upload_staged(self, minutes=STAGED_UPLOAD_MIN_AGE, dry_run=False):
+        ''' Send files staged by asynchronous uploads to S3 if their job
+        has been lost, eg because it failed or could not be queued.
+        Files staged less than `minutes` ago are left for their job.
+        '''
+        resource_ids_and_names = {}
+        with DBConnection(config) as connection:
+            for _id, url in connection.execute(text('''
+                    SELECT id, url
                     FROM resource
                     WHERE state = 'active'
                     AND url IS NOT NULL
                     AND url <> ''
                     AND url_type = 'upload'
-                '''))
-
-            if packages.rowcount:
-                for package in packages:
-                    # package[0] is expected to be the id within the tuple
-                    packages_ids.append(package[0])
-            else:
-                print("No resources found to make visible")
-
-        for package_id in packages_ids:
+                ''')):
+                resource_ids_and_names[_id] = munge.munge_filename(os.path.basename(url))
+
+        resource_uploader = uploader.S3ResourceUploader({'url': ''})
+        redis = resource_uploader.redis
+        pending = {}
+        for resource_ids in _chunks(list(resource_ids_and_names.keys())):
+            tokens = redis.get_many([resource_id + uploader.UPLOAD_PENDING_PATH for resource_id in resource_ids])
+            pending.update((resource_id, token) for resource_id, token in zip(resource_ids, tokens) if token)
+        print('{0} resources have files waiting to be sent to S3'.format(len(pending)))
+
+        sent = 0
+        for resource_id, token in pending.items():
+            staged_path = resource_uploader._get_staged_path(resource_id)
+            if not staged_path or not os.path.isfile(staged_path):
+                print("{} has no staged file at {}".format(resource_id, staged_path))
+                continue
+            if time.time() - os.path.getmtime(staged_path) < minutes * 60:
+                continue
+            if dry_run:
+                print("Would upload {} to resource {}".format(staged_path, resource_id))
+                sent += 1
+                continue
             try:
-                get_action('package_patch')(data_dict={'id': package_id}, context={'ignore_auth': True})
+                # a job that is still running holds the lock
+                with redis.lock(resource_id + tasks.UPLOAD_LOCK, tasks.UPLOAD_LOCK_TIMEOUT, blocking_timeout=1):
+                    resource = get_action('resource_show')({'ignore_auth': True}, {'id': resource_id})
+                    staged_uploader = uploader.S3ResourceUploader(resource)
+                    if staged_uploader.upload_staged(resource_id, resource_ids_and_names[resource_id], token,
+                                                     staged_uploader._get_resource_metadata()):
+                        print("Uploaded {} to resource {}".format(staged_path, resource_id))
+                        sent += 1
+            except LockTimeout:
+                print("{} is being uploaded by a job, skipping".format(resource_id))
             except Exception as e:
-                print("Unable to package_patch on package_id '{}', exception {} ".format(package_id, e))
-
+                print("Failed to upload {} to resource {}: {}".format(staged_path, resource_id, e))
+        print('Done, {0} {1} staged files'.format('would upload' if dry_run else 'uploaded', sent))
 
-def _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths):
-    AWS_BUCKET_NAME = config.get('ckanext.s3filestore.aws_bucket_name')
-    AWS_S3_ACL = config.get('ckanext.s3filestore.acl', 'public-read')
-    s3_connection = get_s3_session(config).client('s3')
-
-    context = {'ignore_auth': True}
-    uploaded_resources = []
-    for resource_id, file_name in resource_ids_and_names.items():
-        file_name = munge.munge_filename(file_name)
-        key = 'resources/{resource_id}/{file_name}'.format(
-            resource_id=resource_id, file_name=file_name)
-
-        try:
-            s3_connection.head_object(Bucket=AWS_BUCKET_NAME, Key=key)
-            print("{} is already in S3, skipping".format(key))
-            continue
-        except ClientError:
-            upload_file = open(resource_ids_and_paths[resource_id])
-
-            acl = AWS_S3_ACL
-            if acl == 'auto':
-                package_id = get_action('resource_show')({'ignore_auth': True}, {'id': resource_id})['package_id']
-                package = get_action('package_show')({'ignore_auth': True}, {'id': package_id})
-                acl = 'private' if package['private'] else 'public-read'
-
-            print("Uploading {} to S3 bucket {} under key {} with ACL {}".format(upload_file, AWS_BUCKET_NAME, key, acl))
-            s3_connection.put_object(Bucket=AWS_BUCKET_NAME, Key=key, Body=upload_file, ACL=acl)
-            uploaded_resources.append(resource_id)
-            print('Uploaded resource {0} ({1}) to S3'.format(resource_id, file_name))
-            try:
-                get_action('resource_patch')(context, {'id': resource_id, 'url': file_name})
-            except ValidationError:
-                print("{} failed to validate; file is in S3 but might not be used".format(resource_id))
-                pass
 
-    print('Done, uploaded {0} resources to S3'.format(len(uploaded_resources)))
+def _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths, **options):
+    ''' Upload the matched files, see MigrationEngine for the options:
+    workers, journal_path and dry_run.
+    '''
+    MigrationEngine(resource_ids_and_names, resource_ids_and_paths, **options).run()
@@ -21,16 +21,55 @@ def check_config():
 
 @s3.command()
 @click.argument(u'identifier', default='all')
-def upload(identifier):
+@click.option(u'--workers', type=int, default=4, help=u'Number of files to upload in parallel')
+@click.option(u'--journal', type=click.Path(dir_okay=False), default=None,
+              help=u'File recording progress, so that an interrupted upload can be resumed')
+@click.option(u'--dry-run', is_flag=True, help=u'List the files that would be uploaded')
+def upload(identifier, workers, journal, dry_run):
     commands = S3FilestoreCommands()
+    options = {'workers': workers, 'journal_path': journal, 'dry_run': dry_run}
     if identifier == 'all':
-        commands.upload_all()
+        commands.upload_all(**options)
     elif identifier == 'pairtree':
-        commands.upload_pairtree()
+        commands.upload_pairtree(**options)
     else:
-        commands.upload_single(identifier)
+        commands.upload_single(identifier, **options)
+
+
+@s3.command(short_help=u'Sends files staged by asynchronous uploads whose job has been lost')
+@click.option(u'--minutes', type=int, default=60,
+              help=u'Minimum time since the file was staged, so that queued jobs can run first')
+@click.option(u'--dry-run', is_flag=True, help=u'List the files that would be uploaded')
+def upload_staged(minutes, dry_run):
+    S3FilestoreCommands().upload_staged(minutes=minutes, dry_run=dry_run)
 
 
 @s3.command(short_help=u'Updates the visibility of all existing S3 objects to match current config')
-def update_all_visibility():
-    S3FilestoreCommands().update_all_visibility()
+@click.option(u'--since', type=click.DateTime(), default=None,
+              help=u'Only update datasets modified since this date')
+@click.option(u'--concurrency', type=int, default=None,
+              help=u'Number of resources to update in parallel; '
+                   u'defaults to ckanext.s3filestore.acl.update_concurrency')
+def update_all_visibility(since, concurrency):
+    S3FilestoreCommands().update_all_visibility(since=since, concurrency=concurrency)
+
+
+@s3.command(short_help=u'Regenerates cached URLs of the most requested files before they expire')
+@click.option(u'--limit', type=int, default=None,
+              help=u'Number of files; defaults to ckanext.s3filestore.prewarm.top_keys')
+def prewarm_urls(limit):
+    S3FilestoreCommands().prewarm_urls(limit=limit)
+
+
+@s3.command(short_help=u'Prints the bucket policy needed for tag-based visibility')
+@click.option(u'--apply', is_flag=True, help=u'Update the bucket policy as well as printing it')
+def bucket_policy(apply):
+    S3FilestoreCommands().bucket_policy(apply=apply)
+
+
+@s3.command(short_help=u'Deletes non-current versions of resource files older than the given days')
+@click.option(u'--days', type=int, default=None,
+              help=u'Minimum age in days; defaults to ckanext.s3filestore.delete_non_current_days')
+@click.option(u'--dry-run', is_flag=True, help=u'List the objects that would be deleted')
+def prune(days, dry_run):
+    S3FilestoreCommands().prune(days=days, dry_run=dry_run)
@@ -0,0 +1,168 @@
+# encoding: utf-8
+
+from builtins import object
+import logging
+import os
+import threading
+
+import boto3
+from botocore.client import Config
+import ckantoolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+
+def get_s3_session(config):
+    if config.get('ckanext.s3filestore.aws_use_ami_role', False):
+        p_key = None
+        s_key = None
+    else:
+        p_key = config.get('ckanext.s3filestore.aws_access_key_id')
+        s_key = config.get('ckanext.s3filestore.aws_secret_access_key')
+    region = config.get('ckanext.s3filestore.region_name')
+    return boto3.session.Session(aws_access_key_id=p_key,
+                                 aws_secret_access_key=s_key,
+                                 region_name=region)
+
+
+def _get_max_pool_connections(config, minimum=None):
+    ''' Return the configured size of the connection pool, or by default
+    enough connections for the visibility update threads of a process,
+    which share one pool each for resources and for objects.
+    Callers that run more requests at once, such as migrations,
+    can ask for at least `minimum` connections.
+    '''
+    max_pool_connections = config.get('ckanext.s3filestore.max_pool_connections')
+    if max_pool_connections:
+        max_pool_connections = int(max_pool_connections)
+    else:
+        max_pool_connections = max(10, int(config.get('ckanext.s3filestore.acl.update_concurrency', '4'))
+                                   + int(config.get('ckanext.s3filestore.acl.object_concurrency', '4')))
+    return max(max_pool_connections, minimum or 0)
+
+
+def get_botocore_config(config, signature_version, addressing_style, max_pool_connections=None):
+    ''' Build the botocore client configuration, including the
+    connection pool and retry settings.
+    '''
+    options = {
+        'signature_version': signature_version,
+        's3': {'addressing_style': addressing_style},
+        'max_pool_connections': _get_max_pool_connections(config, max_pool_connections),
+    }
+    # only passed when enabled, as older botocore versions
+    # do not recognise the option
+    if toolkit.asbool(config.get('ckanext.s3filestore.tcp_keepalive', False)):
+        options['tcp_keepalive'] = True
+    retry_mode = config.get('ckanext.s3filestore.retry_mode')
+    retry_max_attempts = config.get('ckanext.s3filestore.retry_max_attempts')
+    if retry_mode or retry_max_attempts:
+        retries = {}
+        if retry_mode:
+            retries['mode'] = retry_mode
+        if retry_max_attempts:
+            retries['max_attempts'] = int(retry_max_attempts)
+        options['retries'] = retries
+    return Config(**options)
+
+
+def _get_cache_key(config, endpoint_url, signature_version, addressing_style, max_pool_connections=None):
+    return tuple(
+        config.get('ckanext.s3filestore.' + option) for option in (
+            'aws_use_ami_role', 'aws_access_key_id', 'aws_secret_access_key',
+            'region_name', 'max_pool_connections', 'tcp_keepalive',
+            'retry_mode', 'retry_max_attempts',
+            'acl.update_concurrency', 'acl.object_concurrency')
+    ) + (endpoint_url, signature_version, addressing_style, max_pool_connections)
+
+
+class S3ClientPool(object):
+    ''' Process-wide cache of boto3 S3 clients and resources.
+
+    Clients are thread-safe and hold their own HTTP connection pool,
+    so one client per configuration is shared by every thread in the
+    process. Sessions are only used while holding the lock, and
+    resources, which are not thread-safe, are cached per thread.
+
+    The cache is discarded whenever the process ID changes, so forked
+    workers never reuse the sockets of their parent.
+    '''
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = {}
+        self._local = threading.local()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # The lock may have been held by another thread at fork time,
+            # so it is replaced rather than acquired.
+            log.debug("Process ID changed, discarding pooled S3 clients")
+            self._reset()
+
+    def _get_session(self, cache_key, config):
+        session = self._sessions.get(cache_key)
+        if session is None:
+            session = self._sessions[cache_key] = get_s3_session(config)
+        return session
+
+    def get_client(self, config, endpoint_url=None, signature_version=None,
+                   addressing_style='auto', max_pool_connections=None):
+        ''' Return the shared S3 client for the current configuration,
+        with at least `max_pool_connections` connections if specified.
+        '''
+        self._check_pid()
+        cache_key = _get_cache_key(
+            config, endpoint_url, signature_version, addressing_style, max_pool_connections)
+        client = self._clients.get(cache_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(cache_key)
+                if client is None:
+                    log.debug("Creating pooled S3 client for %s", endpoint_url)
+                    client = self._get_session(cache_key, config).client(
+                        's3',
+                        endpoint_url=endpoint_url,
+                        config=get_botocore_config(
+                            config, signature_version, addressing_style, max_pool_connections))
+                    self._clients[cache_key] = client
+        return client
+
+    def get_resource(self, config, endpoint_url=None, signature_version=None,
+                     addressing_style='auto'):
+        ''' Return an S3 resource for the current configuration,
+        shared by all callers on the current thread.
+        '''
+        self._check_pid()
+        cache_key = _get_cache_key(
+            config, endpoint_url, signature_version, addressing_style)
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+        resource = resources.get(cache_key)
+        if resource is None:
+            with self._lock:
+                resource = self._get_session(cache_key, config).resource(
+                    's3',
+                    endpoint_url=endpoint_url,
+                    config=get_botocore_config(
+                        config, signature_version, addressing_style))
+            resources[cache_key] = resource
+        return resource
+
+    def clear(self):
+        ''' Discard all pooled sessions, clients and resources.
+        '''
+        self._reset()
+
+
+_pool = S3ClientPool()
+
+
+def get_pool():
+    return _pool
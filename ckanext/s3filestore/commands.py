@@ -14,17 +14,45 @@ class TestConnection(toolkit.CkanCommand, S3FilestoreCommands):
 
     Usage:
 
-        s3 update-all-visibility
+        s3 update-all-visibility [<since>]
 
-            Updates the visibility of all existing S3 objects to match current config
+            Updates the visibility of all existing S3 objects to match current config,
+            or only those of datasets modified since the given date, eg 2021-01-31
+
+        s3 prune [<days>] [--dry-run]
+
+            Deletes files in the bucket that are not the current upload
+            of their resource and are older than the given number of days,
+            or ckanext.s3filestore.delete_non_current_days if not given.
+            With --dry-run, lists the files that would be deleted.
+
+        s3 prewarm-urls [<limit>]
+
+            Regenerates the cached URLs of the most requested files before
+            they expire. Run it periodically, eg every few minutes from cron.
+
+        s3 bucket-policy [apply]
+
+            Prints the bucket policy needed when ckanext.s3filestore.visibility_mode
+            is 'tag', which grants public read access to objects tagged as public.
+            If 'apply' is specified, the bucket policy is updated too.
+
+        s3 upload-staged [<minutes>] [--dry-run]
+
+            Sends files staged by asynchronous uploads to S3 if their job
+            has been lost, eg because it failed or could not be queued.
+            Files staged less than the given number of minutes ago
+            (default 60) are left for their job. Run it periodically.
 
         s3 check-config
 
             Checks if the configuration entered in the ini file is correct
 
-        s3 upload [pairtree|<id>|all]
+        s3 upload [pairtree|<id>|all] [--workers=N] [--journal=FILE] [--dry-run]
 
-            Uploads existing files from disk to S3.
+            Uploads existing files from disk to S3, N files at a time.
+            With a journal file, an interrupted upload resumes where it
+            stopped when run again with the same file.
 
             If 'all' is specified, this will scan for files on disk and
             attempt to upload each one to the matching resource.
@@ -42,6 +70,15 @@ class TestConnection(toolkit.CkanCommand, S3FilestoreCommands):
     usage = __doc__
     min_args = 1
 
+    def __init__(self, name):
+        super(TestConnection, self).__init__(name)
+        self.parser.add_option('--workers', dest='workers', type='int', default=4,
+                               help='Number of files to upload in parallel')
+        self.parser.add_option('--journal', dest='journal', default=None,
+                               help='File recording progress, so that an interrupted upload can be resumed')
+        self.parser.add_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                               help='List the files that would be uploaded or deleted')
+
     def command(self):
         if not self.args:
             print(self.usage)
@@ -50,13 +87,24 @@ class TestConnection(toolkit.CkanCommand, S3FilestoreCommands):
         if self.args[0] == 'check-config':
             self.check_config()
         elif self.args[0] == 'update-all-visibility':
-            self.update_all_visibility()
+            self.update_all_visibility(self.args[1] if len(self.args) > 1 else None)
+        elif self.args[0] == 'prewarm-urls':
+            self.prewarm_urls(int(self.args[1]) if len(self.args) > 1 else None)
+        elif self.args[0] == 'bucket-policy':
+            self.bucket_policy(apply=len(self.args) > 1 and self.args[1] == 'apply')
+        elif self.args[0] == 'prune':
+            self.prune(int(self.args[1]) if len(self.args) > 1 else None, dry_run=self.options.dry_run)
+        elif self.args[0] == 'upload-staged':
+            self.upload_staged(int(self.args[1]) if len(self.args) > 1 else 60, dry_run=self.options.dry_run)
         elif self.args[0] == 'upload':
+            options = {'workers': self.options.workers,
+                       'journal_path': self.options.journal,
+                       'dry_run': self.options.dry_run}
             if len(self.args) < 2 or self.args[1] == 'all':
-                self.upload_all()
+                self.upload_all(**options)
             elif self.args[1] == 'pairtree':
-                self.upload_pairtree()
+                self.upload_pairtree(**options)
             else:
-                self.upload_single(self.args[1])
+                self.upload_single(self.args[1], **options)
         else:
             self.parser.error('Unrecognized command')
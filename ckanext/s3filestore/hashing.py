@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+from builtins import object
+import hashlib
+
+
+class HashingReader(object):
+    ''' Wraps a binary file, computing its MD5 and SHA-256 digests,
+    and the MD5 digest of each multipart upload part, as it is read.
+
+    Data is only hashed the first time it is read, so that a transfer
+    that seeks back to retry a request does not corrupt the digests.
+    '''
+
+    def __init__(self, fileobj, part_size):
+        self._fileobj = fileobj
+        self._part_size = part_size
+        self._hashed = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self._part_md5 = hashlib.md5()
+        self.part_digests = []
+
+    def read(self, size=-1):
+        position = self._fileobj.tell()
+        data = self._fileobj.read(size)
+        if position <= self._hashed < position + len(data):
+            self._update(data[self._hashed - position:])
+        return data
+
+    def _update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        while data:
+            remaining = self._part_size - self._hashed % self._part_size
+            self._part_md5.update(data[:remaining])
+            self._hashed += len(data[:remaining])
+            data = data[remaining:]
+            if self._hashed % self._part_size == 0:
+                self._finish_part()
+
+    def _finish_part(self):
+        self.part_digests.append(self._part_md5.digest())
+        self._part_md5 = hashlib.md5()
+
+    def seek(self, offset, whence=0):
+        return self._fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fileobj.tell()
+
+    def expected_etag(self, multipart):
+        ''' The ETag that S3 assigns to the data read so far, when
+        uploaded in a single request or in parts of `part_size`.
+        '''
+        if not multipart:
+            return '"{0}"'.format(self.md5.hexdigest())
+        part_digests = list(self.part_digests)
+        if self._hashed % self._part_size or not part_digests:
+            part_digests.append(self._part_md5.digest())
+        return '"{0}-{1}"'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
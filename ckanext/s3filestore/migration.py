@@ -0,0 +1,463 @@
+# encoding: utf-8
+
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+from ckan import model
+from ckan.lib import munge
+from s3transfer.utils import ChunksizeAdjuster
+from ckan.plugins.toolkit import config, get_action, ValidationError
+
+from ckanext.s3filestore import uploader
+from ckanext.s3filestore.hashing import HashingReader
+from ckanext.s3filestore.visibility import InlineExecutor
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+RESOURCES_PREFIX = 'resources/'
+# above this many files, list the whole resources prefix rather than
+# the prefix of each resource
+FULL_LISTING_THRESHOLD = 1000
+# most resources whose packages are looked up in one query
+PACKAGE_QUERY_BATCH_SIZE = 1000
+
+
+def _format_bytes(size):
+    return '{0:.1f} MB'.format(size / MB)
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class MigrationError(Exception):
+    pass
+
+
+class MappedPartReader(object):
+    ''' A file-like view of one part of a memory-mapped file.
+    Reads return memoryview slices of the mapping, so the part
+    is sent without being copied into a buffer first.
+    '''
+
+    def __init__(self, view, start, end):
+        self._view = view
+        self._start = start
+        self._end = end
+        self._position = start
+
+    def read(self, size=-1):
+        end = self._end if size is None or size < 0 else min(self._position + size, self._end)
+        data = self._view[self._position:end]
+        self._position = end
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            position = self._start + offset
+        elif whence == 1:
+            position = self._position + offset
+        else:
+            position = self._end + offset
+        self._position = min(max(position, self._start), self._end)
+        return self._position - self._start
+
+    def tell(self):
+        return self._position - self._start
+
+    def __len__(self):
+        return self._end - self._start
+
+
+def upload_mapped_file(client, bucket, key, upload_file, part_size, extra_args=None, concurrency=1):
+    ''' Upload a file as a multipart upload, sending each part
+    straight from a memory mapping of the file.
+
+    :returns: a tuple of the ETag S3 should assign to the object,
+        and the SHA-256 digest of the file; or None if the file
+        cannot be mapped, in which case nothing is uploaded
+    '''
+    try:
+        mapping = mmap.mmap(upload_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # eg an empty file
+        return None
+    try:
+        view = memoryview(mapping)
+    except TypeError:
+        # mmap does not support memoryview on Python 2
+        mapping.close()
+        return None
+
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **(extra_args or {}))['UploadId']
+    sha256 = hashlib.sha256()
+    part_digests = []
+    try:
+        # a pool per file, so that each worker sends its parts
+        # as concurrently as a managed transfer would
+        with ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else InlineExecutor() as executor:
+            futures = []
+            for part_number, start in enumerate(range(0, len(view), part_size), 1):
+                end = min(start + part_size, len(view))
+                futures.append(executor.submit(
+                    client.upload_part, Bucket=bucket, Key=key, UploadId=upload_id,
+                    PartNumber=part_number, Body=MappedPartReader(view, start, end)))
+                # hash while the parts are being sent
+                sha256.update(view[start:end])
+                part_digests.append(hashlib.md5(view[start:end]).digest())
+            parts = [{'PartNumber': part_number, 'ETag': future.result()['ETag']}
+                     for part_number, future in enumerate(futures, 1)]
+        client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # a slice is still referenced; it is unmapped once collected
+            pass
+    etag = '"{0}-{1}"'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+    return etag, sha256.hexdigest()
+
+
+class MigrationTask(object):
+    ''' A local resource file to be copied to S3.
+    '''
+
+    def __init__(self, resource_id, file_name, path):
+        self.resource_id = resource_id
+        self.file_name = munge.munge_filename(file_name)
+        self.path = path
+        self.key = 'resources/{resource_id}/{file_name}'.format(
+            resource_id=resource_id, file_name=self.file_name)
+        self.size = os.path.getsize(path)
+        self.acl = None
+        # the ETag of an object of the same size already at the key,
+        # which is only uploaded again if the local file differs
+        self.existing_etag = None
+
+
+class MigrationJournal(object):
+    ''' An append-only record of the outcome of each resource migration,
+    so that an interrupted run can resume where it stopped.
+
+    Each line is a JSON object with the resource ID and a status of
+    'done' or 'failed'. Resources marked as done are skipped on the
+    next run; failed ones are retried.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+        self.failed = {}
+        self._file = None
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # eg a partial line from an interrupted write
+                        continue
+                    if entry.get('status') == 'done':
+                        self.done.add(entry['resource_id'])
+                        self.failed.pop(entry['resource_id'], None)
+                    else:
+                        self.failed[entry['resource_id']] = entry.get('error')
+
+    def record(self, resource_id, status, **details):
+        if status == 'done':
+            self.done.add(resource_id)
+            self.failed.pop(resource_id, None)
+        else:
+            self.failed[resource_id] = details.get('error')
+        if not self.path:
+            return
+        details.update({'resource_id': resource_id, 'status': status})
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(details) + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MigrationProgress(object):
+    ''' Tracks and prints throughput and estimated time remaining.
+    '''
+
+    def __init__(self, total_files, total_bytes, interval=5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.failed_bytes = 0
+        self.start = self.last_report = time.time()
+
+    def add(self, size, failed=False):
+        self.files += 1
+        self.bytes += size
+        if failed:
+            self.failed += 1
+            self.failed_bytes += size
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        self.last_report = time.time()
+        elapsed = max(self.last_report - self.start, 0.001)
+        # failed files take no time to send, so they are left out of the rate
+        rate = (self.bytes - self.failed_bytes) / elapsed
+        remaining = (self.total_bytes - self.bytes) / rate if rate else 0
+        print('{0}/{1} files ({2} failed), {3}/{4}, {5}/s, elapsed {6}, ETA {7}'.format(
+            self.files, self.total_files, self.failed,
+            _format_bytes(self.bytes), _format_bytes(self.total_bytes),
+            _format_bytes(rate), _format_duration(elapsed), _format_duration(remaining)))
+
+
+class MigrationEngine(object):
+    ''' Copies local resource files to S3 using a pool of worker threads.
+
+    S3 transfers run in the worker threads, while CKAN actions, which
+    use the database session, run on the calling thread.
+    '''
+
+    def __init__(self, resource_ids_and_names, resource_ids_and_paths,
+                 workers=4, journal_path=None, dry_run=False, progress_interval=5):
+        self.resource_ids_and_names = resource_ids_and_names
+        self.resource_ids_and_paths = resource_ids_and_paths
+        self.workers = max(workers, 1)
+        self.journal = MigrationJournal(journal_path)
+        self.dry_run = dry_run
+        self.progress_interval = progress_interval
+        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
+        self.acl = config.get('ckanext.s3filestore.acl', 'public-read')
+        base_uploader = uploader.BaseS3Uploader()
+        self.transfer_config = base_uploader.get_transfer_config()
+        # each worker may send this many parts at once
+        self.s3_connection = base_uploader.get_s3_client(
+            max_pool_connections=self.workers * self.transfer_config.max_concurrency)
+        self.get_visibility_args = base_uploader.get_visibility_args
+        self.uploaded_resources = []
+        self._resource_packages = {}
+        self._package_privacy = {}
+
+    def list_existing_objects(self, tasks):
+        ''' Index the objects already in the bucket by key, with their
+        size and ETag, using paginated listings rather than a request
+        per key.
+        '''
+        if len(tasks) > FULL_LISTING_THRESHOLD:
+            prefixes = [RESOURCES_PREFIX]
+        else:
+            prefixes = [RESOURCES_PREFIX + task.resource_id + '/' for task in tasks]
+        paginator = self.s3_connection.get_paginator('list_objects_v2')
+        existing = {}
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    existing[obj['Key']] = (obj['Size'], obj['ETag'])
+        return existing
+
+    def plan(self):
+        ''' List the files to migrate, skipping resources already
+        recorded as done in the journal. Files already in S3 with the
+        same size are listed too, and compared with the object's ETag
+        by the workers, which skip them if they match.
+        '''
+        tasks = []
+        resumed = 0
+        for resource_id, file_name in self.resource_ids_and_names.items():
+            if resource_id not in self.resource_ids_and_paths:
+                continue
+            if resource_id in self.journal.done:
+                resumed += 1
+                continue
+            tasks.append(MigrationTask(resource_id, file_name, self.resource_ids_and_paths[resource_id]))
+        if resumed:
+            print('{0} resources already migrated according to the journal, skipping'.format(resumed))
+
+        existing = self.list_existing_objects(tasks) if tasks else {}
+        print('{0} objects found in S3'.format(len(existing)))
+        for task in tasks:
+            existing_size, existing_etag = existing.get(task.key, (None, None))
+            # failed uploads may have left an incomplete or corrupt object
+            if existing_size is None or task.resource_id in self.journal.failed:
+                continue
+            if existing_size != task.size:
+                print("{} is in S3 with size {}, but the local file has size {}; uploading again".format(
+                    task.key, existing_size, task.size))
+                continue
+            task.existing_etag = existing_etag
+        print('{0} files to migrate, {1} in total{2}{3}'.format(
+            len(tasks), _format_bytes(sum(task.size for task in tasks)),
+            ' ({0} failed previously)'.format(
+                len([task for task in tasks if task.resource_id in self.journal.failed]))
+            if self.journal.failed else '',
+            ', {0} of them already in S3 with the same size, to be checked'.format(
+                len([task for task in tasks if task.existing_etag is not None]))))
+        return tasks
+
+    def run(self):
+        tasks = self.plan()
+        if self.dry_run:
+            for task in tasks:
+                print('Would upload {0} ({1}) to {2}{3}'.format(
+                    task.path, _format_bytes(task.size), task.key,
+                    ', unless it matches the object there' if task.existing_etag is not None else ''))
+            return
+
+        if self.acl == 'auto':
+            self._load_package_privacy([task.resource_id for task in tasks])
+        progress = MigrationProgress(len(tasks), sum(task.size for task in tasks), self.progress_interval)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = {}
+                for task in tasks:
+                    try:
+                        task.acl = self._get_acl(task.resource_id)
+                    except MigrationError as e:
+                        self._record_failure(task, 'upload', e, progress)
+                        continue
+                    # bound the work queued ahead of the workers
+                    if len(pending) >= self.workers * 2:
+                        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._complete(pending.pop(future), future, progress)
+                    pending[executor.submit(self._upload, task)] = task
+                for future in list(pending):
+                    self._complete(pending.pop(future), future, progress)
+        finally:
+            self.journal.close()
+        progress.report()
+        print('Done, uploaded {0} resources to S3'.format(len(self.uploaded_resources)))
+        if self.journal.failed:
+            print('{0} resources failed and will be retried on the next run'.format(len(self.journal.failed)))
+
+    def _load_package_privacy(self, resource_ids):
+        ''' Read the package of each resource, and whether it is
+        private, without building the packages.
+        '''
+        for start in range(0, len(resource_ids), PACKAGE_QUERY_BATCH_SIZE):
+            rows = model.Session.query(model.Resource.id, model.Package.id, model.Package.private) \
+                .join(model.Package, model.Resource.package_id == model.Package.id) \
+                .filter(model.Resource.id.in_(resource_ids[start:start + PACKAGE_QUERY_BATCH_SIZE]))
+            for resource_id, package_id, private in rows:
+                self._resource_packages[resource_id] = package_id
+                self._package_privacy[package_id] = bool(private)
+
+    def _get_acl(self, resource_id):
+        acl = self.acl
+        if acl == 'auto':
+            if resource_id not in self._resource_packages:
+                self._load_package_privacy([resource_id])
+            package_id = self._resource_packages.get(resource_id)
+            if package_id is None:
+                raise MigrationError('Resource {0} not found'.format(resource_id))
+            acl = 'private' if self._package_privacy[package_id] else 'public-read'
+        return acl
+
+    def _get_local_digests(self, task):
+        ''' Read the local file once to find both the ETags that S3
+        could have given it: that of a single PUT, and that of an upload
+        in parts of the configured size. Objects uploaded with other part
+        sizes, or encrypted with KMS, match neither and are uploaded again.
+        Returns the two ETags and the SHA-256 digest of the file.
+        '''
+        part_size = ChunksizeAdjuster().adjust_chunksize(self.transfer_config.multipart_chunksize, task.size)
+        with open(task.path, 'rb') as local_file:
+            reader = HashingReader(local_file, part_size)
+            while reader.read(part_size):
+                pass
+        return (reader.expected_etag(False), reader.expected_etag(True)), reader.sha256.hexdigest()
+
+    def _upload(self, task):
+        ''' Stream one file to S3, then check that the object has the
+        expected size and ETag. Returns the SHA-256 digest of the file,
+        and whether it was uploaded, rather than matching the object
+        already in S3.
+        '''
+        if task.existing_etag is not None:
+            etags, sha256 = self._get_local_digests(task)
+            if task.existing_etag in etags:
+                print("{} is already in S3, skipping".format(task.key))
+                return sha256, False
+            print("{} is in S3, but does not match the local file; uploading again".format(task.key))
+
+        print("Uploading {} to S3 bucket {} under key {} with ACL {}".format(
+            task.path, self.bucket_name, task.key, task.acl))
+        multipart = task.size >= self.transfer_config.multipart_threshold
+        part_size = ChunksizeAdjuster().adjust_chunksize(self.transfer_config.multipart_chunksize, task.size)
+        with open(task.path, 'rb') as upload_file:
+            result = None
+            if multipart:
+                result = upload_mapped_file(
+                    self.s3_connection, self.bucket_name, task.key, upload_file, part_size,
+                    extra_args=self.get_visibility_args(task.acl), concurrency=self.transfer_config.max_concurrency)
+            if result is None:
+                reader = HashingReader(upload_file, part_size)
+                self.s3_connection.upload_fileobj(
+                    reader, self.bucket_name, task.key,
+                    ExtraArgs=self.get_visibility_args(task.acl), Config=self.transfer_config)
+                result = reader.expected_etag(multipart), reader.sha256.hexdigest()
+        expected_etag, sha256 = result
+
+        obj = self.s3_connection.head_object(Bucket=self.bucket_name, Key=task.key)
+        if obj['ContentLength'] != task.size:
+            raise MigrationError('Uploaded object has size {0}, expected {1}'.format(
+                obj['ContentLength'], task.size))
+        # the ETag of an object encrypted with KMS is not derived from its content
+        if obj.get('ServerSideEncryption') != 'aws:kms' and obj['ETag'] != expected_etag:
+            raise MigrationError('Uploaded object has ETag {0}, expected {1}'.format(obj['ETag'], expected_etag))
+        return sha256, True
+
+    def _complete(self, task, future, progress):
+        try:
+            sha256, uploaded = future.result()
+        except Exception as e:
+            self._record_failure(task, 'upload', e, progress)
+            return
+        if not uploaded:
+            self.journal.record(task.resource_id, 'done', key=task.key, size=task.size, sha256=sha256,
+                                skipped=True)
+            progress.add(task.size)
+            return
+        print('Uploaded resource {0} ({1}) to S3'.format(task.resource_id, task.file_name))
+        try:
+            get_action('resource_patch')({'ignore_auth': True}, {'id': task.resource_id, 'url': task.file_name})
+        except ValidationError:
+            print("{} failed to validate; file is in S3 but might not be used".format(task.resource_id))
+        except Exception as e:
+            # the next run uploads the file again, and retries the update
+            model.Session.rollback()
+            self._record_failure(task, 'update', e, progress)
+            return
+        self.uploaded_resources.append(task.resource_id)
+        self.journal.record(task.resource_id, 'done', key=task.key, size=task.size, sha256=sha256)
+        progress.add(task.size)
+
+    def _record_failure(self, task, step, error, progress):
+        print('Failed to {0} resource {1} ({2}): {3}'.format(step, task.resource_id, task.file_name, error))
+        self.journal.record(task.resource_id, 'failed', key=task.key, error=str(error))
+        progress.add(task.size, failed=True)
@@ -0,0 +1,171 @@
+# encoding: utf-8
+
+import datetime
+import logging
+import threading
+
+from sqlalchemy import Column, MetaData, Table, func, select, types
+
+from ckan.model import meta
+
+log = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# The visibility last applied to all S3 objects of each resource,
+# and the key of its current object at the time.
+visibility_state_table = Table(
+    's3filestore_visibility_state', metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('object_key', types.UnicodeText, nullable=False),
+    Column('acl', types.UnicodeText, nullable=False),
+    Column('updated', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+# Resource object keys whose content is stored under its hash, when
+# ckanext.s3filestore.content_addressed is enabled. Each row is one
+# reference to a blob; a blob with no references can be deleted.
+blob_reference_table = Table(
+    's3filestore_blob_reference', metadata,
+    Column('object_key', types.UnicodeText, primary_key=True),
+    Column('blob_key', types.UnicodeText, nullable=False, index=True),
+    Column('updated', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+_tables_created = set()
+_tables_lock = threading.Lock()
+
+
+def setup():
+    ''' Create the tables used by the extension, if they do not exist.
+    '''
+    engine = meta.engine
+    if engine in _tables_created:
+        return
+    with _tables_lock:
+        if engine not in _tables_created:
+            metadata.create_all(bind=engine, checkfirst=True)
+            _tables_created.add(engine)
+
+
+def get_visibility_state(resource_id):
+    ''' Return the (object key, ACL) last applied to the resource,
+    or None if unknown.
+    '''
+    try:
+        setup()
+        with meta.engine.connect() as connection:
+            row = connection.execute(
+                visibility_state_table.select().where(
+                    visibility_state_table.c.resource_id == resource_id)).first()
+    except Exception as e:
+        log.error("Failed to read visibility state of resource %s: %s", resource_id, e)
+        return None
+    if row is None:
+        return None
+    return row[1], row[2]
+
+
+def set_visibility_state(resource_id, object_key, acl):
+    ''' Record that all S3 objects of the resource have been given
+    the visibility matching `acl`.
+    '''
+    try:
+        setup()
+        with meta.engine.begin() as connection:
+            connection.execute(visibility_state_table.delete().where(
+                visibility_state_table.c.resource_id == resource_id))
+            connection.execute(visibility_state_table.insert().values(
+                resource_id=resource_id, object_key=object_key, acl=acl,
+                updated=datetime.datetime.utcnow()))
+    except Exception as e:
+        log.error("Failed to record visibility state of resource %s: %s", resource_id, e)
+
+
+def clear_visibility_state(resource_id):
+    ''' Forget the visibility of the resource, so that its S3 objects
+    are checked on the next visibility update.
+    '''
+    try:
+        setup()
+        with meta.engine.begin() as connection:
+            connection.execute(visibility_state_table.delete().where(
+                visibility_state_table.c.resource_id == resource_id))
+    except Exception as e:
+        log.error("Failed to clear visibility state of resource %s: %s", resource_id, e)
+
+
+def get_blob_key(object_key):
+    ''' Return the key of the blob holding the content of a resource
+    object key, in the content-addressed layout, or None if it has none.
+    Errors are raised, so that they are not taken to mean there is no blob.
+    '''
+    setup()
+    with meta.engine.connect() as connection:
+        row = connection.execute(
+            select([blob_reference_table.c.blob_key]).where(
+                blob_reference_table.c.object_key == object_key)).first()
+    return row[0] if row else None
+
+
+def set_blob_reference(object_key, blob_key):
+    ''' Point a resource object key at a blob, replacing any blob
+    it pointed at before. Unlike the visibility state, this is the only
+    record of where the content is, so errors are raised.
+    '''
+    setup()
+    with meta.engine.begin() as connection:
+        connection.execute(blob_reference_table.delete().where(
+            blob_reference_table.c.object_key == object_key))
+        connection.execute(blob_reference_table.insert().values(
+            object_key=object_key, blob_key=blob_key,
+            updated=datetime.datetime.utcnow()))
+
+
+def remove_blob_reference(object_key, blob_key):
+    ''' Remove the reference from a resource object key to a blob.
+    Returns the number of references to the blob that remain.
+    '''
+    setup()
+    with meta.engine.begin() as connection:
+        connection.execute(blob_reference_table.delete().where(
+            (blob_reference_table.c.object_key == object_key)
+            & (blob_reference_table.c.blob_key == blob_key)))
+        return count_blob_references(blob_key, connection)
+
+
+def count_blob_references(blob_key, connection=None):
+    ''' Return the number of resource object keys pointing at a blob.
+    '''
+    query = select([func.count()]).select_from(blob_reference_table).where(
+        blob_reference_table.c.blob_key == blob_key)
+    if connection is not None:
+        return connection.execute(query).scalar()
+    setup()
+    with meta.engine.connect() as connection:
+        return connection.execute(query).scalar()
+
+
+def get_referenced_blob_keys(blob_keys):
+    ''' Return the set of those `blob_keys` that any resource object
+    key points at.
+    '''
+    setup()
+    with meta.engine.connect() as connection:
+        return set(row[0] for row in connection.execute(
+            select([blob_reference_table.c.blob_key]).distinct().where(
+                blob_reference_table.c.blob_key.in_(list(blob_keys)))))
+
+
+def iter_blob_references(prefix):
+    ''' Yield the (object key, blob key, updated) of each reference
+    from an object key starting with `prefix`.
+    '''
+    setup()
+    with meta.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            select([blob_reference_table.c.object_key, blob_reference_table.c.blob_key,
+                    blob_reference_table.c.updated]).where(
+                blob_reference_table.c.object_key.startswith(prefix)))
+        for row in result:
+            yield row[0], row[1], row[2]
@@ -10,6 +10,7 @@ from ckan.lib.uploader import ResourceUpload as DefaultResourceUpload,\
     get_resource_uploader
 
 import ckanext.s3filestore.tasks as tasks
+from ckanext.s3filestore.visibility import update_resources_visibility
 
 from ckanext.s3filestore.redis_helper import RedisHelper
 
@@ -22,6 +23,8 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IUploader)
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
 
     if toolkit.check_ckan_version(min_version='2.9.0'):
         plugins.implements(plugins.IBlueprint)
@@ -29,6 +32,9 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     else:
         plugins.implements(plugins.IRoutes, inherit=True)
 
+    # replaced from the config by configure()
+    visibility_update_concurrency = 1
+
     # IConfigurer
 
     def update_config(self, config_):
@@ -67,6 +73,8 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
 
         self.async_visibility_update = toolkit.asbool(config.get(
             'ckanext.s3filestore.acl.async_update', 'True'))
+        self.visibility_update_concurrency = int(config.get(
+            'ckanext.s3filestore.acl.update_concurrency', '4'))
 
     # IUploader
 
@@ -78,6 +86,18 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         '''Return an uploader object used to upload general files.'''
         return s3_uploader.S3Uploader(upload_to, old_filename)
 
+    # IActions
+
+    def get_actions(self):
+        from ckanext.s3filestore import action
+        return action.get_actions()
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        from ckanext.s3filestore import auth
+        return auth.get_auth_functions()
+
     # IPackageController
 
     def after_update(self, context, pkg_dict):
@@ -85,6 +105,7 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         '''
         pkg_id = pkg_dict['id']
         LOG.debug("after_update: Package %s has been updated, notifying resources", pkg_id)
+        s3_uploader.forget_package(pkg_id)
 
         is_private = pkg_dict.get('private', False)
         is_private_str = six.text_type(is_private)
@@ -103,7 +124,7 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         async_update = self.async_visibility_update
         if async_update:
             try:
-                self.enqueue_resource_visibility_update_job(visibility_level, pkg_id)
+                self.enqueue_pending_visibility_update_job(visibility_level, pkg_id)
             except Exception as e:
                 LOG.debug("after_update: Failed to enqueue, updating inline. Error: [%s]", e)
                 async_update = False
@@ -116,36 +137,38 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     def after_update_resource_list_update(self, visibility_level, pkg_id, pkg_dict):
 
         LOG.debug("after_update_resource_list_update: Package %s has been updated, notifying resources", pkg_id)
-        for resource in pkg_dict['resources']:
-            uploader = get_resource_uploader(resource)
-            if hasattr(uploader, 'update_visibility'):
-                uploader.update_visibility(
-                    resource['id'],
-                    target_acl=visibility_level)
-        LOG.debug("after_update_resource_list_update: Package %s has been updated, notifying resources finished", pkg_id)
+        summary = update_resources_visibility(
+            [(resource, visibility_level) for resource in pkg_dict['resources']],
+            get_resource_uploader,
+            concurrency=self.visibility_update_concurrency)
+        LOG.info("after_update_resource_list_update: Package %s visibility set to %s: %s",
+                 pkg_id, visibility_level, summary)
+        if summary.failed:
+            raise s3_uploader.S3FileStoreException(
+                "Failed to update visibility of resources {0} in package {1}".format(
+                    ', '.join(sorted(summary.failed.keys())), pkg_id))
+
+    def enqueue_pending_visibility_update_job(self, visibility_level, pkg_id):
+        ''' Queue a visibility update for the package, unless one is
+        already queued; the queued job will apply the latest visibility.
+        '''
+        redis = RedisHelper()
+        pending_key = pkg_id + tasks.VISIBILITY_JOB_PENDING
+        if not redis.put_if_absent(pending_key, visibility_level, expiry=tasks.VISIBILITY_JOB_PENDING_EXPIRY):
+            LOG.debug("Package %s already has a visibility update queued", pkg_id)
+            return
+        try:
+            self.enqueue_resource_visibility_update_job(visibility_level, pkg_id)
+        except Exception:
+            redis.delete(pending_key)
+            raise
 
     def enqueue_resource_visibility_update_job(self, visibility_level, pkg_id):
 
-        enqueue_args = {
-            'fn': tasks.s3_afterUpdatePackage,
-            'title': "s3_afterUpdatePackage: setting {} on {}".format(visibility_level, pkg_id),
-            'kwargs': {'visibility_level': visibility_level, 'pkg_id': pkg_id},
-        }
-        if toolkit.check_ckan_version('2.8'):
-            ttl = 24 * 60 * 60  # 24 hour ttl.
-            rq_kwargs = {
-                'ttl': ttl
-            }
-            if toolkit.check_ckan_version('2.9'):
-                rq_kwargs['failure_ttl'] = ttl
-            enqueue_args['rq_kwargs'] = rq_kwargs
-
-        # Optional variable, if not set, default queue is used
-        queue = toolkit.config.get('ckanext.s3filestore.queue', None)
-        if queue:
-            enqueue_args['queue'] = queue
-
-        toolkit.enqueue_job(**enqueue_args)
+        tasks.enqueue_task(
+            tasks.s3_afterUpdatePackage,
+            "s3_afterUpdatePackage: setting {} on {}".format(visibility_level, pkg_id),
+            {'visibility_level': visibility_level, 'pkg_id': pkg_id})
         LOG.debug("enqueue_resource_visibility_update_job: Package %s has been enqueued",
                   pkg_id)
 
@@ -1,14 +1,165 @@
 # encoding: utf-8
 
 from builtins import object
+from collections import OrderedDict
+from contextlib import contextmanager
 import logging
+import os
 import six
+import threading
+import time
+import uuid
 
+import ckantoolkit as toolkit
 from ckan.lib.redis import connect_to_redis
 
 log = logging.getLogger(__name__)
 
 REDIS_PREFIX = 'ckanext-s3filestore:'
+INVALIDATION_CHANNEL = REDIS_PREFIX + 'invalidate'
+
+_redis_conn = None
+_local_cache = None
+_local_cache_settings = None
+
+
+def _get_connection():
+    ''' Return a Redis client for this process.
+    The client holds a connection pool, so connections are reused
+    across operations; redis-py discards the pool after a fork.
+    '''
+    global _redis_conn
+    if _redis_conn is None:
+        _redis_conn = connect_to_redis()
+    return _redis_conn
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def _to_text(cache_value):
+    if cache_value is not None and hasattr(six, 'ensure_text'):
+        cache_value = six.ensure_text(cache_value)
+    return cache_value
+
+
+class LocalCache(object):
+    ''' A bounded in-process cache in front of Redis. When full, the
+    least recently used entry is evicted. Entries expire after the
+    configured TTL, or sooner if their Redis counterpart expires first.
+
+    The cache is only used while `ready` is set, ie while subscribed
+    to invalidations from other processes.
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # identifies our own invalidation messages
+        self.token = uuid.uuid4().hex
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def get(self, key):
+        ''' Return the cached value, or None if absent or expired.
+        '''
+        if not self.ready.is_set():
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ''' Cache a value, for no longer than `ttl` seconds if specified.
+        '''
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if value is None or ttl <= 0 or not self.ready.is_set():
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _get_local_cache():
+    ''' Return the in-process cache, or None if it is disabled.
+    A new cache is created in each process, and when the settings change.
+    '''
+    global _local_cache, _local_cache_settings
+    config = toolkit.config
+    settings = (os.getpid(),
+                int(config.get('ckanext.s3filestore.local_cache_size', '0')),
+                int(config.get('ckanext.s3filestore.local_cache_ttl', '60')))
+    if settings != _local_cache_settings:
+        _local_cache_settings = settings
+        if settings[1] > 0 and settings[2] > 0:
+            _local_cache = LocalCache(settings[1], settings[2])
+            listener = threading.Thread(
+                target=_listen_for_invalidations, args=(_local_cache,),
+                name='s3filestore-cache-invalidation')
+            listener.daemon = True
+            listener.start()
+        else:
+            _local_cache = None
+    return _local_cache
+
+
+def _listen_for_invalidations(local_cache):
+    ''' Evict keys changed by other processes from the local cache,
+    until the cache is replaced.
+    '''
+    while local_cache is _local_cache:
+        pubsub = None
+        try:
+            pubsub = _get_connection().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            local_cache.ready.set()
+            while local_cache is _local_cache:
+                message = pubsub.get_message(timeout=1.0)
+                if not message or message['type'] != 'message':
+                    continue
+                token_and_keys = _to_text(message['data']).split('\n')
+                if token_and_keys[0] != local_cache.token:
+                    local_cache.evict(token_and_keys[1:])
+        except Exception as e:
+            log.warning("Lost Redis cache invalidation channel: %s", e)
+            # changes may be missed until we resubscribe
+            local_cache.ready.clear()
+            local_cache.clear()
+            time.sleep(5)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+def _publish_invalidation(redis_conn, local_cache, cache_keys):
+    ''' Tell other processes to evict the keys from their local caches.
+    `redis_conn` may be a pipeline, in which case the message is
+    sent when the pipeline is executed.
+    '''
+    redis_conn.publish(INVALIDATION_CHANNEL, '\n'.join([local_cache.token] + list(cache_keys)))
 
 
 class RedisHelper(object):
@@ -21,34 +172,269 @@ class RedisHelper(object):
         Returned values will be converted to text type instead of bytes.
         '''
         cache_key = self._get_cache_key(key)
+        local_cache = _get_local_cache()
+        if local_cache is None:
+            try:
+                cache_value = _get_connection().get(cache_key)
+            except Exception as e:
+                log.error("Failed to connect to Redis cache: %s", e)
+                cache_value = None
+            return _to_text(cache_value)
+        return self._get_many_through_local_cache(local_cache, [cache_key])[0]
+
+    def get_many(self, keys):
+        ''' Get multiple values from the cache in a single round trip.
+        Returns a list in the same order as `keys`, with None
+        for any value that is not available.
+        '''
+        cache_keys = [self._get_cache_key(key) for key in keys]
+        if not cache_keys:
+            return []
+        local_cache = _get_local_cache()
+        if local_cache is not None:
+            return self._get_many_through_local_cache(local_cache, cache_keys)
+        try:
+            cache_values = _get_connection().mget(cache_keys)
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+            cache_values = [None] * len(cache_keys)
+        return [_to_text(cache_value) for cache_value in cache_values]
+
+    def _get_many_through_local_cache(self, local_cache, cache_keys):
+        ''' Look up values in the local cache, then fetch any missing
+        values from Redis, along with their remaining lifetimes,
+        in a single round trip.
+        '''
+        cache_values = [local_cache.get(cache_key) for cache_key in cache_keys]
+        missing_keys = [cache_key for cache_key, cache_value
+                        in zip(cache_keys, cache_values) if cache_value is None]
+        if not missing_keys:
+            return cache_values
         try:
-            redis_conn = connect_to_redis()
-            cache_value = redis_conn.get(cache_key)
+            pipeline = _get_connection().pipeline(transaction=False)
+            pipeline.mget(missing_keys)
+            for cache_key in missing_keys:
+                pipeline.pttl(cache_key)
+            results = pipeline.execute()
         except Exception as e:
             log.error("Failed to connect to Redis cache: %s", e)
-            cache_value = None
-        if cache_value is not None and hasattr(six, 'ensure_text'):
-            cache_value = six.ensure_text(cache_value)
-        return cache_value
+            return cache_values
+        fetched = {}
+        for cache_key, cache_value, ttl in zip(missing_keys, results[0], results[1:]):
+            cache_value = _to_text(cache_value)
+            fetched[cache_key] = cache_value
+            # a negative TTL means no expiry (-1) or already gone (-2)
+            if ttl is None or ttl == -1:
+                local_cache.set(cache_key, cache_value)
+            elif ttl > 0:
+                local_cache.set(cache_key, cache_value, ttl / 1000.0)
+        return [fetched.get(cache_key) if cache_value is None else cache_value
+                for cache_key, cache_value in zip(cache_keys, cache_values)]
 
     def put(self, key, value, expiry=None):
         ''' Set a URL value in the cache, if available, with the
         specified expiry. If expiry is None, no action is taken.
         '''
         if expiry:
-            cache_key = self._get_cache_key(key)
-            try:
-                redis_conn = connect_to_redis()
-                redis_conn.set(cache_key, value, ex=expiry)
-            except Exception as e:
-                log.error("Failed to connect to Redis cache: %s", e)
+            with self.batch() as batch:
+                batch.put(key, value, expiry=expiry)
+
+    def put_many(self, values, expiry=None):
+        ''' Set multiple values in the cache in a single round trip,
+        each with the specified expiry. If expiry is None,
+        no action is taken.
+        '''
+        with self.batch() as batch:
+            for key, value in values.items():
+                batch.put(key, value, expiry=expiry)
 
     def delete(self, key):
         ''' Delete a value from the cache, if available.
         '''
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        ''' Delete multiple values from the cache in a single round trip.
+        '''
+        with self.batch() as batch:
+            for key in keys:
+                batch.delete(key)
+
+    def get_ttls(self, keys):
+        ''' Get the remaining lifetimes, in seconds, of multiple values
+        in a single round trip. Returns a list in the same order as
+        `keys`, with None for any value that is missing, has no expiry,
+        or is not available.
+        '''
+        if not keys:
+            return []
+        try:
+            pipeline = _get_connection().pipeline(transaction=False)
+            for key in keys:
+                pipeline.pttl(self._get_cache_key(key))
+            ttls = pipeline.execute()
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+            return [None] * len(keys)
+        return [ttl / 1000.0 if ttl is not None and ttl >= 0 else None for ttl in ttls]
+
+    def increment_scores(self, key, increments, max_size=None):
+        ''' Add to the scores of members of a sorted set,
+        in a single round trip.
+        If `max_size` is set, the set is then trimmed to that many
+        members, dropping those with the lowest scores.
+        '''
+        if not increments:
+            return
+        cache_key = self._get_cache_key(key)
+        try:
+            pipeline = _get_connection().pipeline(transaction=False)
+            for member, amount in increments.items():
+                # keywords, as redis-py 2 and 3 take these in a different order
+                pipeline.zincrby(name=cache_key, amount=amount, value=member)
+            if max_size:
+                pipeline.zremrangebyrank(cache_key, 0, -max_size - 1)
+            pipeline.execute()
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+
+    def get_top_members(self, key, count):
+        ''' Get the members of a sorted set with the highest scores,
+        highest first.
+        '''
+        try:
+            members = _get_connection().zrevrange(self._get_cache_key(key), 0, count - 1)
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+            return []
+        return [_to_text(member) for member in members]
+
+    def remove_members(self, key, members):
+        ''' Remove members from a sorted set.
+        '''
+        if not members:
+            return
+        try:
+            _get_connection().zrem(self._get_cache_key(key), *members)
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+
+    def decay_scores(self, key, factor, max_size):
+        ''' Multiply the scores of a sorted set by `factor`, so that
+        older increments count for less, and keep only the `max_size`
+        members with the highest scores.
+        '''
         cache_key = self._get_cache_key(key)
         try:
-            redis_conn = connect_to_redis()
-            redis_conn.delete(cache_key)
+            pipeline = _get_connection().pipeline(transaction=True)
+            pipeline.zunionstore(cache_key, {cache_key: factor})
+            pipeline.zremrangebyrank(cache_key, 0, -max_size - 1)
+            pipeline.execute()
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+
+    def put_if_absent(self, key, value, expiry):
+        ''' Set a value in the cache, with the specified expiry,
+        unless the key already has a value.
+
+        :returns: True if the value was set, or if the cache is
+            unavailable, False if the key already had a value
+        '''
+        try:
+            return bool(_get_connection().set(self._get_cache_key(key), value, ex=expiry, nx=True))
         except Exception as e:
             log.error("Failed to connect to Redis cache: %s", e)
+            return True
+
+    @contextmanager
+    def lock(self, key, timeout, blocking_timeout=None):
+        ''' Hold a lock shared by all processes, waiting for it if
+        necessary. The lock is released after `timeout` seconds even
+        if the holder has not finished.
+        If `blocking_timeout` is set, LockTimeout is raised if the lock
+        is not acquired within that many seconds.
+        If the cache is unavailable, the block runs without the lock.
+        '''
+        lock = None
+        acquired = True
+        try:
+            lock = _get_connection().lock(
+                self._get_cache_key(key), timeout=timeout, blocking_timeout=blocking_timeout)
+            acquired = lock.acquire()
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+            lock = None
+        if not acquired:
+            raise LockTimeout('Timed out waiting for lock {0}'.format(key))
+        try:
+            yield
+        finally:
+            if lock is not None:
+                try:
+                    lock.release()
+                except Exception as e:
+                    # eg the lock expired and was taken by another process
+                    log.warning("Failed to release Redis lock %s: %s", key, e)
+
+    def batch(self):
+        ''' Start a batch of cache updates, which are sent to Redis
+        in a single round trip when the batch is executed.
+        Use as a context manager to execute automatically, eg:
+
+            with redis.batch() as batch:
+                batch.delete(key)
+                batch.put(other_key, value, expiry=60)
+        '''
+        return RedisBatch(self)
+
+
+class RedisBatch(object):
+    ''' A pipeline of cache updates. Operations are queued until
+    `execute` is called, or the `with` block exits. Queued operations
+    are sent even if the block raised an error, since they describe
+    changes that have already been made in S3.
+    '''
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.operations = []
+
+    def put(self, key, value, expiry=None):
+        if expiry:
+            self.operations.append(('set', self.helper._get_cache_key(key), value, expiry))
+        return self
+
+    def delete(self, key):
+        self.operations.append(('delete', self.helper._get_cache_key(key)))
+        return self
+
+    def execute(self):
+        operations, self.operations = self.operations, []
+        if not operations:
+            return
+        local_cache = _get_local_cache()
+        if local_cache is not None:
+            # apply locally first, so a failure cannot leave stale values
+            for operation in operations:
+                if operation[0] == 'set':
+                    local_cache.set(operation[1], operation[2], operation[3])
+                else:
+                    local_cache.evict([operation[1]])
+        try:
+            pipeline = _get_connection().pipeline(transaction=False)
+            for operation in operations:
+                if operation[0] == 'set':
+                    pipeline.set(operation[1], operation[2], ex=operation[3])
+                else:
+                    pipeline.delete(operation[1])
+            if local_cache is not None:
+                _publish_invalidation(pipeline, local_cache, [operation[1] for operation in operations])
+            pipeline.execute()
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.execute()
@@ -5,9 +5,47 @@ import os
 
 from ckan import plugins as p
 
+from ckanext.s3filestore.redis_helper import RedisHelper
+
 toolkit = p.toolkit
 log = logging.getLogger(__name__)
 
+# marks a package as having a visibility update job queued;
+# expires with the job if it is never run
+VISIBILITY_JOB_PENDING = '/visibility_job_pending'
+VISIBILITY_JOB_PENDING_EXPIRY = 24 * 60 * 60
+# serialises visibility updates of a package
+VISIBILITY_UPDATE_LOCK = '/visibility_update_lock'
+VISIBILITY_UPDATE_LOCK_TIMEOUT = 60 * 60
+# serialises uploads of staged files for a resource
+UPLOAD_LOCK = '/upload_lock'
+UPLOAD_LOCK_TIMEOUT = 60 * 60
+JOB_TTL = 24 * 60 * 60
+
+
+def enqueue_task(fn, title, kwargs):
+    ''' Queue a job on the configured queue, or the default queue.
+    '''
+    enqueue_args = {
+        'fn': fn,
+        'title': title,
+        'kwargs': kwargs,
+    }
+    if toolkit.check_ckan_version('2.8'):
+        rq_kwargs = {
+            'ttl': JOB_TTL
+        }
+        if toolkit.check_ckan_version('2.9'):
+            rq_kwargs['failure_ttl'] = JOB_TTL
+        enqueue_args['rq_kwargs'] = rq_kwargs
+
+    # Optional variable, if not set, default queue is used
+    queue = toolkit.config.get('ckanext.s3filestore.queue', None)
+    if queue:
+        enqueue_args['queue'] = queue
+
+    toolkit.enqueue_job(**enqueue_args)
+
 
 def s3_afterUpdatePackage(ckan_ini_filepath=None, visibility_level=None, pkg_id=None, pkg_dict=None):
     u'''
@@ -15,7 +53,8 @@ def s3_afterUpdatePackage(ckan_ini_filepath=None, visibility_level=None, pkg_id=
 
     :param string ckan_ini_filepath: Deprecated, will be removed version+1 release so that in situ jobs are not lost.
 
-    :param boolean visibility_level: what visibility should be set
+    :param boolean visibility_level: the visibility requested when the job was queued;
+        the visibility applied is that of the package when the job runs
 
     :param string pkg_id: package id for resources to update
 
@@ -30,10 +69,21 @@ def s3_afterUpdatePackage(ckan_ini_filepath=None, visibility_level=None, pkg_id=
     # Also put try/except around it, as it is easier to monitor CKAN's log
     # rather than a queue's task status.
     try:
-        pkg_dict = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg_id})
+        redis = RedisHelper()
+        # changes made while this job was queued joined it, as no other
+        # job was queued for them; changes made from now on queue a new
+        # job, which will see them
+        redis.delete(pkg_id + VISIBILITY_JOB_PENDING)
+        with redis.lock(pkg_id + VISIBILITY_UPDATE_LOCK, VISIBILITY_UPDATE_LOCK_TIMEOUT):
+            pkg_dict = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg_id})
+            current_visibility_level = 'private' if pkg_dict.get('private') else 'public-read'
+            if current_visibility_level != visibility_level:
+                log.info('Package %r has been made %s since the job was queued',
+                         pkg_id, current_visibility_level)
+                visibility_level = current_visibility_level
 
-        plugin = p.get_plugin("s3filestore")
-        plugin.after_update_resource_list_update(visibility_level, pkg_id, pkg_dict)
+            plugin = p.get_plugin("s3filestore")
+            plugin.after_update_resource_list_update(visibility_level, pkg_id, pkg_dict)
         log.info('Finished s3_afterUpdatePackage task: package_id=%r, visibility_level=%s', pkg_id, visibility_level)
 
     except Exception as e:
@@ -44,3 +94,40 @@ def s3_afterUpdatePackage(ckan_ini_filepath=None, visibility_level=None, pkg_id=
         log.error('Error s3_afterUpdatePackage task: package_id=%r, visibility_level=%s stackTrace: %s',
                   pkg_id, visibility_level, e)
         raise
+
+
+def s3_uploadResource(resource_id=None, filename=None, token=None, metadata=None):
+    u'''
+    Send a resource file staged by an asynchronous upload to S3.
+
+    :param string resource_id: the resource that the file was uploaded to
+
+    :param string filename: the munged name of the uploaded file
+
+    :param string token: identifies the staged upload; if the resource
+        has been given another file since, this job does nothing
+
+    :param dict metadata: the metadata to store with the S3 object
+
+    :raises Exception: if job has failure.
+    '''
+
+    log.info('Starting s3_uploadResource task: resource_id=%r, filename=%s', resource_id, filename)
+
+    try:
+        # imported here, as the uploader queues this job
+        from ckanext.s3filestore.uploader import S3ResourceUploader
+
+        with RedisHelper().lock(resource_id + UPLOAD_LOCK, UPLOAD_LOCK_TIMEOUT):
+            resource = toolkit.get_action('resource_show')({'ignore_auth': True}, {'id': resource_id})
+            if S3ResourceUploader(resource).upload_staged(resource_id, filename, token, metadata):
+                log.info('Finished s3_uploadResource task: resource_id=%r, filename=%s', resource_id, filename)
+            else:
+                log.info('Resource %r has a newer upload than %s, skipping', resource_id, filename)
+
+    except Exception as e:
+        if os.environ.get('DEBUG'):
+            raise
+        log.error('Error s3_uploadResource task: resource_id=%r, filename=%s stackTrace: %s',
+                  resource_id, filename, e)
+        raise
@@ -0,0 +1,183 @@
+# encoding: utf-8
+
+from builtins import object
+import io
+import os
+import shutil
+import tempfile
+
+import mock
+
+from nose.tools import assert_equal, assert_false, assert_in, assert_not_equal, assert_raises, with_setup
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import helpers
+import ckan.tests.factories as factories
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from ckanext.s3filestore import tasks
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+from .test_uploader import _setup_function
+
+
+@with_setup(_setup_function)
+class TestMultipartActions(object):
+
+    def _test_resource(self):
+        dataset = factories.Dataset(owner_org=self.organisation['id'])
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        return helpers.call_action(
+            'resource_create',
+            package_id=dataset['id'],
+            upload=FlaskFileStorage(io.open(file_path, 'rb')),
+            url='data.csv')
+
+    def test_multipart_upload(self):
+        ''' A file uploaded in parts becomes the resource's current file.
+        '''
+        resource = self._test_resource()
+        body = b'date,price\n2001-01-01,2\n'
+        upload = helpers.call_action(
+            's3filestore_initiate_multipart',
+            id=resource['id'], name='new data.csv', size=len(body))
+        key = S3ResourceUploader(resource).get_path(resource['id'], 'new-data.csv')
+        assert_equal(upload['key'], key)
+        assert_equal(upload['part_count'], 1)
+
+        urls = helpers.call_action(
+            's3filestore_sign_multipart_parts',
+            id=resource['id'], name='new data.csv',
+            upload_id=upload['upload_id'], part_numbers=[1])['urls']
+        assert_in(upload['upload_id'], urls['1'])
+
+        # send the part as the browser would with the signed URL
+        part = self.s3.upload_part(
+            Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+            PartNumber=1, Body=body)
+        updated = helpers.call_action(
+            's3filestore_complete_multipart',
+            id=resource['id'], name='new data.csv', upload_id=upload['upload_id'],
+            parts=[{'part_number': 1, 'etag': part['ETag']}])
+
+        assert_equal(updated['url_type'], 'upload')
+        assert_equal(os.path.basename(updated['url']), 'new-data.csv')
+        assert_equal(int(updated['size']), len(body))
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        assert_equal(obj['Body'].read(), body)
+        assert_equal(obj['ContentType'], 'text/csv')
+
+    @helpers.change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_multipart_upload_replaces_blob(self):
+        ''' A direct upload to a key that pointed at a blob
+        is served instead of the blob.
+        '''
+        resource = self._test_resource()
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'], 'data.csv')
+        assert_not_equal(uploader.resolve_key(key), key)
+
+        body = b'date,price\n2001-01-01,3\n'
+        upload = helpers.call_action(
+            's3filestore_initiate_multipart',
+            id=resource['id'], name='data.csv', size=len(body))
+        part = self.s3.upload_part(
+            Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+            PartNumber=1, Body=body)
+        helpers.call_action(
+            's3filestore_complete_multipart',
+            id=resource['id'], name='data.csv', upload_id=upload['upload_id'],
+            parts=[{'part_number': 1, 'etag': part['ETag']}])
+
+        assert_equal(S3ResourceUploader(resource).resolve_key(key), key)
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        assert_equal(obj['Body'].read(), body)
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_multipart_upload_applies_current_visibility(self):
+        ''' If the dataset is made private while a file is being
+        uploaded, the completed object is private too.
+        '''
+        resource = self._test_resource()
+        key = S3ResourceUploader(resource).get_path(resource['id'])
+        body = b'date,price\n2001-01-01,4\n'
+        upload = helpers.call_action(
+            's3filestore_initiate_multipart',
+            id=resource['id'], name='data.csv', size=len(body))
+        helpers.call_action('package_patch', id=resource['package_id'], private=True)
+
+        part = self.s3.upload_part(
+            Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+            PartNumber=1, Body=body)
+        updated = helpers.call_action(
+            's3filestore_complete_multipart',
+            id=resource['id'], name='data.csv', upload_id=upload['upload_id'],
+            parts=[{'part_number': 1, 'etag': part['ETag']}])
+
+        assert_equal(updated['hash'], '')
+        grants = self.s3.get_object_acl(Bucket=self.bucket_name, Key=key)['Grants']
+        assert_false(any(grant['Grantee'].get('URI', '').endswith('AllUsers') for grant in grants))
+
+    @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+    def test_multipart_upload_discards_staged_upload(self):
+        ''' A job queued for an earlier asynchronous upload does not
+        overwrite a file uploaded in parts since.
+        '''
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                    mock.patch('ckanext.s3filestore.tasks.enqueue_task') as enqueue_task:
+                resource = self._test_resource()
+                uploader = S3ResourceUploader(resource)
+                key = uploader.get_path(resource['id'], 'data.csv')
+                job_kwargs = enqueue_task.call_args[0][2]
+
+                body = b'date,price\n2001-01-01,5\n'
+                upload = helpers.call_action(
+                    's3filestore_initiate_multipart',
+                    id=resource['id'], name='data.csv', size=len(body))
+                part = self.s3.upload_part(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload['upload_id'],
+                    PartNumber=1, Body=body)
+                helpers.call_action(
+                    's3filestore_complete_multipart',
+                    id=resource['id'], name='data.csv', upload_id=upload['upload_id'],
+                    parts=[{'part_number': 1, 'etag': part['ETag']}])
+                assert_false(uploader.is_upload_pending(resource['id']))
+                assert_false(os.path.exists(uploader._get_staged_path(resource['id'])))
+
+                tasks.s3_uploadResource(**job_kwargs)
+                obj = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+                assert_equal(obj['Body'].read(), body)
+        finally:
+            shutil.rmtree(storage_path)
+
+    def test_abort_multipart_upload(self):
+        ''' An aborted upload can no longer be completed.
+        '''
+        resource = self._test_resource()
+        upload = helpers.call_action(
+            's3filestore_initiate_multipart',
+            id=resource['id'], name='data.csv', size=10)
+        helpers.call_action(
+            's3filestore_abort_multipart',
+            id=resource['id'], name='data.csv', upload_id=upload['upload_id'])
+
+        with assert_raises(toolkit.ObjectNotFound):
+            helpers.call_action(
+                's3filestore_complete_multipart',
+                id=resource['id'], name='data.csv', upload_id=upload['upload_id'],
+                parts=[{'part_number': 1, 'etag': '"etag"'}])
+
+    def test_multipart_upload_needs_update_permission(self):
+        ''' Only users who can update the resource can upload to it.
+        '''
+        resource = self._test_resource()
+        user = factories.User()
+        with assert_raises(toolkit.NotAuthorized):
+            helpers.call_auth(
+                's3filestore_initiate_multipart',
+                {'user': user['name'], 'model': model},
+                id=resource['id'], name='data.csv', size=10)
@@ -0,0 +1,181 @@
+# encoding: utf-8
+
+from builtins import object
+import io
+import os
+import shutil
+import tempfile
+import uuid
+
+import mock
+import pytest
+from nose.tools import assert_equal, assert_raises, with_setup
+
+from botocore.exceptions import ClientError
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from ckan.plugins import toolkit
+from ckan.tests import helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore.cli_commands import S3FilestoreCommands
+from ckanext.s3filestore.model import clear_visibility_state, get_blob_key
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+from .test_uploader import _setup_function
+
+
+@with_setup(_setup_function)
+class TestS3FilestoreCommands(object):
+
+    def _upload_test_resource(self, resource_id=None, filename='data.csv'):
+        ''' Uploads a file to a new resource in a new dataset,
+        or to an existing resource.
+        '''
+        file_path = os.path.join(os.path.dirname(__file__), filename)
+        upload = FlaskFileStorage(io.open(file_path, 'rb'))
+        if resource_id:
+            return helpers.call_action(
+                'resource_update', id=resource_id, upload=upload, url=filename)
+        dataset = factories.Dataset(owner_org=self.organisation['id'])
+        return helpers.call_action(
+            'resource_create', package_id=dataset['id'], upload=upload, url=filename)
+
+    def _put_object(self, key):
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'test')
+
+    def _assert_exists(self, key):
+        self.s3.head_object(Bucket=self.bucket_name, Key=key)
+
+    def _assert_not_exists(self, key):
+        with assert_raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+
+    @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+    def test_upload_staged(self):
+        ''' Staged files whose job was lost are sent to S3, unless
+        they were staged too recently.
+        '''
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                    mock.patch('ckanext.s3filestore.tasks.enqueue_task'):
+                resource = self._upload_test_resource()
+                uploader = S3ResourceUploader(resource)
+                key = uploader.get_path(resource['id'])
+
+                S3FilestoreCommands().upload_staged()
+                self._assert_not_exists(key)
+
+                S3FilestoreCommands().upload_staged(minutes=0)
+                self._assert_exists(key)
+                assert not uploader.is_upload_pending(resource['id'])
+                assert not os.path.exists(uploader._get_staged_path(resource['id']))
+        finally:
+            shutil.rmtree(storage_path)
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_update_all_visibility_skips_recorded_state(self):
+        ''' Resources whose recorded visibility matches their dataset
+        are not checked in S3.
+        '''
+        self._upload_test_resource()
+        unrecorded = self._upload_test_resource()
+        clear_visibility_state(unrecorded['id'])
+
+        with mock.patch.object(S3ResourceUploader, 'update_visibility', return_value=True) as update_visibility:
+            S3FilestoreCommands().update_all_visibility()
+        update_visibility.assert_called_once_with(unrecorded['id'], target_acl='public-read')
+
+    def test_prune(self):
+        ''' Objects that are not the current file of their resource are
+        removed, unless it is a dry run; other objects are left alone.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        current_key = uploader.get_path(resource['id'])
+        old_key = uploader.get_path(resource['id'], 'old.csv')
+        unknown_key = uploader.get_path(str(uuid.uuid4()), 'data.csv')
+        self._put_object(old_key)
+        self._put_object(unknown_key)
+
+        S3FilestoreCommands().prune(days=0, dry_run=True)
+        self._assert_exists(old_key)
+
+        S3FilestoreCommands().prune(days=0)
+        self._assert_not_exists(old_key)
+        self._assert_exists(current_key)
+        self._assert_exists(unknown_key)
+
+    @pytest.mark.skipif(not hasattr(toolkit, 'CkanCommand'), reason='paster commands need CKAN < 2.9')
+    def test_paster_prune_dry_run(self):
+        ''' The paster command passes --dry-run on, so nothing is deleted.
+        '''
+        from ckanext.s3filestore.commands import TestConnection
+        resource = self._upload_test_resource()
+        old_key = S3ResourceUploader(resource).get_path(resource['id'], 'old.csv')
+        self._put_object(old_key)
+
+        command = TestConnection('s3')
+        command.options, command.args = command.parser.parse_args(['prune', '0', '--dry-run'])
+        with mock.patch.object(command, '_load_config'):
+            command.command()
+        self._assert_exists(old_key)
+
+    def test_prune_keeps_recent_objects(self):
+        ''' Objects younger than the number of days are kept.
+        '''
+        resource = self._upload_test_resource()
+        old_key = S3ResourceUploader(resource).get_path(resource['id'], 'old.csv')
+        self._put_object(old_key)
+
+        S3FilestoreCommands().prune(days=1)
+        self._assert_exists(old_key)
+
+    @helpers.change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_prune_blobs(self):
+        ''' Non-current references to blobs are removed along with
+        blobs that nothing refers to, unless it is a dry run.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        old_key = uploader.get_path(resource['id'], 'data.csv')
+        old_blob_key = uploader.resolve_key(old_key)
+        resource = self._upload_test_resource(resource['id'], filename='data.txt')
+        current_key = uploader.get_path(resource['id'], 'data.txt')
+        current_blob_key = uploader.resolve_key(current_key)
+        orphan_key = os.path.join(uploader.blob_storage_path, 'or', 'orphan')
+        self._put_object(orphan_key)
+
+        S3FilestoreCommands().prune(days=0, dry_run=True)
+        assert_equal(get_blob_key(old_key), old_blob_key)
+        self._assert_exists(old_blob_key)
+        self._assert_exists(orphan_key)
+
+        S3FilestoreCommands().prune(days=0)
+        assert_equal(get_blob_key(old_key), None)
+        self._assert_not_exists(old_blob_key)
+        self._assert_not_exists(orphan_key)
+        assert_equal(get_blob_key(current_key), current_blob_key)
+        self._assert_exists(current_blob_key)
+
+    @helpers.change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_prune_orphaned_blobs_in_batches(self):
+        ''' Blobs that nothing refers to are deleted in one request,
+        and referenced blobs are kept.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        blob_key = uploader.resolve_key(uploader.get_path(resource['id']))
+        orphan_keys = [os.path.join(uploader.blob_storage_path, 'or', 'orphan{0}'.format(i)) for i in range(3)]
+        for orphan_key in orphan_keys:
+            self._put_object(orphan_key)
+
+        with mock.patch.object(S3ResourceUploader, 'clear_keys', autospec=True,
+                               side_effect=S3ResourceUploader.clear_keys) as clear_keys:
+            S3FilestoreCommands().prune(days=0)
+        clear_keys.assert_called_once_with(mock.ANY, orphan_keys)
+        for orphan_key in orphan_keys:
+            self._assert_not_exists(orphan_key)
+        self._assert_exists(blob_key)
@@ -5,7 +5,11 @@ import io
 import logging
 import os
 import requests
+import shutil
 import six
+import tempfile
+
+import mock
 
 from nose.tools import (with_setup)
 
@@ -243,6 +247,56 @@ class TestS3Controller(object):
             file_response = requests.get(location)
             assert 'date,price' in _get_response_body(file_response)
 
+        @helpers.change_config('ckanext.s3filestore.proxy_downloads', 'true')
+        def test_resource_download_proxy_range(self):
+            u'''A proxied download honours Range and If-Range.'''
+            resource_with_upload = self._upload_resource()
+            url = url_for(
+                u'dataset_resource.download',
+                id=resource_with_upload[u'package_id'],
+                resource_id=resource_with_upload[u'id'],
+            )
+            app = helpers._get_test_app()
+
+            response = app.get(url, headers={'Range': 'bytes=0-3'})
+            assert 206 == _get_status_code(response)
+            assert 'date' == _get_response_body(response)
+            assert response.headers['Content-Range'].startswith('bytes 0-3/')
+            etag = response.headers['ETag']
+
+            response = app.get(url, headers={'Range': 'bytes=5-9', 'If-Range': etag})
+            assert 206 == _get_status_code(response)
+            assert 'price' == _get_response_body(response)
+
+            # a stale validator gets the whole object
+            response = app.get(url, headers={'Range': 'bytes=5-9', 'If-Range': '"stale"'})
+            assert 200 == _get_status_code(response)
+            assert _get_response_body(response).startswith('date,price')
+
+        @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+        def test_staged_resource_download(self):
+            u'''A file waiting to be sent to S3 is served from the filesystem.'''
+            storage_path = tempfile.mkdtemp()
+            try:
+                with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                        mock.patch('ckanext.s3filestore.tasks.enqueue_task'):
+                    resource_with_upload = self._upload_resource()
+                    status_code, location = self._get_expecting_redirect(
+                        url_for(
+                            u'dataset_resource.download',
+                            id=resource_with_upload[u'package_id'],
+                            resource_id=resource_with_upload[u'id'],
+                        )
+                    )
+                    assert '/fs_download/' in location
+
+                    response = helpers._get_test_app().get(location.replace(config.get('ckan.site_url'), ''))
+                    assert 200 == _get_status_code(response)
+                    assert response.headers['Content-Type'].startswith('text/csv')
+                    assert 'date,price' in _get_response_body(response)
+            finally:
+                shutil.rmtree(storage_path)
+
     else:
 
         def _get_expecting_redirect(self, url, app=None):
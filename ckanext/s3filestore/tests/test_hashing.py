@@ -0,0 +1,26 @@
+# encoding: utf-8
+
+from builtins import object
+import hashlib
+import io
+
+from ckanext.s3filestore.hashing import HashingReader
+
+
+class TestHashingReader(object):
+
+    def test_digests(self):
+        ''' Digests and ETags match the data, even if parts are re-read.
+        '''
+        data = b'0123456789' * 5
+        reader = HashingReader(io.BytesIO(data), 20)
+        reader.read(15)
+        # a retried request seeks back and reads again
+        reader.seek(0)
+        reader.read(20)
+        reader.read(-1)
+
+        assert reader.sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+        assert reader.expected_etag(False) == '"{0}"'.format(hashlib.md5(data).hexdigest())
+        part_digests = b''.join(hashlib.md5(data[i:i + 20]).digest() for i in (0, 20, 40))
+        assert reader.expected_etag(True) == '"{0}-3"'.format(hashlib.md5(part_digests).hexdigest())
@@ -0,0 +1,302 @@
+# encoding: utf-8
+
+from builtins import object
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+
+import mock
+import pytest
+
+from ckan.plugins.toolkit import config
+from ckan.tests import helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore.migration import MappedPartReader, MigrationEngine, MigrationJournal, \
+    MigrationProgress, upload_mapped_file
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+class TestMigrationJournal(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        ''' Outcomes recorded by one run are loaded by the next.
+        '''
+        journal = MigrationJournal(self.path)
+        journal.record('one', 'done', size=1)
+        journal.record('two', 'failed', error='Timed out')
+        journal.record('three', 'failed', error='Timed out')
+        journal.record('three', 'done', size=3)
+        journal.close()
+
+        journal = MigrationJournal(self.path)
+        assert journal.done == {'one', 'three'}
+        assert journal.failed == {'two': 'Timed out'}
+
+    def test_partial_line_is_ignored(self):
+        ''' A line left incomplete by an interrupted run is skipped.
+        '''
+        journal = MigrationJournal(self.path)
+        journal.record('one', 'done', size=1)
+        journal.close()
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"resource_id": "tw')
+
+        assert MigrationJournal(self.path).done == {'one'}
+
+
+class TestMigrationProgress(object):
+
+    def test_failed_files_are_counted(self):
+        ''' Failed files count towards the totals, but not the rate.
+        '''
+        progress = MigrationProgress(2, 30, interval=60)
+        progress.add(10)
+        progress.add(20, failed=True)
+        assert (progress.files, progress.bytes, progress.failed) == (2, 30, 1)
+
+        with mock.patch('ckanext.s3filestore.migration.print', create=True) as print_:
+            progress.report()
+        assert '2/2 files (1 failed)' in print_.call_args[0][0]
+
+
+class TestMigrationEngine(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'journal')
+        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
+        uploader = BaseS3Uploader()
+        self.s3 = uploader.get_s3_client()
+        uploader.get_s3_bucket(self.bucket_name)
+        self.names = {}
+        self.paths = {}
+        for size in (10, 20, 30, 40):
+            resource_id = str(uuid.uuid4())
+            path = os.path.join(self.directory, resource_id)
+            with open(path, 'wb') as local_file:
+                local_file.write(b'x' * size)
+            self.names[resource_id] = 'data.csv'
+            self.paths[resource_id] = path
+        self.resource_ids = list(self.names)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _engine(self, **kwargs):
+        return MigrationEngine(self.names, self.paths, journal_path=self.journal_path, **kwargs)
+
+    def _key(self, resource_id):
+        return 'resources/{0}/data.csv'.format(resource_id)
+
+    def test_plan(self):
+        ''' Resources done according to the journal are skipped, and
+        failed ones are retried. Files already in S3 with the same size
+        are left for the workers to compare with the object.
+        '''
+        done, existing, new, failed = self.resource_ids
+        journal = MigrationJournal(self.journal_path)
+        journal.record(done, 'done', size=10)
+        journal.record(failed, 'failed', error='Timed out')
+        journal.close()
+        for resource_id in (existing, failed):
+            with open(self.paths[resource_id], 'rb') as local_file:
+                self.s3.put_object(Bucket=self.bucket_name, Key=self._key(resource_id), Body=local_file.read())
+
+        tasks = self._engine().plan()
+        assert sorted(task.resource_id for task in tasks) == sorted([existing, new, failed])
+        assert [task.resource_id for task in tasks if task.existing_etag is not None] == [existing]
+
+    def test_unchanged_files_are_skipped(self):
+        ''' Files already in S3 with the same content are not uploaded
+        again, whether the object was uploaded in one request or in parts.
+        '''
+        single, multipart = self.resource_ids[:2]
+        with open(self.paths[single], 'rb') as local_file:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self._key(single), Body=local_file.read())
+        with open(self.paths[multipart], 'rb') as local_file:
+            upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self._key(multipart))['UploadId']
+            part = self.s3.upload_part(
+                Bucket=self.bucket_name, Key=self._key(multipart), UploadId=upload_id,
+                PartNumber=1, Body=local_file.read())
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self._key(multipart), UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': part['ETag']}]})
+
+        with mock.patch('ckanext.s3filestore.migration.get_action'):
+            engine = self._engine()
+            # the single PUT predates a lower multipart threshold
+            engine.transfer_config.multipart_threshold = 1
+            engine.run()
+        assert sorted(engine.uploaded_resources) == sorted(self.resource_ids[2:])
+        assert MigrationJournal(self.journal_path).done == set(self.resource_ids)
+
+    def test_plan_uploads_changed_files(self):
+        ''' A file in S3 with the same size but other content is
+        uploaded again.
+        '''
+        changed = self.resource_ids[0]
+        with open(self.paths[changed], 'rb') as local_file:
+            body = local_file.read()
+        self.s3.put_object(Bucket=self.bucket_name, Key=self._key(changed), Body=b'y' * len(body))
+
+        with mock.patch('ckanext.s3filestore.migration.get_action'):
+            engine = self._engine()
+            engine.run()
+        assert changed in engine.uploaded_resources
+
+    def test_run_and_resume(self):
+        ''' A run uploads the files and records them in the journal,
+        so that the next run has nothing left to do.
+        '''
+        with mock.patch('ckanext.s3filestore.migration.get_action') as get_action:
+            engine = self._engine()
+            engine.run()
+        assert sorted(engine.uploaded_resources) == sorted(self.resource_ids)
+        for resource_id in self.resource_ids:
+            obj = self.s3.head_object(Bucket=self.bucket_name, Key=self._key(resource_id))
+            assert obj['ContentLength'] == os.path.getsize(self.paths[resource_id])
+        get_action.assert_any_call('resource_patch')
+
+        assert MigrationJournal(self.journal_path).done == set(self.resource_ids)
+        assert self._engine().plan() == []
+
+    def test_failed_upload_is_retried(self):
+        ''' A failed upload is recorded in the journal and retried
+        by the next run.
+        '''
+        failed = self.resource_ids[0]
+        engine = self._engine()
+        upload = engine._upload
+
+        def _upload(task):
+            if task.resource_id == failed:
+                raise Exception('Timed out')
+            return upload(task)
+
+        with mock.patch('ckanext.s3filestore.migration.get_action'), \
+                mock.patch.object(engine, '_upload', side_effect=_upload):
+            engine.run()
+        assert failed not in engine.uploaded_resources
+        assert MigrationJournal(self.journal_path).failed == {failed: 'Timed out'}
+
+        assert [task.resource_id for task in self._engine().plan()] == [failed]
+
+    def test_failed_update_is_retried(self):
+        ''' If a resource cannot be updated after its file is uploaded,
+        the failure is recorded and the other files are still uploaded.
+        '''
+        failed = self.resource_ids[0]
+
+        def _get_action(name):
+            def _action(context, data_dict):
+                if data_dict['id'] == failed:
+                    raise Exception('Database unavailable')
+            return _action
+
+        with mock.patch('ckanext.s3filestore.migration.get_action', side_effect=_get_action):
+            engine = self._engine()
+            engine.run()
+        assert sorted(engine.uploaded_resources) == sorted(self.resource_ids[1:])
+        assert MigrationJournal(self.journal_path).failed == {failed: 'Database unavailable'}
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_acl_follows_package_privacy(self):
+        ''' With the automatic ACL, the files of a private package
+        are private, and the package is only looked up once.
+        '''
+        helpers.reset_db()
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'], private=True)
+        resources = [factories.Resource(package_id=dataset['id']) for _ in range(2)]
+        paths = dict(zip([resource['id'] for resource in resources], list(self.paths.values())))
+        names = {resource_id: 'data.csv' for resource_id in paths}
+
+        engine = MigrationEngine(names, paths, journal_path=self.journal_path)
+        with mock.patch('ckanext.s3filestore.migration.get_action') as get_action, \
+                mock.patch.object(engine, '_load_package_privacy', wraps=engine._load_package_privacy) \
+                as load_package_privacy:
+            engine.run()
+        load_package_privacy.assert_called_once()
+        get_action.assert_called_with('resource_patch')
+        for resource_id in paths:
+            grants = self.s3.get_object_acl(Bucket=self.bucket_name, Key=self._key(resource_id))['Grants']
+            assert not any(grant['Grantee'].get('URI', '').endswith('AllUsers') for grant in grants)
+
+    def test_dry_run(self):
+        ''' A dry run uploads nothing and records nothing.
+        '''
+        with mock.patch('ckanext.s3filestore.migration.get_action') as get_action:
+            self._engine(dry_run=True).run()
+        get_action.assert_not_called()
+        assert not os.path.exists(self.journal_path)
+        assert len(self._engine().plan()) == len(self.resource_ids)
+
+
+class TestMappedPartReader(object):
+
+    def test_read_part(self):
+        ''' Reads are limited to the part, and can be repeated after seeking.
+        '''
+        reader = MappedPartReader(memoryview(b'0123456789'), 3, 7)
+        assert len(reader) == 4
+        assert bytes(reader.read(3)) == b'345'
+        assert bytes(reader.read()) == b'6'
+        reader.seek(0)
+        assert reader.tell() == 0
+        assert bytes(reader.read()) == b'3456'
+
+
+class TestUploadMappedFile(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.bin')
+        # three parts, the last one short
+        self.data = os.urandom(1024 * 1024) * 11
+        with open(self.path, 'wb') as local_file:
+            local_file.write(self.data)
+        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
+        uploader = BaseS3Uploader()
+        self.s3 = uploader.get_s3_client()
+        uploader.get_s3_bucket(self.bucket_name)
+        self.key = 'resources/{0}/data.bin'.format(uuid.uuid4())
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_upload(self):
+        ''' The parts are sent from the mapping and assembled in order,
+        and the ETag and digest returned match the object.
+        '''
+        with open(self.path, 'rb') as upload_file:
+            etag, sha256 = upload_mapped_file(
+                self.s3, self.bucket_name, self.key, upload_file, 5 * 1024 * 1024,
+                extra_args={'ContentType': 'application/octet-stream'}, concurrency=2)
+
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)
+        assert obj['Body'].read() == self.data
+        assert obj['ETag'] == etag
+        assert etag.endswith('-3"')
+        assert sha256 == hashlib.sha256(self.data).hexdigest()
+
+    def test_failed_upload_is_aborted(self):
+        ''' If a part fails, the multipart upload is aborted.
+        '''
+        with open(self.path, 'rb') as upload_file, \
+                mock.patch.object(self.s3, 'upload_part', side_effect=Exception('Timed out')):
+            with pytest.raises(Exception, match='Timed out'):
+                upload_mapped_file(self.s3, self.bucket_name, self.key, upload_file, 5 * 1024 * 1024)
+
+        uploads = self.s3.list_multipart_uploads(Bucket=self.bucket_name, Prefix=self.key)
+        assert not uploads.get('Uploads')
@@ -3,11 +3,14 @@
 from builtins import object
 import mock
 from parameterized import parameterized
+import pytest
 
 import ckantoolkit as toolkit
 
 from ckanext.s3filestore import tasks
 from ckanext.s3filestore.plugin import S3FileStorePlugin
+from ckanext.s3filestore.redis_helper import LockTimeout, RedisHelper
+from ckanext.s3filestore.uploader import S3FileStoreException
 
 
 class TestS3Plugin(object):
@@ -47,6 +50,71 @@ class TestS3Plugin(object):
                 mock_uploader.update_visibility.assert_called_once_with(
                     'test-resource', target_acl=expected_acl)
 
+    def test_resource_visibility_update_isolates_failures(self):
+        ''' A failure for one resource does not stop the others
+        from being updated, but is reported at the end.
+        '''
+        pkg_dict = {'id': 'test-package',
+                    'resources': [{'id': 'resource-{}'.format(i)} for i in range(10)]}
+
+        def _update_visibility(resource_id, target_acl=None):
+            if resource_id == 'resource-3':
+                raise Exception("Simulated failure")
+            return resource_id != 'resource-5'
+
+        mock_uploader = mock.MagicMock()
+        mock_uploader.update_visibility.side_effect = _update_visibility
+        with mock.patch('ckanext.s3filestore.plugin.get_resource_uploader') as mock_get_uploader, \
+                mock.patch.object(self.plugin, 'visibility_update_concurrency', 4):
+            mock_get_uploader.return_value = mock_uploader
+            with pytest.raises(S3FileStoreException) as excinfo:
+                self.plugin.after_update_resource_list_update('private', 'test-package', pkg_dict)
+
+        assert 'resource-3' in str(excinfo.value)
+        assert mock_uploader.update_visibility.call_count == 10
+        mock_uploader.update_visibility.assert_any_call('resource-9', target_acl='private')
+
+    def test_enqueueing_pending_visibility_update(self):
+        ''' Only one visibility update job is queued per package at a time.
+        '''
+        RedisHelper().delete('abcdef' + tasks.VISIBILITY_JOB_PENDING)
+        with mock.patch.object(self.plugin, 'enqueue_resource_visibility_update_job') as enqueue:
+            self.plugin.enqueue_pending_visibility_update_job('private', 'abcdef')
+            self.plugin.enqueue_pending_visibility_update_job('public-read', 'abcdef')
+        enqueue.assert_called_once_with('private', 'abcdef')
+
+    def test_visibility_update_job(self):
+        ''' The job applies the privacy of the package when it runs,
+        while holding the package's lock, and lets a later change
+        queue another job.
+        '''
+        redis = RedisHelper()
+        pending_key = 'abcdef' + tasks.VISIBILITY_JOB_PENDING
+        redis.delete(pending_key)
+        with mock.patch.object(self.plugin, 'enqueue_resource_visibility_update_job') as enqueue:
+            self.plugin.enqueue_pending_visibility_update_job('public-read', 'abcdef')
+        assert redis.get(pending_key) == 'public-read'
+
+        def _update(visibility_level, pkg_id, pkg_dict):
+            # another job for the package has to wait
+            with pytest.raises(LockTimeout):
+                with redis.lock(pkg_id + tasks.VISIBILITY_UPDATE_LOCK, 10, blocking_timeout=0.1):
+                    pass
+
+        mock_plugin = mock.MagicMock()
+        mock_plugin.after_update_resource_list_update.side_effect = _update
+        pkg_dict = {'id': 'abcdef', 'private': True}
+        with mock.patch('ckanext.s3filestore.tasks.p.get_plugin', return_value=mock_plugin), \
+                mock.patch('ckanext.s3filestore.tasks.toolkit.get_action',
+                           return_value=lambda context, data_dict: pkg_dict):
+            tasks.s3_afterUpdatePackage(visibility_level='public-read', pkg_id='abcdef')
+        mock_plugin.after_update_resource_list_update.assert_called_once_with('private', 'abcdef', pkg_dict)
+        assert redis.get(pending_key) is None
+
+        with mock.patch.object(self.plugin, 'enqueue_resource_visibility_update_job') as enqueue:
+            self.plugin.enqueue_pending_visibility_update_job('public-read', 'abcdef')
+        enqueue.assert_called_once_with('public-read', 'abcdef')
+
     def test_enqueueing_visibility_update(self):
         ''' Asynchronous job is created to update object visibility.
         '''
@@ -0,0 +1,77 @@
+# encoding: utf-8
+
+from builtins import object
+
+from ckan.tests import helpers
+
+from ckanext.s3filestore import redis_helper
+from ckanext.s3filestore.redis_helper import RedisHelper
+
+
+class TestRedisHelper(object):
+
+    def setup(self):
+        self.redis = RedisHelper()
+        self.redis.delete_many(['test/a', 'test/b', 'test/c'])
+
+    def test_put_and_get_many(self):
+        ''' Multiple values can be stored and retrieved together.
+        '''
+        self.redis.put_many({'test/a': 'one', 'test/b': 'two'}, expiry=60)
+        assert self.redis.get_many(['test/a', 'test/c', 'test/b']) == ['one', None, 'two']
+
+    def test_put_many_without_expiry(self):
+        ''' Values without an expiry are not stored.
+        '''
+        self.redis.put_many({'test/a': 'one'})
+        assert self.redis.get('test/a') is None
+
+    def test_delete_many(self):
+        ''' Multiple values can be deleted together.
+        '''
+        self.redis.put_many({'test/a': 'one', 'test/b': 'two', 'test/c': 'three'}, expiry=60)
+        self.redis.delete_many(['test/a', 'test/b'])
+        assert self.redis.get_many(['test/a', 'test/b', 'test/c']) == [None, None, 'three']
+
+    def test_batch(self):
+        ''' Batched operations are applied when the batch exits.
+        '''
+        self.redis.put('test/a', 'one', expiry=60)
+        with self.redis.batch() as batch:
+            batch.delete('test/a')
+            batch.put('test/b', 'two', expiry=60)
+            assert self.redis.get('test/a') == 'one'
+        assert self.redis.get_many(['test/a', 'test/b']) == [None, 'two']
+
+    @helpers.change_config('ckanext.s3filestore.local_cache_size', '10')
+    def test_local_cache(self):
+        ''' Values are served from the local cache until changed
+        through the helper.
+        '''
+        assert redis_helper._get_local_cache().ready.wait(5)
+        self.redis.put('test/a', 'one', expiry=60)
+        assert self.redis.get('test/a') == 'one'
+
+        # bypass the helper, so the local copy is not invalidated
+        redis_helper._get_connection().set(redis_helper.REDIS_PREFIX + 'test/a', 'two')
+        assert self.redis.get('test/a') == 'one'
+
+        self.redis.delete('test/a')
+        assert self.redis.get('test/a') is None
+
+    def test_local_cache_bounds(self):
+        ''' The local cache evicts the least recently used entries,
+        and never keeps values longer than requested.
+        '''
+        local_cache = redis_helper.LocalCache(2, 60)
+        local_cache.ready.set()
+        local_cache.set('a', 'one')
+        local_cache.set('b', 'two')
+        local_cache.get('a')
+        local_cache.set('c', 'three')
+        assert local_cache.get('a') == 'one'
+        assert local_cache.get('b') is None
+        assert local_cache.get('c') == 'three'
+
+        local_cache.set('d', 'four', ttl=0)
+        assert local_cache.get('d') is None
@@ -2,9 +2,15 @@
 
 from builtins import object
 import datetime
+import hashlib
 import io
+import json
 import os
+import shutil
 import six
+import tempfile
+import threading
+import uuid
 
 import mock
 from nose.tools import (assert_equal,
@@ -19,13 +25,18 @@ from botocore.exceptions import ClientError
 
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
+from ckan import model
 from ckan.plugins import toolkit
 from ckan.plugins.toolkit import config
 from ckan.tests import helpers
 import ckan.tests.factories as factories
 
+from ckanext.s3filestore import tasks
+from ckanext.s3filestore.model import clear_visibility_state, get_visibility_state
 from ckanext.s3filestore.uploader import (
-    BaseS3Uploader, S3Uploader, S3ResourceUploader, _is_presigned_url)
+    BaseS3Uploader, S3Uploader, S3ResourceUploader, _is_presigned_url,
+    BLOB_CACHE_PATH, METADATA_CACHE_PATH, TAG_VISIBILITY_CACHE_PATH, URL_HITS_KEY,
+    VISIBILITY_CACHE_PATH, VISIBILITY_TAG)
 
 from . import _get_status_code
 
@@ -83,6 +94,29 @@ class TestS3Uploader(object):
         clean_dict = uploader.as_clean_dict(date_dict)
         assert_equal(clean_dict['key'], '1970-01-02T03:04:05.000006')
 
+    def test_client_is_pooled(self):
+        '''S3 clients are shared between uploaders in the same process'''
+        client = S3Uploader('').get_s3_client()
+        assert_true(client is BaseS3Uploader().get_s3_client())
+
+        # a forked process must not reuse the parent's connections
+        with mock.patch('ckanext.s3filestore.client_pool.os.getpid', return_value=-1):
+            assert_false(client is BaseS3Uploader().get_s3_client())
+
+    def test_clear_keys(self):
+        '''S3Uploader deletes multiple keys in batches'''
+        uploader = S3Uploader('')
+        keys = ['my-path/storage/uploads/batch/file-{}.txt'.format(i) for i in range(5)]
+        for key in keys:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'test')
+
+        with mock.patch('ckanext.s3filestore.uploader.DELETE_BATCH_SIZE', 2):
+            uploader.clear_keys(keys)
+
+        for key in keys:
+            with assert_raises(ClientError):
+                self.s3.head_object(Bucket=self.bucket_name, Key=key)
+
     def test_uploader_storage_path(self):
         '''S3Uploader get_storage_path returns as expected'''
         returned_path = S3Uploader.get_storage_path('myfiles')
@@ -221,6 +255,262 @@ class TestS3ResourceUploader(object):
         data = obj['Body'].read()
         assert_equal(data, io.open(file_path, 'rb').read())
 
+        # the checksum is computed while uploading
+        assert_equal(resource['hash'], hashlib.sha256(data).hexdigest())
+
+    def test_package_privacy_lookup(self):
+        ''' The privacy of a resource's package is read from the database.
+        '''
+        private_resource = self._upload_test_resource(self._test_dataset(private=True))
+        uploader = S3ResourceUploader(private_resource)
+        assert_true(uploader._is_package_private(private_resource['id']))
+
+        helpers.call_action('package_patch', id=private_resource['package_id'], private=False)
+        assert_false(uploader._is_package_private(private_resource['id']))
+        with assert_raises(toolkit.ObjectNotFound):
+            uploader._is_package_private('no-such-resource')
+
+    @helpers.change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_content_addressed_upload(self):
+        ''' Identical files share one blob, which is deleted
+        with its last reference.
+        '''
+        dataset = self._test_dataset()
+        # unique content, so that no blob is left from another run
+        body = 'date,price\n2001-01-01,{0}\n'.format(uuid.uuid4()).encode('utf-8')
+        resources = [helpers.call_action(
+            'resource_create',
+            package_id=dataset['id'],
+            upload=FlaskFileStorage(six.BytesIO(body), 'data.csv'),
+            url='data.csv') for i in range(2)]
+        uploader = S3ResourceUploader(resources[0])
+        first_key, second_key = [uploader.get_path(resource['id']) for resource in resources]
+
+        blob_key = uploader.resolve_key(first_key)
+        assert_equal(blob_key, uploader.get_blob_path(hashlib.sha256(body).hexdigest()))
+        assert_equal(uploader.resolve_key(second_key), blob_key)
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=blob_key)
+        assert_equal(obj['Body'].read(), body)
+        with assert_raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=first_key)
+        assert_true(_is_presigned_url(uploader.get_signed_url_to_key(first_key)))
+
+        uploader.clear_key(first_key)
+        self.s3.head_object(Bucket=self.bucket_name, Key=blob_key)
+        uploader.clear_key(second_key)
+        with assert_raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=blob_key)
+
+    @helpers.change_config('ckanext.s3filestore.content_addressed', 'true')
+    def test_blob_lookup_error_is_not_cached(self):
+        ''' A failure to read the blob reference is raised, and the
+        reference is found once the database is available again.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        blob_key = uploader.resolve_key(key)
+        uploader.redis.delete(key + BLOB_CACHE_PATH)
+
+        with mock.patch('ckanext.s3filestore.uploader.get_blob_key', side_effect=Exception('Database error')):
+            with assert_raises(Exception):
+                uploader.resolve_key(key)
+        assert_equal(uploader.resolve_key(key), blob_key)
+
+    def test_upload_is_indexed_without_head(self):
+        ''' The metadata of an uploaded object is indexed from the upload
+        itself, and matches what S3 reports.
+        '''
+        client = BaseS3Uploader().get_s3_client()
+        with mock.patch.object(client, 'head_object', wraps=client.head_object) as head_object:
+            resource = self._upload_test_resource()
+        head_object.assert_not_called()
+
+        uploader = S3ResourceUploader(resource)
+        key = _get_object_key(resource)
+        indexed = json.loads(uploader.redis.get(key + METADATA_CACHE_PATH))
+        obj = self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        assert_equal(indexed, {'ContentType': obj['ContentType'],
+                               'ContentLength': obj['ContentLength'],
+                               'ETag': obj['ETag'],
+                               'ContentDisposition': obj['ContentDisposition'],
+                               'Metadata': obj['Metadata']})
+
+    def test_kms_encrypted_upload_is_indexed_from_head(self):
+        ''' If the bucket encrypts objects with KMS by default, the
+        ETag of an uploaded object is read from S3, as it cannot be
+        computed from the file.
+        '''
+        client = BaseS3Uploader().get_s3_client()
+        encryption = {'ServerSideEncryptionConfiguration': {'Rules': [
+            {'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'aws:kms'}}]}}
+        with mock.patch.dict('ckanext.s3filestore.uploader._bucket_kms_encryption', clear=True), \
+                mock.patch.object(client, 'get_bucket_encryption', return_value=encryption), \
+                mock.patch.object(client, 'head_object', wraps=client.head_object) as head_object:
+            resource = self._upload_test_resource()
+        head_object.assert_called_once_with(Bucket=self.bucket_name, Key=_get_object_key(resource))
+
+    def test_unchanged_upload_is_skipped(self):
+        ''' Uploading the same file again does not send it to S3,
+        but brings the metadata of the object up to date.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        self.s3.copy_object(
+            Bucket=self.bucket_name, Key=key, CopySource={'Bucket': self.bucket_name, 'Key': key},
+            MetadataDirective='REPLACE', ContentType='text/csv', Metadata={})
+        uploader = S3ResourceUploader(resource)
+        uploader.redis.delete(key + METADATA_CACHE_PATH)
+        uploader.get_object_metadata(key)
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        with mock.patch.object(S3ResourceUploader, 'index_uploaded_object') as index_uploaded_object:
+            updated = helpers.call_action(
+                'resource_update',
+                id=resource['id'],
+                upload=FlaskFileStorage(io.open(file_path, 'rb')),
+                url='data.csv')
+        index_uploaded_object.assert_not_called()
+        assert_equal(updated['hash'], resource['hash'])
+        assert_in('uploaded_by', self.s3.head_object(Bucket=self.bucket_name, Key=key)['Metadata'])
+
+    def test_unchanged_object_is_not_copied(self):
+        ''' Uploading the same file again with the same metadata
+        neither sends it to S3 nor copies the object.
+        '''
+        resource = self._upload_test_resource()
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        with mock.patch.object(S3ResourceUploader, 'index_uploaded_object') as index_uploaded_object, \
+                mock.patch.object(S3ResourceUploader, '_replace_object_metadata') as replace_object_metadata:
+            helpers.call_action(
+                'resource_update',
+                id=resource['id'],
+                upload=FlaskFileStorage(io.open(file_path, 'rb')),
+                url='data.csv')
+        index_uploaded_object.assert_not_called()
+        replace_object_metadata.assert_not_called()
+
+    def test_unindexed_upload_is_sent(self):
+        ''' An object missing from the metadata index is uploaded
+        again, without checking it with a HEAD request first.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        uploader.redis.delete(_get_object_key(resource) + METADATA_CACHE_PATH)
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        with mock.patch.object(S3ResourceUploader, 'get_object_metadata') as get_object_metadata, \
+                mock.patch.object(S3ResourceUploader, 'index_uploaded_object') as index_uploaded_object:
+            helpers.call_action(
+                'resource_update',
+                id=resource['id'],
+                upload=FlaskFileStorage(io.open(file_path, 'rb')),
+                url='data.csv')
+        get_object_metadata.assert_not_called()
+        index_uploaded_object.assert_called_once()
+
+    @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+    def test_async_resource_upload(self):
+        ''' Asynchronous uploads are staged locally until the job
+        has sent them to S3.
+        '''
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                    mock.patch('ckanext.s3filestore.tasks.enqueue_task') as enqueue_task:
+                resource = self._upload_test_resource()
+                key = _get_object_key(resource)
+                uploader = S3ResourceUploader(resource)
+                assert_true(uploader.is_upload_pending(resource['id']))
+                with assert_raises(ClientError):
+                    self.s3.head_object(Bucket=self.bucket_name, Key=key)
+
+                job_kwargs = enqueue_task.call_args[0][2]
+                tasks.s3_uploadResource(**job_kwargs)
+
+                self.s3.head_object(Bucket=self.bucket_name, Key=key)
+                assert_false(uploader.is_upload_pending(resource['id']))
+                assert_false(os.path.exists(uploader._get_staged_path(resource['id'])))
+        finally:
+            shutil.rmtree(storage_path)
+
+    @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+    def test_async_upload_job_sees_committed_resource(self):
+        ''' The upload job is queued once the resource has been saved,
+        so that a worker picking it up straight away finds the new file.
+        '''
+        def _run_job_in_worker(fn, title, kwargs):
+            # a worker has its own database session
+            def _run():
+                try:
+                    fn(**kwargs)
+                finally:
+                    model.Session.remove()
+            worker = threading.Thread(target=_run)
+            worker.start()
+            worker.join()
+
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                    mock.patch('ckanext.s3filestore.tasks.enqueue_task', side_effect=_run_job_in_worker):
+                resource = self._upload_test_resource()
+                uploader = S3ResourceUploader(resource)
+                self.s3.head_object(Bucket=self.bucket_name, Key=_get_object_key(resource))
+                assert_false(uploader.is_upload_pending(resource['id']))
+
+                file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+                helpers.call_action(
+                    'resource_update',
+                    id=resource['id'],
+                    upload=FlaskFileStorage(io.open(file_path, 'rb'), 'renamed.csv'),
+                    url='renamed.csv')
+                self.s3.head_object(Bucket=self.bucket_name, Key=uploader.get_path(resource['id'], 'renamed.csv'))
+                assert_false(uploader.is_upload_pending(resource['id']))
+                assert_false(os.path.exists(uploader._get_staged_path(resource['id'])))
+        finally:
+            shutil.rmtree(storage_path)
+
+    @helpers.change_config('ckanext.s3filestore.async_upload', 'true')
+    def test_async_upload_of_replaced_file_is_discarded(self):
+        ''' If the staged file is no longer the resource's file when
+        the job runs, it is discarded without being sent to S3.
+        '''
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch('ckan.lib.uploader.get_storage_path', return_value=storage_path), \
+                    mock.patch('ckanext.s3filestore.tasks.enqueue_task') as enqueue_task:
+                resource = self._upload_test_resource()
+                key = _get_object_key(resource)
+                uploader = S3ResourceUploader(resource)
+                job_kwargs = dict(enqueue_task.call_args[0][2], filename='renamed.csv')
+
+                tasks.s3_uploadResource(**job_kwargs)
+
+                with assert_raises(ClientError):
+                    self.s3.head_object(Bucket=self.bucket_name, Key=key)
+                assert_false(uploader.is_upload_pending(resource['id']))
+                assert_false(os.path.exists(uploader._get_staged_path(resource['id'])))
+        finally:
+            shutil.rmtree(storage_path)
+
+    @helpers.change_config('ckanext.s3filestore.multipart_threshold', str(5 * 1024 * 1024))
+    @helpers.change_config('ckanext.s3filestore.multipart_chunksize', str(5 * 1024 * 1024))
+    def test_resource_multipart_upload(self):
+        '''Test that large files are uploaded in parts, keeping headers'''
+        dataset = self._test_dataset()
+        body = b'date,price\n' + b'2001-01-01,1\n' * (11 * 1024 * 1024 // 13)
+        resource = helpers.call_action(
+            'resource_create',
+            package_id=dataset['id'],
+            upload=FlaskFileStorage(six.BytesIO(body), 'data.csv'),
+            url='data.csv')
+
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=_get_object_key(resource))
+        assert_true(obj['ETag'].endswith('-3"'), "Expected a 3-part upload but ETag was {}".format(obj['ETag']))
+        assert_equal(obj['ContentType'], 'text/csv')
+        assert_equal(obj['ContentDisposition'], 'attachment; filename=data.csv')
+        assert_equal(obj['Metadata']['package_id'], dataset['id'])
+        assert_equal(obj['Body'].read(), body)
+
     def test_package_update(self):
         ''' Test a typical package_update API call.
         '''
@@ -270,6 +560,25 @@ class TestS3ResourceUploader(object):
         _assert_public(resource, url, uploader)
         assert_in('ETag=', url)
 
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_resource_url_uses_metadata_index(self):
+        ''' Tests that URLs for uploaded objects are generated
+        from the metadata index, without asking S3.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        client = uploader.get_s3_client()
+
+        with mock.patch.object(client, 'head_object') as mock_head_object, \
+                mock.patch.object(client, 'get_object_acl') as mock_get_object_acl:
+            url = uploader.get_signed_url_to_key(key)
+            mock_head_object.assert_not_called()
+            mock_get_object_acl.assert_not_called()
+
+        _assert_public(resource, url, uploader)
+        assert_in('ETag=', url)
+
     @helpers.change_config('ckanext.s3filestore.acl', 'auto')
     def test_resource_url_signed_for_private_dataset(self):
         ''' Tests that resources in private datasets generate presigned URLs.
@@ -376,6 +685,161 @@ class TestS3ResourceUploader(object):
         url = uploader.get_signed_url_to_key(key)
         assert_false(_is_presigned_url(url), "Expected [{}] to use public URL but was {}".format(key, url))
 
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    @helpers.change_config('ckanext.s3filestore.non_current_acl', 'public-read')
+    def test_visibility_update_across_listing_pages(self):
+        ''' Tests that objects on every page of the bucket listing
+        are updated, not only the first.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        old_keys = [uploader.get_path(resource['id'], 'old-{}.csv'.format(i)) for i in range(3)]
+        for key in old_keys:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'old', ACL='private')
+        # the objects were added behind the uploader's back
+        uploader.redis.delete(uploader.get_path(resource['id']) + VISIBILITY_CACHE_PATH + '/all')
+        clear_visibility_state(resource['id'])
+
+        original_iter = uploader._iter_resource_objects
+
+        def _single_object_pages(client, id):
+            for page in original_iter(client, id):
+                for upload in page:
+                    yield [upload]
+
+        with mock.patch.object(uploader, '_iter_resource_objects', side_effect=_single_object_pages):
+            assert_true(uploader.update_visibility(resource['id'], target_acl='public-read'))
+
+        for key in old_keys:
+            url = uploader.get_signed_url_to_key(key)
+            assert_false(_is_presigned_url(url), "Expected [{}] to use public URL but was {}".format(key, url))
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_visibility_update_uses_recorded_state(self):
+        ''' Tests that S3 is not consulted when the recorded visibility
+        state of a resource already matches, even if the cache is empty.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        assert_equal(get_visibility_state(resource['id']), (key, 'public-read'))
+
+        uploader.redis.delete(key + VISIBILITY_CACHE_PATH + '/all')
+        with mock.patch.object(uploader, '_iter_resource_objects') as iter_resource_objects:
+            assert_false(uploader.update_visibility(resource['id'], target_acl='public-read'))
+            iter_resource_objects.assert_not_called()
+
+        assert_true(uploader.update_visibility(resource['id'], target_acl='private'))
+        assert_equal(get_visibility_state(resource['id']), (key, 'private'))
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    @helpers.change_config('ckanext.s3filestore.delete_non_current_days', '0')
+    def test_reupload_prunes_non_current_files(self):
+        ''' Uploading the current file again checks every object of the
+        resource, even if its visibility is recorded, so that
+        non-current files are pruned.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        old_key = uploader.get_path(resource['id'], 'old.csv')
+        self.s3.put_object(Bucket=self.bucket_name, Key=old_key, Body=b'old')
+        assert_equal(get_visibility_state(resource['id']), (key, 'public-read'))
+
+        file_path = os.path.join(os.path.dirname(__file__), 'data.txt')
+        helpers.call_action(
+            'resource_update',
+            id=resource['id'],
+            upload=FlaskFileStorage(io.open(file_path, 'rb')),
+            url='data.csv')
+        with assert_raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=old_key)
+        self.s3.head_object(Bucket=self.bucket_name, Key=key)
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    @helpers.change_config('ckanext.s3filestore.visibility_mode', 'tag')
+    def test_tag_visibility_mode(self):
+        ''' Tests that visibility can be applied with object tags
+        instead of ACLs.
+        '''
+        dataset = self._test_dataset(private=True)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        assert_in({'Key': VISIBILITY_TAG, 'Value': 'private'},
+                  self.s3.get_object_tagging(Bucket=self.bucket_name, Key=key)['TagSet'])
+
+        with mock.patch.object(uploader.get_s3_client(), 'put_object_acl') as put_object_acl:
+            assert_true(uploader.update_visibility(resource['id'], target_acl='public-read'))
+            put_object_acl.assert_not_called()
+        assert_in({'Key': VISIBILITY_TAG, 'Value': 'public-read'},
+                  self.s3.get_object_tagging(Bucket=self.bucket_name, Key=key)['TagSet'])
+
+        uploader.redis.delete(key + TAG_VISIBILITY_CACHE_PATH)
+        assert_true(uploader.is_key_public(key))
+        assert_equal(uploader.get_bucket_policy_statement()['Condition'],
+                     {'StringEquals': {'s3:ExistingObjectTag/' + VISIBILITY_TAG: 'public-read'}})
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    @helpers.change_config('ckanext.s3filestore.visibility_mode', 'tag')
+    @helpers.change_config('ckanext.s3filestore.tag_mode_reset_acl', 'true')
+    def test_tag_visibility_mode_resets_acl(self):
+        ''' Tests that making an object private in tag mode keeps its
+        other tags, and removes a public ACL left from ACL mode.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        self.s3.put_object_acl(Bucket=self.bucket_name, Key=key, ACL='public-read')
+        self.s3.put_object_tagging(Bucket=self.bucket_name, Key=key, Tagging={'TagSet': [
+            {'Key': 'owner', 'Value': 'test'},
+            {'Key': VISIBILITY_TAG, 'Value': 'public-read'}]})
+
+        assert_true(uploader.update_visibility(resource['id'], target_acl='private'))
+        tags = self.s3.get_object_tagging(Bucket=self.bucket_name, Key=key)['TagSet']
+        assert_in({'Key': 'owner', 'Value': 'test'}, tags)
+        assert_in({'Key': VISIBILITY_TAG, 'Value': 'private'}, tags)
+        uploader.redis.delete(key + TAG_VISIBILITY_CACHE_PATH)
+        assert_false(uploader.is_key_public(key))
+
+    @helpers.change_config('ckanext.s3filestore.prewarm.top_keys', '10')
+    def test_prewarm_signed_urls(self):
+        ''' Tests that URLs of the most requested keys are regenerated
+        when they are missing or close to expiry.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        uploader.redis.delete(URL_HITS_KEY)
+        uploader.redis.increment_scores(URL_HITS_KEY, {key: 5})
+        uploader.redis.delete(key)
+
+        assert_equal(uploader.prewarm_signed_urls(), 1)
+        assert_true(uploader.redis.get(key))
+        # the new URL is far from expiry
+        assert_equal(uploader.prewarm_signed_urls(), 0)
+
+    @helpers.change_config('ckanext.s3filestore.prewarm.top_keys', '1')
+    def test_url_hits_are_capped(self):
+        ''' Tests that requesting URLs counts hits per key, and only
+        the most requested keys are kept.
+        '''
+        resource = self._upload_test_resource()
+        uploader = S3ResourceUploader(resource)
+        key = uploader.get_path(resource['id'])
+        uploader.redis.delete(URL_HITS_KEY)
+        uploader.get_signed_url_to_key(key)
+        uploader.redis.increment_scores(
+            URL_HITS_KEY, dict(('other-%d' % i, 1) for i in range(20)))
+
+        uploader.get_signed_url_to_key(key)
+        assert_equal(uploader.redis.get_top_members(URL_HITS_KEY, 100)[0], key)
+        assert_equal(len(uploader.redis.get_top_members(URL_HITS_KEY, 100)), 10)
+
     @helpers.change_config('ckanext.s3filestore.acl', 'auto')
     @helpers.change_config('ckanext.s3filestore.non_current_acl', 'auto')
     def test_non_current_objects_match_auto_acl(self):
@@ -4,28 +4,42 @@ from builtins import str
 from builtins import object
 import datetime
 import errno
+import json
 import logging
 import mimetypes
 import magic
 import os
 import pytz as timezone
 import re
+import shutil
 import six
+import threading
+import uuid
 
 
-import boto3
-from botocore.client import Config
+from boto3.s3.transfer import TransferConfig
+from s3transfer.utils import ChunksizeAdjuster
 from botocore.exceptions import ClientError
 import ckantoolkit as toolkit
+import flask
 import ckan.lib.helpers as h
 from six.moves.urllib.parse import urlencode
 
+from sqlalchemy import event
+
 from ckan.lib import munge
 from ckan.lib.uploader import ResourceUpload as DefaultResourceUpload, Upload as DefaultUpload
 from ckan import model
 from ckan.plugins.toolkit import g
 
+from ckanext.s3filestore.hashing import HashingReader
+from ckanext.s3filestore.client_pool import get_botocore_config, get_pool, \
+    get_s3_session  # noqa: F401
+from ckanext.s3filestore.model import clear_visibility_state, get_visibility_state, set_visibility_state, \
+    get_blob_key, remove_blob_reference, set_blob_reference
 from ckanext.s3filestore.redis_helper import RedisHelper
+from ckanext.s3filestore import tasks
+from ckanext.s3filestore.visibility import get_executor
 
 if toolkit.check_ckan_version(min_version='2.8'):
     from ckan.lib.uploader import ALLOWED_UPLOAD_TYPES
@@ -46,8 +60,43 @@ _max_image_size = None
 
 URL_HOST = re.compile('^https?://[^/]*/')
 VISIBILITY_CACHE_PATH = '/visibility'
+TAG_VISIBILITY_CACHE_PATH = '/visibility-tag'
+METADATA_CACHE_PATH = '/metadata'
+BLOB_CACHE_PATH = '/blob'
+# serialises adding and removing references to a blob
+BLOB_LOCK = '/blob_lock'
+BLOB_LOCK_TIMEOUT = 60 * 60
+# how long a request waits for another to finish with a blob
+BLOB_LOCK_WAIT = 30
+# the most keys that S3 accepts in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+INDEXED_METADATA_FIELDS = ('ContentType', 'ContentLength', 'ETag', 'ContentDisposition', 'Metadata')
+# user metadata that changes with every update of the package,
+# and is not worth copying an unchanged object to bring up to date
+VOLATILE_METADATA_FIELDS = ('package_metadata_modified', 'package_revision_id')
 PUBLIC_ACL = 'public-read'
 PRIVATE_ACL = 'private'
+# visibility is applied either with object ACLs, or with an object tag
+# that the bucket policy uses to grant public read access
+VISIBILITY_MODES = ('acl', 'tag')
+VISIBILITY_TAG = 'ckanext-s3filestore-visibility'
+BUCKET_POLICY_SID = 'CkanS3FilestorePublicRead'
+MULTIPART_DEFAULT_SIZE = str(8 * 1024 * 1024)
+# sorted set of object keys, scored by recent URL requests
+URL_HITS_KEY = 'url_hits'
+# how many keys are tracked, as a multiple of the keys to prewarm
+URL_HITS_TRACKED_FACTOR = 10
+# marks a resource whose file is staged locally, waiting to be sent to S3
+UPLOAD_PENDING_PATH = '/upload_pending'
+UPLOAD_PENDING_EXPIRY = 7 * 24 * 60 * 60
+
+# libmagic loads its database when created, and is not thread-safe
+_mime_detector = None
+_mime_detector_lock = threading.Lock()
+
+# whether each bucket encrypts new objects with KMS by default
+_bucket_kms_encryption = {}
+_bucket_kms_encryption_lock = threading.Lock()
 
 
 def _get_underlying_file(wrapper):
@@ -77,6 +126,99 @@ def ensure_ascii(text):
     return text.encode('ascii', 'xmlcharrefreplace').decode()
 
 
+def _any_result(futures):
+    ''' Wait for the futures and return True if any result is truthy.
+    Errors are re-raised.
+    '''
+    return any([future.result() for future in futures])
+
+
+def _on_transaction_end(on_commit, on_rollback):
+    ''' Call `on_commit` once the current database transaction is
+    committed, or `on_rollback` if it is rolled back instead.
+    '''
+    session = model.Session()
+    ended = []
+
+    def _after_commit(*args):
+        if not ended:
+            ended.append(True)
+            on_commit()
+
+    def _after_rollback(*args):
+        if not ended:
+            ended.append(True)
+            on_rollback()
+
+    event.listen(session, 'after_commit', _after_commit, once=True)
+    event.listen(session, 'after_soft_rollback', _after_rollback, once=True)
+
+
+def _get_cache_paths(filepath):
+    ''' List the cache entries that describe an S3 object key.
+    '''
+    return [filepath, filepath + VISIBILITY_CACHE_PATH,
+            filepath + TAG_VISIBILITY_CACHE_PATH, filepath + METADATA_CACHE_PATH,
+            filepath + BLOB_CACHE_PATH]
+
+
+def _detect_mimetype(data):
+    ''' Guess the MIME type of a file from its first bytes,
+    using a detector shared by the whole process.
+    '''
+    global _mime_detector
+    with _mime_detector_lock:
+        if _mime_detector is None:
+            _mime_detector = magic.Magic(mime=True)
+        return _mime_detector.from_buffer(data)
+
+
+def _get_request_packages():
+    ''' Return the packages looked up during the current request,
+    by id, or None outside a Flask request.
+    '''
+    if not flask.has_request_context():
+        return None
+    packages = getattr(flask.g, '_s3filestore_packages', None)
+    if packages is None:
+        packages = flask.g._s3filestore_packages = {}
+    return packages
+
+
+def forget_package(package_id):
+    ''' Drop a package looked up earlier in the request, eg once it
+    has been updated.
+    '''
+    packages = _get_request_packages()
+    if packages:
+        packages.pop(package_id, None)
+
+
+def _record_url_hit(redis, key, max_size):
+    ''' Count a request for the URL of an S3 object key,
+    keeping only the `max_size` most requested keys.
+    '''
+    redis.increment_scores(URL_HITS_KEY, {key: 1}, max_size)
+
+
+def _get_state_acl(acl, visibility_mode):
+    ''' The ACL as recorded in the visibility state, which also
+    identifies how it was applied, so that changing the mode
+    causes objects to be checked again.
+    '''
+    if visibility_mode == 'acl':
+        return acl
+    return visibility_mode + ':' + acl
+
+
+def _get_partition(region):
+    if region and region.startswith('cn-'):
+        return 'aws-cn'
+    if region and region.startswith('us-gov-'):
+        return 'aws-us-gov'
+    return 'aws'
+
+
 def _get_object_age_days(upload):
     """ Calculates the age of an uploaded S3 object, in days, rounded down.
     """
@@ -87,19 +229,6 @@ class S3FileStoreException(Exception):
     pass
 
 
-def get_s3_session(config):
-    if config.get('ckanext.s3filestore.aws_use_ami_role', False):
-        p_key = None
-        s_key = None
-    else:
-        p_key = config.get('ckanext.s3filestore.aws_access_key_id')
-        s_key = config.get('ckanext.s3filestore.aws_secret_access_key')
-    region = config.get('ckanext.s3filestore.region_name')
-    return boto3.session.Session(aws_access_key_id=p_key,
-                                 aws_secret_access_key=s_key,
-                                 region_name=region)
-
-
 def _is_presigned_url(url):
     ''' Determines whether a URL represents a presigned S3 URL.'''
     parts = url.split('?')
@@ -113,13 +242,33 @@ class BaseS3Uploader(object):
         self.region = config.get('ckanext.s3filestore.region_name')
         self.signature = config.get('ckanext.s3filestore.signature_version')
         self.download_proxy = config.get('ckanext.s3filestore.download_proxy')
+        # streaming responses need Flask, ie CKAN 2.9 or later
+        self.proxy_downloads = toolkit.asbool(config.get('ckanext.s3filestore.proxy_downloads', False)) \
+            and toolkit.check_ckan_version(min_version='2.9.0')
         self.signed_url_expiry = int(config.get('ckanext.s3filestore.signed_url_expiry', '3600'))
         self.signed_url_cache_window = int(config.get('ckanext.s3filestore.signed_url_cache_window', '1800'))
         self.public_url_cache_window = int(config.get('ckanext.s3filestore.public_url_cache_window', '86400'))
         self.acl_cache_window = int(config.get('ckanext.s3filestore.acl_cache_window', '86400'))
+        self.metadata_cache_window = int(config.get('ckanext.s3filestore.metadata_cache_window', self.acl_cache_window))
         self.acl = config.get('ckanext.s3filestore.acl', PUBLIC_ACL)
         self.non_current_acl = config.get('ckanext.s3filestore.non_current_acl', PRIVATE_ACL)
+        self.visibility_mode = config.get('ckanext.s3filestore.visibility_mode', 'acl')
+        if self.visibility_mode not in VISIBILITY_MODES:
+            raise S3FileStoreException('ckanext.s3filestore.visibility_mode must be one of: {0}'.format(
+                ', '.join(VISIBILITY_MODES)))
+        self.visibility_cache_path = \
+            TAG_VISIBILITY_CACHE_PATH if self.visibility_mode == 'tag' else VISIBILITY_CACHE_PATH
+        # in tag mode, also check and reset ACLs left from ACL mode
+        self.tag_mode_reset_acl = toolkit.asbool(
+            config.get('ckanext.s3filestore.tag_mode_reset_acl', False))
         self.addressing_style = config.get('ckanext.s3filestore.addressing_style', 'auto')
+        self.multipart_threshold = int(config.get('ckanext.s3filestore.multipart_threshold', MULTIPART_DEFAULT_SIZE))
+        self.multipart_chunksize = int(config.get('ckanext.s3filestore.multipart_chunksize', MULTIPART_DEFAULT_SIZE))
+        self.multipart_concurrency = int(config.get('ckanext.s3filestore.multipart_concurrency', '4'))
+        self.skip_unchanged_uploads = toolkit.asbool(config.get('ckanext.s3filestore.skip_unchanged_uploads', True))
+        self.content_addressed = toolkit.asbool(config.get('ckanext.s3filestore.content_addressed', False))
+        self.prewarm_top_keys = int(config.get('ckanext.s3filestore.prewarm.top_keys', '0'))
+        self.prewarm_refresh_margin = int(config.get('ckanext.s3filestore.prewarm.refresh_margin', '600'))
         if is_path_addressing():
             self.host_name = config.get('ckanext.s3filestore.host_name')
         else:
@@ -131,21 +280,33 @@ class BaseS3Uploader(object):
         return directory
 
     def _get_s3_config(self):
-        return Config(
-            signature_version=self.signature,
-            s3={'addressing_style': self.addressing_style}
-        )
+        return get_botocore_config(config, self.signature, self.addressing_style)
 
     def get_s3_resource(self, session=None):
+        ''' Return an S3 resource. Unless a specific session is
+        requested, this comes from the process-wide client pool.
+        '''
         if not session:
-            session = get_s3_session(config)
+            return get_pool().get_resource(
+                config, endpoint_url=self.host_name,
+                signature_version=self.signature,
+                addressing_style=self.addressing_style)
         return session.resource('s3',
                                 endpoint_url=self.host_name,
                                 config=self._get_s3_config())
 
-    def get_s3_client(self, session=None):
+    def get_s3_client(self, session=None, max_pool_connections=None):
+        ''' Return an S3 client. Unless a specific session is
+        requested, this is shared via the process-wide client pool.
+        `max_pool_connections` sets the least number of connections
+        the client should allow.
+        '''
         if not session:
-            session = get_s3_session(config)
+            return get_pool().get_client(
+                config, endpoint_url=self.host_name,
+                signature_version=self.signature,
+                addressing_style=self.addressing_style,
+                max_pool_connections=max_pool_connections)
         return session.client('s3',
                               endpoint_url=self.host_name,
                               config=self._get_s3_config())
@@ -185,8 +346,27 @@ class BaseS3Uploader(object):
 
         return bucket
 
-    def upload_to_key(self, filepath, upload_file, acl, extra_metadata=None):
-        '''Uploads the `upload_file` to `filepath` on `self.bucket`.'''
+    def get_transfer_config(self):
+        ''' Build the managed transfer settings for uploads.
+        Files larger than the multipart threshold are sent in parts,
+        and at most one part per concurrent thread is held in memory.
+        '''
+        transfer_config = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=max(self.multipart_concurrency, 1),
+            use_threads=self.multipart_concurrency > 1)
+        transfer_config.max_in_memory_upload_chunks = max(self.multipart_concurrency, 1)
+        return transfer_config
+
+    def upload_to_key(self, filepath, upload_file, acl, extra_metadata=None, content_disposition=True):
+        '''Uploads the `upload_file` to `filepath` on `self.bucket`.
+        The file is streamed, using a multipart upload if it is larger
+        than the configured threshold, rather than read into memory.
+        If `content_disposition` is False, no download file name is
+        stored with the object.
+        Returns the SHA-256 digest of the file, in hex.
+        '''
 
         upload_file.seek(0)
         mime_type = getattr(self, 'mimetype', '') or 'application/octet-stream'
@@ -196,58 +376,304 @@ class BaseS3Uploader(object):
             filepath, self.bucket_name, acl, mime_type)
 
         try:
-            kwargs = {
-                'Body': upload_file.read(), 'ACL': acl,
-                'ContentType': mime_type}
-            if mime_type != 'application/pdf':
-                filename = filepath.split('/')[-1]
-                kwargs['ContentDisposition'] = 'attachment; filename=' + filename
-            if extra_metadata:
-                kwargs['Metadata'] = extra_metadata
-
-            self.get_s3_resource().Object(self.bucket_name, filepath).put(**kwargs)
+            kwargs = self.get_upload_args(filepath, acl, mime_type, extra_metadata, content_disposition)
+            client = self.get_s3_client()
+            indexed = self._get_indexed_metadata(filepath) if self.skip_unchanged_uploads else None
+            digest = indexed and self._get_unchanged_digest(filepath, upload_file, indexed, mime_type, acl)
+            if digest:
+                log.info("%s is unchanged, skipping upload", filepath)
+                if self._is_metadata_changed(indexed, kwargs):
+                    self._replace_object_metadata(client, filepath, kwargs)
+                    self._index_object_metadata(filepath, dict(
+                        indexed, ContentDisposition=kwargs.get('ContentDisposition'),
+                        Metadata=kwargs.get('Metadata', {})))
+                return digest
+
+            upload_file.seek(0, os.SEEK_END)
+            size = upload_file.tell()
+            upload_file.seek(0)
+            # hash the data as it is sent, rather than reading it twice,
+            # split into parts as the transfer manager splits it
+            reader = HashingReader(
+                upload_file, ChunksizeAdjuster().adjust_chunksize(self.multipart_chunksize, size))
+            client.upload_fileobj(
+                reader, self.bucket_name, filepath,
+                ExtraArgs=kwargs, Config=self.get_transfer_config())
             log.info("Successfully uploaded %s to S3!", filepath)
-            self.redis.delete(filepath)
-            self.redis.delete(filepath + VISIBILITY_CACHE_PATH + '/all')
-            self.redis.put(filepath + VISIBILITY_CACHE_PATH, acl, expiry=self.acl_cache_window)
+            metadata = None
+            # the ETag of an object encrypted with KMS is not derived
+            # from its content, so it is read from S3 instead
+            if not self._is_bucket_kms_encrypted(client):
+                metadata = {'ContentType': mime_type, 'ContentLength': size,
+                            'ETag': reader.expected_etag(size >= self.multipart_threshold),
+                            'ContentDisposition': kwargs.get('ContentDisposition'),
+                            'Metadata': kwargs.get('Metadata', {})}
+            self.index_uploaded_object(client, filepath, acl, metadata)
+            return reader.sha256.hexdigest()
         except Exception as e:
             log.error('Something went very very wrong when uploading to [%s]: %s', filepath, e)
             raise e
 
+    def _is_bucket_kms_encrypted(self, client):
+        ''' Check whether the bucket encrypts new objects with KMS by
+        default. This is read once per process; if it cannot be read,
+        the bucket is assumed to use KMS.
+        '''
+        with _bucket_kms_encryption_lock:
+            if self.bucket_name not in _bucket_kms_encryption:
+                try:
+                    rules = client.get_bucket_encryption(
+                        Bucket=self.bucket_name)['ServerSideEncryptionConfiguration']['Rules']
+                    kms_encrypted = any(
+                        rule.get('ApplyServerSideEncryptionByDefault', {}).get('SSEAlgorithm', '')
+                        .startswith('aws:kms') for rule in rules)
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'ServerSideEncryptionConfigurationNotFoundError':
+                        kms_encrypted = False
+                    else:
+                        log.warning("Unable to read the encryption of bucket %s, so uploaded objects will "
+                                    "be checked with a HEAD request: %s", self.bucket_name, e)
+                        kms_encrypted = True
+                _bucket_kms_encryption[self.bucket_name] = kms_encrypted
+            return _bucket_kms_encryption[self.bucket_name]
+
+    def _get_indexed_metadata(self, filepath):
+        ''' Return the metadata index entry of the object at `filepath`,
+        or None if it has none. Objects missing from the index are
+        assumed to have changed, rather than sending a HEAD request
+        for every new upload.
+        '''
+        record = self.redis.get(filepath + METADATA_CACHE_PATH)
+        if not record:
+            return None
+        try:
+            return json.loads(record)
+        except ValueError:
+            return None
+
+    def _get_unchanged_digest(self, filepath, upload_file, metadata, mime_type, acl):
+        ''' If the object at `filepath`, indexed with `metadata`, already
+        holds the contents of `upload_file`, with the same type and
+        visibility, return the SHA-256 digest of the file; otherwise
+        return None.
+
+        The size and type in the metadata index are compared first,
+        so the file is only read if they match. Its content is then
+        compared with the object's ETag, which S3 derives from the MD5
+        digests of the data and of each part.
+        '''
+        upload_file.seek(0, os.SEEK_END)
+        size = upload_file.tell()
+        upload_file.seek(0)
+        if metadata.get('ContentLength') != size or metadata.get('ContentType') != mime_type:
+            return None
+
+        # split the file as the transfer manager would
+        part_size = ChunksizeAdjuster().adjust_chunksize(self.multipart_chunksize, size)
+        reader = HashingReader(upload_file, part_size)
+        while reader.read(part_size):
+            pass
+        upload_file.seek(0)
+        if reader.expected_etag(size >= self.multipart_threshold) != metadata.get('ETag'):
+            return None
+        if self.is_key_public(filepath) != (acl == PUBLIC_ACL):
+            return None
+        return reader.sha256.hexdigest()
+
+    def _is_metadata_changed(self, indexed, kwargs):
+        ''' Check whether the headers and user metadata in `kwargs`
+        differ from those of the object in the metadata index. Entries
+        indexed before these were recorded are assumed to differ.
+        '''
+        if 'Metadata' not in indexed:
+            return True
+
+        def _stable(metadata):
+            return {name: value for name, value in (metadata or {}).items()
+                    if name not in VOLATILE_METADATA_FIELDS}
+
+        return indexed.get('ContentDisposition') != kwargs.get('ContentDisposition') \
+            or _stable(indexed['Metadata']) != _stable(kwargs.get('Metadata'))
+
+    def _replace_object_metadata(self, client, filepath, kwargs):
+        ''' Give an existing object the user metadata and headers in
+        `kwargs`, by copying it onto itself within S3. The copy is split
+        into parts as an upload would be, so the ETag is unchanged.
+        In tag mode, the tags of the object are kept.
+        '''
+        kwargs = dict(kwargs, MetadataDirective='REPLACE')
+        kwargs.pop('Tagging', None)
+        client.copy(
+            {'Bucket': self.bucket_name, 'Key': filepath}, self.bucket_name, filepath,
+            ExtraArgs=kwargs, Config=self.get_transfer_config())
+
+    def get_upload_args(self, filepath, acl, mime_type, extra_metadata=None, content_disposition=True):
+        ''' Return the arguments for writing a new S3 object to `filepath`.
+        '''
+        kwargs = self.get_visibility_args(acl)
+        kwargs['ContentType'] = mime_type
+        if content_disposition and mime_type != 'application/pdf':
+            filename = filepath.split('/')[-1]
+            kwargs['ContentDisposition'] = 'attachment; filename=' + filename
+        if extra_metadata:
+            kwargs['Metadata'] = extra_metadata
+        return kwargs
+
+    def index_uploaded_object(self, client, filepath, acl=None, metadata=None):
+        ''' Cache the visibility and metadata of a newly written object,
+        so that URL generation does not need to ask S3 again.
+        `metadata` holds the content type, size and ETag, if they are
+        known from the upload; otherwise they are read with a HEAD request.
+        Returns the metadata.
+        '''
+        if metadata is None:
+            metadata = client.head_object(Bucket=self.bucket_name, Key=filepath)
+        with self.redis.batch() as cache_updates:
+            cache_updates.delete(filepath)
+            cache_updates.delete(filepath + self.visibility_cache_path + '/all')
+            if acl:
+                cache_updates.put(filepath + self.visibility_cache_path, acl, expiry=self.acl_cache_window)
+            else:
+                cache_updates.delete(filepath + self.visibility_cache_path)
+            self._index_object_metadata(filepath, metadata, cache_updates)
+        return metadata
+
+    def get_visibility_args(self, acl):
+        ''' Return the arguments that give a new S3 object
+        the visibility of the canned ACL `acl`.
+        '''
+        if self.visibility_mode == 'tag':
+            return {'Tagging': urlencode({VISIBILITY_TAG: acl})}
+        return {'ACL': acl}
+
+    def get_bucket_policy_statement(self):
+        ''' Return the bucket policy statement that makes objects
+        tagged as public readable by anyone, for the 'tag' visibility mode.
+        '''
+        return {
+            'Sid': BUCKET_POLICY_SID,
+            'Effect': 'Allow',
+            'Principal': '*',
+            'Action': 's3:GetObject',
+            'Resource': 'arn:{0}:s3:::{1}/*'.format(_get_partition(self.region), self.bucket_name),
+            'Condition': {'StringEquals': {'s3:ExistingObjectTag/' + VISIBILITY_TAG: PUBLIC_ACL}},
+        }
+
     def clear_key(self, filepath):
         '''Deletes the contents of the key at `filepath` on `self.bucket`.'''
         try:
             self.get_s3_resource().Object(self.bucket_name, filepath).delete()
             log.info("Removed %s from S3", filepath)
-            self.redis.delete(filepath)
-            self.redis.delete(filepath + VISIBILITY_CACHE_PATH)
+            self.redis.delete_many(_get_cache_paths(filepath))
         except Exception as e:
             raise e
 
+    def clear_keys(self, filepaths):
+        '''Deletes the objects at each of `filepaths` on `self.bucket`,
+        using one DeleteObjects request per batch of up to 1000 keys.
+        '''
+        filepaths = list(filepaths)
+        client = self.get_s3_client()
+        for start in range(0, len(filepaths), DELETE_BATCH_SIZE):
+            batch = filepaths[start:start + DELETE_BATCH_SIZE]
+            response = client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': filepath} for filepath in batch], 'Quiet': True})
+            with self.redis.batch() as cache_updates:
+                for filepath in batch:
+                    for cache_path in _get_cache_paths(filepath):
+                        cache_updates.delete(cache_path)
+            errors = response.get('Errors')
+            if errors:
+                raise S3FileStoreException('Failed to remove {0} objects from S3, eg {1}: {2}'.format(
+                    len(errors), errors[0].get('Key'), errors[0].get('Message')))
+            log.info("Removed %s objects from S3", len(batch))
+
+    def _index_object_metadata(self, key, metadata, cache_updates=None):
+        ''' Record the content type, size and ETag of an S3 object.
+        '''
+        record = json.dumps({field: metadata.get(field) for field in INDEXED_METADATA_FIELDS})
+        (cache_updates or self.redis).put(
+            key + METADATA_CACHE_PATH, record, expiry=self.metadata_cache_window)
+
+    def get_object_metadata(self, key):
+        ''' Return the content type, size and ETag of an S3 object,
+        as a dict with the same keys as a HEAD response.
+        These are read from the metadata index written at upload time,
+        falling back to a HEAD request if the index has no entry.
+        '''
+        record = self.redis.get(key + METADATA_CACHE_PATH)
+        if record:
+            try:
+                return json.loads(record)
+            except ValueError:
+                log.warning("Ignoring invalid metadata index entry for %s", key)
+
+        log.debug('Checking that S3 object %s exists', key)
+        try:
+            metadata = self.get_s3_client().head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            raise toolkit.ObjectNotFound("Unable to retrieve metadata for object [{}]".format(key))
+        self._index_object_metadata(key, metadata)
+        return metadata
+
+    def resolve_key(self, key):
+        ''' Return the key of the S3 object holding the content of `key`.
+        In the content-addressed layout, this is the blob that a resource
+        object key points at; otherwise, and for keys that do not point
+        at a blob, it is `key` itself.
+        '''
+        if not self.content_addressed:
+            return key
+        cache_key = key + BLOB_CACHE_PATH
+        blob_key = self.redis.get(cache_key)
+        if blob_key is None:
+            # an empty value records that the key has no blob;
+            # database errors are raised rather than cached
+            blob_key = get_blob_key(key) or ''
+            self.redis.put(cache_key, blob_key, expiry=self.metadata_cache_window)
+        return blob_key or key
+
     def is_key_public(self, key):
         ''' Check whether an S3 object key is publicly readable.
         May cache results to reduce API calls.
         '''
-        acl_key = key + VISIBILITY_CACHE_PATH
+        acl_key = key + self.visibility_cache_path
         acl = self.redis.get(acl_key)
         if acl == PUBLIC_ACL:
             return True
         if acl == PRIVATE_ACL:
             return False
 
+        acl = self._get_key_acl(key)
+        self.redis.put(acl_key, acl, expiry=self.acl_cache_window)
+        return acl == PUBLIC_ACL
+
+    def _get_key_acl(self, key, tags=None):
+        ''' Read the canned ACL of an S3 object key from S3.
+        In tag mode, `tags` is the TagSet of the object, if already known.
+        '''
         client = self.get_s3_client()
+        if self.visibility_mode == 'tag':
+            if tags is None:
+                tags = client.get_object_tagging(Bucket=self.bucket_name, Key=key)['TagSet']
+            if {'Key': VISIBILITY_TAG, 'Value': PUBLIC_ACL} in tags:
+                return PUBLIC_ACL
+            if not self.tag_mode_reset_acl:
+                return PRIVATE_ACL
+            # an ACL applied before switching to tags may still make it public
         # check if the object ACL grants any permission to all users
-        acl = PUBLIC_ACL if any(
+        return PUBLIC_ACL if any(
             grant['Grantee']['Type'] == 'Group'
             and grant['Grantee'].get('URI', '').endswith('AllUsers')
             for grant in client.get_object_acl(Bucket=self.bucket_name, Key=key)['Grants']
         ) else PRIVATE_ACL
-        self.redis.put(acl_key, acl, expiry=self.acl_cache_window)
-        return acl == PUBLIC_ACL
 
-    def get_signed_url_to_key(self, key, extra_params={}):
+    def get_signed_url_to_key(self, key, extra_params={}, refresh=False):
         '''Generates a pre-signed URL giving access to an S3 object,
         or, if the object is already publicly visible, an unsigned URL.
+        The URL is cached; if `refresh` is True, a new one is generated
+        even if a cached URL is available.
 
         If a download_proxy is configured, then the URL will be
         generated using the true S3 host, and then the hostname will be
@@ -257,7 +683,10 @@ class BaseS3Uploader(object):
         be configured to set the Host header back to the true value when
         forwarding the request (CloudFront does this automatically).
         '''
-        cache_url = self.redis.get(key)
+        if self.prewarm_top_keys > 0 and not refresh:
+            _record_url_hit(self.redis, key,
+                            self.prewarm_top_keys * URL_HITS_TRACKED_FACTOR)
+        cache_url = None if refresh else self.redis.get(key)
         if cache_url:
             log.debug('Returning cached URL for path %s', key)
             return cache_url
@@ -265,18 +694,15 @@ class BaseS3Uploader(object):
             log.debug('No cache found for %s; generating a new URL', key)
 
         client = self.get_s3_client()
+        object_key = self.resolve_key(key)
 
         # check whether the object exists in S3
-        log.debug('Checking that S3 object %s exists', key)
-        try:
-            metadata = client.head_object(Bucket=self.bucket_name, Key=key)
-        except ClientError:
-            raise toolkit.ObjectNotFound("Unable to retrieve metadata for object [{}]".format(key))
+        metadata = self.get_object_metadata(object_key)
 
         # check whether the object is publicly readable
-        is_public_read = self.is_key_public(key)
+        is_public_read = self.is_key_public(object_key)
         params = {'Bucket': self.bucket_name,
-                  'Key': key}
+                  'Key': object_key}
         if not is_public_read and metadata['ContentType'] != 'application/pdf':
             filename = key.split('/')[-1]
             params['ResponseContentDisposition'] = 'attachment; filename=' + filename
@@ -300,6 +726,33 @@ class BaseS3Uploader(object):
         self.redis.put(key, url, expiry=cache_expiry)
         return url
 
+    def prewarm_signed_urls(self, limit=None):
+        ''' Regenerate the cached URLs of the most requested keys that
+        expire within the refresh margin, so that requests for popular
+        files always find a cached URL. Request counts are then decayed,
+        so that the ranking follows recent demand.
+
+        :returns: the number of URLs regenerated
+        '''
+        limit = limit or self.prewarm_top_keys
+        if limit <= 0:
+            return 0
+        keys = self.redis.get_top_members(URL_HITS_KEY, limit)
+        refreshed = 0
+        missing = []
+        for key, ttl in zip(keys, self.redis.get_ttls(keys)):
+            if ttl is not None and ttl > self.prewarm_refresh_margin:
+                continue
+            try:
+                self.get_signed_url_to_key(key, refresh=True)
+                refreshed += 1
+            except (ClientError, toolkit.ObjectNotFound) as e:
+                log.debug("Not prewarming URL of %s: %s", key, e)
+                missing.append(key)
+        self.redis.remove_members(URL_HITS_KEY, missing)
+        self.redis.decay_scores(URL_HITS_KEY, 0.5, limit * URL_HITS_TRACKED_FACTOR)
+        return refreshed
+
     def as_clean_dict(self, dict):
         for k, v in list(dict.items()):
             if isinstance(v, datetime.datetime):
@@ -508,8 +961,12 @@ class S3ResourceUploader(BaseS3Uploader):
 
         self.use_filename = toolkit.asbool(config.get('ckanext.s3filestore.use_filename', False))
         self.delete_non_current_days = int(config.get('ckanext.s3filestore.delete_non_current_days', '-1'))
+        self.acl_object_concurrency = int(config.get('ckanext.s3filestore.acl.object_concurrency', '4'))
+        self.track_visibility_state = toolkit.asbool(config.get('ckanext.s3filestore.acl.track_state', True))
+        self.async_upload = toolkit.asbool(config.get('ckanext.s3filestore.async_upload', False))
         path = config.get('ckanext.s3filestore.aws_storage_path', '')
         self.storage_path = os.path.join(path, 'resources')
+        self.blob_storage_path = os.path.join(path, 'blobs')
         self.filename = None
         self.old_filename = None
         self.url = resource['url']
@@ -519,8 +976,6 @@ class S3ResourceUploader(BaseS3Uploader):
         upload_field_storage = resource.pop('upload', None)
         self.clear = resource.pop('clear_upload', None)
 
-        mime = magic.Magic(mime=True)
-
         if isinstance(upload_field_storage, ALLOWED_UPLOAD_TYPES) \
                 and upload_field_storage.filename:
             self.filesize = 0  # bytes
@@ -555,7 +1010,7 @@ class S3ResourceUploader(BaseS3Uploader):
                     if not self.mimetype:
                         try:
                             # 2048 bytes are needed to detect Office docs
-                            self.mimetype = mime.from_buffer(self.upload_file.read(2048))
+                            self.mimetype = _detect_mimetype(self.upload_file.read(2048))
                         except Exception:
                             pass
                     resource['mimetype'] = self.mimetype
@@ -577,15 +1032,30 @@ class S3ResourceUploader(BaseS3Uploader):
             self.old_filename = old_resource.url
             resource['url_type'] = ''
 
-    def _get_package(self, resource_id=None):
-        context = {'ignore_auth': True}
-        if resource_id:
-            resource = toolkit.get_action('resource_show')(
-                context=context, data_dict={'id': resource_id})
-        else:
-            resource = self.resource
-        return toolkit.get_action('package_show')(
-            context=context, data_dict={'id': resource.get('package_id')})
+    def _get_package(self):
+        ''' Return the package of the resource. The result of
+        package_show is shared by all uploaders for the rest of the request.
+        '''
+        package_id = self.resource.get('package_id')
+        packages = _get_request_packages()
+        if packages is not None and package_id in packages:
+            return packages[package_id]
+        package = toolkit.get_action('package_show')(
+            context={'ignore_auth': True}, data_dict={'id': package_id})
+        if packages is not None:
+            packages[package_id] = package
+        return package
+
+    def _is_package_private(self, resource_id):
+        ''' Read whether the package of a resource is private,
+        without building the whole package.
+        '''
+        row = model.Session.query(model.Package.private) \
+            .join(model.Resource, model.Resource.package_id == model.Package.id) \
+            .filter(model.Resource.id == resource_id).first()
+        if row is None:
+            raise toolkit.ObjectNotFound('Resource {0} not found'.format(resource_id))
+        return bool(row[0])
 
     def get_path(self, id, filename=None):
         '''Return the key used for this resource in S3.
@@ -607,70 +1077,174 @@ class S3ResourceUploader(BaseS3Uploader):
 
     def _get_target_acl(self, resource_id):
         if self.acl == 'auto':
-            package = self._get_package(resource_id)
-            return PRIVATE_ACL if package['private'] else PUBLIC_ACL
+            return PRIVATE_ACL if self._is_package_private(resource_id) else PUBLIC_ACL
         else:
             return self.acl
 
+    def _get_key_acl(self, key, tags=None):
+        ''' Use the recorded visibility state of the resource, if the
+        key is its current object, rather than reading it from S3.
+        '''
+        if self.track_visibility_state and key.startswith(self.storage_path + '/'):
+            resource_id = key[len(self.storage_path) + 1:].split('/')[0]
+            state = get_visibility_state(resource_id)
+            for acl in (PUBLIC_ACL, PRIVATE_ACL):
+                if state == (key, _get_state_acl(acl, self.visibility_mode)):
+                    return acl
+        return super(S3ResourceUploader, self)._get_key_acl(key, tags)
+
     def update_visibility(self, id, target_acl=None):
         ''' Update the visibility of all S3 objects for a resource
         to match the package, if the ACL config is set to 'auto'.
+        S3 is not consulted if the cache, or the recorded visibility
+        state of the resource, shows that the objects already match.
+
+        Returns True if any object was changed or deleted.
         '''
         if self.acl != 'auto':
-            return
+            return False
         if not target_acl:
             target_acl = self._get_target_acl(id)
 
         client = self.get_s3_client()
 
         current_key = self.get_path(id)
-        all_visibility = self.redis.get(current_key + VISIBILITY_CACHE_PATH + '/all')
+        all_visibility = self.redis.get(current_key + self.visibility_cache_path + '/all')
         if all_visibility is not None and all_visibility == target_acl:
             log.debug("update_visibility: id: %s already set and found in cache as %s", id, target_acl)
-            return
-        # iterate through every S3 object matching the resource ID
-        log.debug("update_visibility: id: %s getting item list from store", id)
-        resource_objects = client.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=self.get_directory(id, self.storage_path)
-        )
-        log.debug("update_visibility: id: %s finished item list from store", id)
-        if not resource_objects['KeyCount']:
-            return
+            return False
+        state_acl = _get_state_acl(target_acl, self.visibility_mode)
+        if self.track_visibility_state and get_visibility_state(id) == (current_key, state_acl):
+            log.debug("update_visibility: id: %s already set and recorded as %s", id, target_acl)
+            self.redis.put(current_key + self.visibility_cache_path + '/all', target_acl, expiry=self.acl_cache_window)
+            return False
 
-        for upload in resource_objects['Contents']:
+        # Iterate through every S3 object matching the resource ID,
+        # one listing page at a time. The changes for each page run
+        # in the background while the next page is fetched, but we
+        # never fall more than one page behind.
+        # Cache changes are queued and sent together at the end,
+        # and expired objects are deleted in batches.
+        log.debug("update_visibility: id: %s getting item list from store", id)
+        changed = False
+        expired_keys = []
+        with self.redis.batch() as cache_updates, \
+                get_executor(self.acl_object_concurrency, 'objects') as executor:
+            previous_page = []
+            for uploads in self._iter_resource_objects(client, id):
+                actions = []
+                for upload_key, acl in self._get_visibility_actions(uploads, current_key, target_acl):
+                    if acl:
+                        actions.append((upload_key, acl))
+                    else:
+                        expired_keys.append(upload_key)
+                if len(expired_keys) >= DELETE_BATCH_SIZE:
+                    self.clear_keys(expired_keys)
+                    expired_keys = []
+                    changed = True
+                # fetch the page's cached ACLs in one round trip
+                acl_keys = [upload_key for upload_key, acl in actions]
+                cached_acls = dict(zip(acl_keys, self.redis.get_many(
+                    [upload_key + self.visibility_cache_path for upload_key in acl_keys])))
+                current_page = [
+                    executor.submit(self._apply_visibility_action, client, upload_key, acl,
+                                    cached_acls.get(upload_key), cache_updates)
+                    for upload_key, acl in actions]
+                changed = _any_result(previous_page) or changed
+                previous_page = current_page
+            changed = _any_result(previous_page) or changed
+            if expired_keys:
+                self.clear_keys(expired_keys)
+                changed = True
+            log.debug("update_visibility: id: %s finished item list from store", id)
+            cache_updates.put(current_key + self.visibility_cache_path + '/all', target_acl, expiry=self.acl_cache_window)
+        if self.track_visibility_state:
+            set_visibility_state(id, current_key, state_acl)
+        return changed
+
+    def _iter_resource_objects(self, client, id):
+        ''' Yield the S3 objects for a resource, one listing page at a time.
+        '''
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=self.get_directory(id, self.storage_path)):
+            yield page.get('Contents', [])
+
+    def _get_visibility_actions(self, uploads, current_key, target_acl):
+        ''' Decide what should happen to each S3 object of a resource.
+        Yields (key, ACL) pairs, where an ACL of None means that
+        the object has expired and should be deleted.
+        '''
+        for upload in uploads:
             upload_key = upload['Key']
             log.debug("Setting visibility for key [%s], current object is [%s]", upload_key, current_key)
             if upload_key == current_key:
-                acl = target_acl
+                yield upload_key, target_acl
             elif self.delete_non_current_days >= 0 and _get_object_age_days(upload) >= self.delete_non_current_days:
-                self.clear_key(upload_key)
-                continue
+                yield upload_key, None
             elif self.non_current_acl == 'auto':
-                acl = target_acl
+                yield upload_key, target_acl
             else:
-                acl = self.non_current_acl
-
-            is_public_read = self.is_key_public(upload_key)
-            # if the ACL status doesn't match what we want, update it
-            if (acl == PUBLIC_ACL) != is_public_read:
-                log.debug("Updating ACL for object %s to %s", upload_key, acl)
-                client.put_object_acl(
-                    Bucket=self.bucket_name, Key=upload_key, ACL=acl)
-                self.redis.delete(upload_key)
-                self.redis.put(upload_key + VISIBILITY_CACHE_PATH, acl, expiry=self.acl_cache_window)
-        self.redis.put(current_key + VISIBILITY_CACHE_PATH + '/all', target_acl, expiry=self.acl_cache_window)
+                yield upload_key, self.non_current_acl
+
+    def _apply_visibility_action(self, client, upload_key, acl, current_acl, cache_updates):
+        ''' Apply the ACL to an S3 object. Returns True if it was changed.
+        '''
+        tags = None
+        if current_acl not in (PUBLIC_ACL, PRIVATE_ACL):
+            if self.visibility_mode == 'tag':
+                # read once, for both the check and the update
+                tags = client.get_object_tagging(Bucket=self.bucket_name, Key=upload_key)['TagSet']
+            current_acl = self._get_key_acl(upload_key, tags)
+            cache_updates.put(upload_key + self.visibility_cache_path, current_acl, expiry=self.acl_cache_window)
+        # if the ACL status doesn't match what we want, update it
+        if (acl == PUBLIC_ACL) == (current_acl == PUBLIC_ACL):
+            return False
+        log.debug("Updating ACL for object %s to %s", upload_key, acl)
+        if self.visibility_mode == 'tag':
+            # keep any other tags on the object
+            if tags is None:
+                tags = client.get_object_tagging(Bucket=self.bucket_name, Key=upload_key)['TagSet']
+            tags = [tag for tag in tags if tag['Key'] != VISIBILITY_TAG]
+            tags.append({'Key': VISIBILITY_TAG, 'Value': acl})
+            client.put_object_tagging(
+                Bucket=self.bucket_name, Key=upload_key, Tagging={'TagSet': tags})
+            if acl != PUBLIC_ACL and self.tag_mode_reset_acl:
+                self._reset_key_acl(client, upload_key)
+        else:
+            client.put_object_acl(
+                Bucket=self.bucket_name, Key=upload_key, ACL=acl)
+        cache_updates.delete(upload_key)
+        cache_updates.put(upload_key + self.visibility_cache_path, acl, expiry=self.acl_cache_window)
+        return True
+
+    def _reset_key_acl(self, client, upload_key):
+        ''' Remove any public grant left by an ACL set before switching
+        to tag mode. Buckets with ACLs disabled reject the request,
+        and need nothing to be done.
+        '''
+        try:
+            client.put_object_acl(
+                Bucket=self.bucket_name, Key=upload_key, ACL=PRIVATE_ACL)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'AccessControlListNotSupported':
+                raise
 
     def upload(self, id, max_size=10):
         '''Upload the file to S3.'''
 
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
-        if self.filename:
-            filepath = self.get_path(id, self.filename)
-            self.upload_to_key(filepath, self.upload_file, acl=self._get_target_acl(id),
-                               extra_metadata=self._get_resource_metadata())
-        self.update_visibility(id)
+        # Asynchronous uploads are staged locally; a background job
+        # sends them to S3 and then updates the visibility.
+        if not (self.filename and self.async_upload and self._stage_upload(id)):
+            if self.filename:
+                filepath = self.get_path(id, self.filename)
+                digest = self._upload_resource_file(id, filepath, self.upload_file,
+                                                    self._get_resource_metadata())
+                # committed with the rest of the resource update
+                self._set_resource_hash(id, digest)
+            self.update_visibility(id)
 
         # The resource form only sets self.clear (via the input clear_upload)
         # to True when an uploaded file is not replaced by another uploaded
@@ -681,6 +1255,208 @@ class S3ResourceUploader(BaseS3Uploader):
             filepath = self.get_path(id, self.old_filename)
             self.clear_key(filepath)
 
+    def _upload_resource_file(self, id, filepath, upload_file, metadata):
+        ''' Upload a resource file to `filepath`, or to a blob that
+        `filepath` points at in the content-addressed layout.
+        Returns the SHA-256 digest of the file.
+        '''
+        # the next visibility update then checks every object of the
+        # resource, which is also when non-current files are pruned
+        if self.track_visibility_state:
+            clear_visibility_state(id)
+        if self.content_addressed:
+            return self.upload_blob(filepath, upload_file)
+        return self.upload_to_key(filepath, upload_file, acl=self._get_target_acl(id),
+                                  extra_metadata=metadata)
+
+    def get_blob_path(self, digest):
+        ''' Return the key of the blob for content with a SHA-256 digest.
+        '''
+        return os.path.join(self.blob_storage_path, digest[:2], digest)
+
+    def upload_blob(self, filepath, upload_file):
+        ''' Store the file under the key of its content hash, unless
+        that blob already exists, and point `filepath` at the blob.
+        Blobs may be shared by public and private resources, so they
+        are always private, and served with signed URLs.
+        Returns the SHA-256 digest of the file.
+        '''
+        upload_file.seek(0)
+        reader = HashingReader(upload_file, self.multipart_chunksize)
+        while reader.read(self.multipart_chunksize):
+            pass
+        digest = reader.sha256.hexdigest()
+        blob_key = self.get_blob_path(digest)
+        previous_blob_key = get_blob_key(filepath)
+
+        # the lock stops the blob being deleted before it is referenced
+        with self.redis.lock(blob_key + BLOB_LOCK, BLOB_LOCK_TIMEOUT, blocking_timeout=BLOB_LOCK_WAIT):
+            try:
+                self.get_object_metadata(blob_key)
+                log.info("%s already stored as %s, skipping upload", filepath, blob_key)
+            except toolkit.ObjectNotFound:
+                # the download file name comes from the resource key,
+                # as the blob may be shared by files with other names
+                self.upload_to_key(blob_key, upload_file, acl=PRIVATE_ACL,
+                                   extra_metadata={'sha256': digest}, content_disposition=False)
+            try:
+                set_blob_reference(filepath, blob_key)
+            except Exception:
+                if previous_blob_key:
+                    set_blob_reference(filepath, previous_blob_key)
+                raise
+        self.redis.delete_many(_get_cache_paths(filepath))
+
+        if previous_blob_key and previous_blob_key != blob_key:
+            self._release_blob(filepath, previous_blob_key)
+        return digest
+
+    def _release_blob(self, filepath, blob_key):
+        ''' Remove the reference from `filepath` to a blob,
+        and delete the blob if nothing else refers to it.
+        '''
+        with self.redis.lock(blob_key + BLOB_LOCK, BLOB_LOCK_TIMEOUT, blocking_timeout=BLOB_LOCK_WAIT):
+            if remove_blob_reference(filepath, blob_key) == 0:
+                super(S3ResourceUploader, self).clear_key(blob_key)
+
+    def detach_blob(self, filepath):
+        ''' Stop `filepath` pointing at a blob in the content-addressed
+        layout, eg because an object has been written to it directly.
+        The blob is deleted if nothing else refers to it.
+        '''
+        blob_key = get_blob_key(filepath) if self.content_addressed else None
+        if blob_key:
+            self._release_blob(filepath, blob_key)
+            self.redis.delete(filepath + BLOB_CACHE_PATH)
+
+    def clear_key(self, filepath):
+        ''' Delete the object at `filepath`, and the blob it points at
+        in the content-addressed layout, unless the blob is shared.
+        '''
+        self.detach_blob(filepath)
+        super(S3ResourceUploader, self).clear_key(filepath)
+
+    def _set_resource_hash(self, id, digest):
+        ''' Record the SHA-256 digest of the uploaded file as the
+        resource hash, in the current database session.
+        '''
+        resource_obj = model.Resource.get(id)
+        if resource_obj is not None and resource_obj.hash != digest:
+            resource_obj.hash = digest
+        self.resource['hash'] = digest
+
+    def _get_staged_path(self, id):
+        ''' Return where the file of an asynchronous upload is staged.
+        This is the path used by the default CKAN uploader, so that
+        the filesystem download serves the file until it is in S3.
+        Returns None if no local storage path is configured.
+        '''
+        default_upload = DefaultResourceUpload({'url': self.url})
+        if not default_upload.storage_path:
+            return None
+        return default_upload.get_path(id)
+
+    def _stage_upload(self, id):
+        ''' Copy the uploaded file to the staging area, and queue a job
+        to send it to S3 once the resource update has been committed, as
+        the job reads the resource. Returns False if the file could not
+        be staged, in which case it should be uploaded straight away.
+        '''
+        staged_path = self._get_staged_path(id)
+        if not staged_path:
+            log.warning("ckan.storage_path is not set, so resource %s cannot be staged; uploading now", id)
+            return False
+        try:
+            os.makedirs(os.path.dirname(staged_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write to a temporary file first, so that a download never
+        # sees a partly written file
+        temp_path = staged_path + '~'
+        self.upload_file.seek(0)
+        with open(temp_path, 'wb') as staged_file:
+            shutil.copyfileobj(self.upload_file, staged_file)
+        os.rename(temp_path, staged_path)
+
+        token = uuid.uuid4().hex
+        self.redis.put(id + UPLOAD_PENDING_PATH, token, expiry=UPLOAD_PENDING_EXPIRY)
+        job_kwargs = {'resource_id': id, 'filename': self.filename, 'token': token,
+                      'metadata': self._get_resource_metadata()}
+
+        def _queue_upload():
+            try:
+                tasks.enqueue_task(
+                    tasks.s3_uploadResource,
+                    "s3_uploadResource: uploading {} to {}".format(self.filename, id), job_kwargs)
+            except Exception as e:
+                # the file stays staged until 's3 upload-staged' sends it
+                log.error("Failed to queue upload of resource %s. Error: [%s]", id, e)
+
+        def _discard_upload():
+            if self.redis.get(id + UPLOAD_PENDING_PATH) == token:
+                self.discard_staged_upload(id)
+
+        _on_transaction_end(_queue_upload, _discard_upload)
+        log.debug("Staged upload of resource %s at %s", id, staged_path)
+        return True
+
+    def upload_staged(self, id, filename, token, metadata=None):
+        ''' Send the staged file of an asynchronous upload to S3,
+        and update the visibility of the resource's objects.
+
+        Returns False, without uploading, if the resource has been
+        given another file since.
+        '''
+        pending_key = id + UPLOAD_PENDING_PATH
+        if self.redis.get(pending_key) != token:
+            # a newer upload has been staged, or the file was replaced
+            # by a direct upload, which discarded this one
+            return False
+
+        try:
+            if munge.munge_filename(os.path.basename(self.url)) != filename:
+                return False
+            staged_path = self._get_staged_path(id)
+            if not staged_path:
+                raise S3FileStoreException('ckan.storage_path must be set for asynchronous uploads')
+            self.mimetype = self.resource.get('mimetype')
+            with open(staged_path, 'rb') as staged_file:
+                digest = self._upload_resource_file(id, self.get_path(id, filename), staged_file, metadata)
+            self._set_resource_hash(id, digest)
+            model.repo.commit()
+            self.update_visibility(id)
+            return True
+        finally:
+            # unless another file was staged meanwhile, this one is done with
+            if self.redis.get(pending_key) == token:
+                self.discard_staged_upload(id)
+
+    def discard_staged_upload(self, id):
+        ''' Forget the staged file of an asynchronous upload, so that
+        downloads are served from S3, and a job still queued for the
+        file does nothing.
+        '''
+        pending_key = id + UPLOAD_PENDING_PATH
+        if self.redis.get(pending_key) is None:
+            # nothing is staged; a file at the staging path
+            # predates the extension, and must be kept
+            return
+        self.redis.delete(pending_key)
+        staged_path = self._get_staged_path(id)
+        if staged_path:
+            try:
+                os.remove(staged_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def is_upload_pending(self, id):
+        ''' Check whether the current file of the resource is staged
+        locally, and not yet in S3.
+        '''
+        return self.async_upload and self.redis.get(id + UPLOAD_PENDING_PATH) is not None
+
     def _get_resource_metadata(self):
         ''' Retrieve a dict of metadata about the resource,
         to be added to the S3 object.
@@ -707,6 +1483,8 @@ class S3ResourceUploader(BaseS3Uploader):
             log.warning("Key '%s' not found in bucket '%s' for delete",
                         key_path, self.bucket_name)
             pass
+        if self.track_visibility_state:
+            clear_visibility_state(id)
 
     def download(self, id, filename=None):
         '''
@@ -723,7 +1501,14 @@ class S3ResourceUploader(BaseS3Uploader):
             log.warning("Key '%s' not found in bucket '%s'",
                         filename, self.bucket_name)
 
+        if filename == munge.munge_filename(os.path.basename(self.url)) and self.is_upload_pending(id):
+            return DefaultResourceUpload(self.resource).download(id, self.filename)
+
         try:
+            if self.proxy_downloads:
+                from ckanext.s3filestore.views import stream_object
+                return stream_object(self.get_s3_client(), self.bucket_name, self.resolve_key(key_path),
+                                     filename=filename)
             url = self.get_signed_url_to_key(key_path)
             return h.redirect_to(url)
         except ClientError as ex:
@@ -745,12 +1530,15 @@ class S3ResourceUploader(BaseS3Uploader):
             log.warning("Key '%s' not found in bucket '%s'",
                         filename, self.bucket_name)
 
+        if filename == munge.munge_filename(os.path.basename(self.url)) and self.is_upload_pending(id):
+            return DefaultResourceUpload(self.resource).metadata(id)
+
         try:
             # Small workaround to manage downloading of large files
             # We are using redirect to minio's resource public URL
             client = self.get_s3_client()
 
-            metadata = client.head_object(Bucket=self.bucket_name, Key=key_path)
+            metadata = client.head_object(Bucket=self.bucket_name, Key=self.resolve_key(key_path))
             metadata['content_type'] = metadata['ContentType']
 
             # Drop non public metadata
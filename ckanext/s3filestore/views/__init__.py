@@ -4,6 +4,8 @@ import logging
 import os
 
 from botocore.exceptions import ClientError
+import flask
+from werkzeug.http import http_date
 
 from ckan import model
 from ckan.lib import uploader
@@ -15,6 +17,75 @@ from ckanext.s3filestore.uploader import S3Uploader, BaseS3Uploader
 
 log = logging.getLogger(__name__)
 
+PROXY_CHUNK_SIZE = 64 * 1024
+
+
+def stream_object(client, bucket_name, key, chunk_size=None, filename=None):
+    ''' Return a response that streams an S3 object to the client in
+    fixed-size chunks, so memory use does not depend on the object size.
+
+    A single byte range requested with a Range header is passed on to
+    S3. If the request has an If-Range header with a strong ETag, the
+    range is only sent if the object still has that ETag, and the whole
+    object is sent otherwise.
+
+    If `filename` is given, the file is downloaded under that name,
+    as with signed URLs, rather than any name stored with the object.
+    '''
+    if chunk_size is None:
+        chunk_size = int(config.get('ckanext.s3filestore.proxy_chunk_size', PROXY_CHUNK_SIZE))
+    params = {'Bucket': bucket_name, 'Key': key}
+    byte_range = flask.request.headers.get('Range')
+    if_range = flask.request.headers.get('If-Range')
+    # multiple ranges are not supported by S3; weak ETags and dates
+    # cannot be validated by S3, so send the whole object instead
+    if byte_range and byte_range.startswith('bytes=') and ',' not in byte_range \
+            and (not if_range or if_range.startswith('"')):
+        params['Range'] = byte_range
+        if if_range:
+            params['IfMatch'] = if_range
+
+    try:
+        obj = client.get_object(**params)
+    except ClientError as ex:
+        error = ex.response['Error']
+        if error['Code'] == 'PreconditionFailed' and 'Range' in params:
+            # the object has changed since the client's partial download
+            obj = client.get_object(Bucket=bucket_name, Key=key)
+        elif error['Code'] == 'InvalidRange':
+            headers = {'Accept-Ranges': 'bytes'}
+            if error.get('ActualObjectSize'):
+                headers['Content-Range'] = 'bytes */{0}'.format(error['ActualObjectSize'])
+            return flask.Response(status=416, headers=headers)
+        else:
+            raise
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(obj['ContentLength']),
+        'ETag': obj['ETag'],
+        'Last-Modified': http_date(obj['LastModified']),
+        # access was checked for this user
+        'Cache-Control': 'private',
+    }
+    if filename and obj.get('ContentType') != 'application/pdf':
+        headers['Content-Disposition'] = 'attachment; filename=' + filename
+    elif obj.get('ContentDisposition'):
+        headers['Content-Disposition'] = obj['ContentDisposition']
+    status = 200
+    if obj.get('ContentRange'):
+        headers['Content-Range'] = obj['ContentRange']
+        status = 206
+
+    body = obj['Body']
+    response = flask.Response(
+        body.iter_chunks(chunk_size), status=status, headers=headers,
+        content_type=obj.get('ContentType') or 'application/octet-stream',
+        direct_passthrough=True)
+    # release the S3 connection even if the body is not read, eg for HEAD
+    response.call_on_close(body.close)
+    return response
+
 
 def resource_download(id, resource_id, filename=None):
     '''
@@ -44,7 +115,20 @@ def resource_download(id, resource_id, filename=None):
             log.warn("Key '%s' not found in bucket '%s'",
                      key_path, upload.bucket_name)
 
+        # a file still waiting to be sent to S3 is served from the filesystem
+        is_upload_pending = getattr(upload, 'is_upload_pending', None)
+        if is_upload_pending and filename == os.path.basename(rsc['url']) \
+                and is_upload_pending(rsc['id']):
+            return redirect_to(url_for(
+                u's3_resource.filesystem_resource_download',
+                id=id,
+                resource_id=resource_id,
+                filename=filename))
+
         try:
+            if getattr(upload, 'proxy_downloads', False):
+                return stream_object(upload.get_s3_client(), upload.bucket_name,
+                                     upload.resolve_key(key_path), filename=os.path.basename(key_path))
             url = upload.get_signed_url_to_key(key_path)
             return redirect_to(url)
         except ClientError as ex:
@@ -74,29 +158,40 @@ def filesystem_resource_download(id, resource_id, filename=None):
     Provide a direct download by either redirecting the user to the url
     stored or downloading an uploaded file directly.
     """
-    if hasattr(DefaultResourceUpload, 'download'):
-        context = {'model': model, 'session': model.Session,
-                   'user': g.user, 'auth_user_obj': g.userobj}
-
+    if not hasattr(DefaultResourceUpload, 'download'):
         try:
-            rsc = get_action('resource_show')(context, {'id': resource_id})
-        except ObjectNotFound:
-            return abort(404, _('Resource not found'))
-        except NotAuthorized:
-            return abort(401, _('Unauthorised to read resource %s') % resource_id)
-        upload = DefaultResourceUpload(rsc)
-        return upload.download(rsc['id'], filename)
-    else:
-        try:
-            from ckan.views.resource import download
-            return download('dataset', id, resource_id, filename)
+            import ckan.views.resource  # noqa: F401
         except ImportError:
             # pre-Flask
             from ckan.controllers.package import PackageController
             return PackageController().resource_download(id, resource_id, filename)
-        except (IOError, OSError):
-            # probably file not found
-            return abort(404, _('Resource data not found'))
+
+    context = {'model': model, 'session': model.Session,
+               'user': g.user, 'auth_user_obj': g.userobj}
+    try:
+        rsc = get_action('resource_show')(context, {'id': resource_id})
+    except ObjectNotFound:
+        return abort(404, _('Resource not found'))
+    except NotAuthorized:
+        return abort(401, _('Unauthorised to read resource %s') % resource_id)
+    upload = DefaultResourceUpload(rsc)
+    if hasattr(upload, 'download'):
+        return upload.download(rsc['id'], filename)
+
+    if rsc.get('url_type') != 'upload':
+        return redirect_to(rsc['url'])
+    # the core download view would ask this plugin's uploader
+    # for the path, which is an S3 key rather than a local file
+    if not upload.storage_path:
+        return abort(404, _('Resource data not found'))
+    try:
+        response = flask.send_file(upload.get_path(rsc['id']))
+    except (IOError, OSError):
+        # probably file not found
+        return abort(404, _('Resource data not found'))
+    if rsc.get('mimetype'):
+        response.headers['Content-Type'] = rsc['mimetype']
+    return response
 
 
 def uploaded_file_redirect(upload_to, filename):
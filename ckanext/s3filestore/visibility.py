@@ -0,0 +1,152 @@
+# encoding: utf-8
+
+from builtins import object
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class InlineExecutor(object):
+    ''' An executor that runs each task immediately on the calling thread.
+    '''
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class SharedExecutor(object):
+    ''' A view of a process-wide thread pool. Leaving the context
+    waits for the tasks submitted through this view, as a
+    ThreadPoolExecutor would, but leaves the pool running so that
+    its threads are reused by later callers.
+    '''
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def submit(self, fn, *args, **kwargs):
+        future = self._pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            pending = set(self._pending)
+        wait(pending)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = None
+
+
+def get_executor(concurrency, name):
+    ''' Return an executor backed by the process-wide thread pool
+    of the specified size for `name`, or an inline executor if no
+    concurrency is requested.
+
+    Each kind of work has its own pool, so that tasks never wait for
+    a pool that is busy with the tasks that submitted them. The pools
+    are discarded whenever the process ID changes, as their threads
+    do not survive a fork.
+    '''
+    global _pools, _pools_lock, _pools_pid
+    if concurrency <= 1:
+        return InlineExecutor()
+    if _pools_pid != os.getpid():
+        # the lock may have been held by another thread at fork time
+        _pools = {}
+        _pools_lock = threading.Lock()
+        _pools_pid = os.getpid()
+    pool = _pools.get((name, concurrency))
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get((name, concurrency))
+            if pool is None:
+                log.debug("Creating %s thread pool of size %s", name, concurrency)
+                pool = _pools[(name, concurrency)] = ThreadPoolExecutor(max_workers=concurrency)
+    return SharedExecutor(pool)
+
+
+class VisibilityUpdateSummary(object):
+    ''' The outcome of updating the visibility of a set of resources.
+    '''
+
+    def __init__(self):
+        self.changed = []
+        self.skipped = []
+        self.failed = {}
+
+    def add(self, resource_id, changed):
+        if changed:
+            self.changed.append(resource_id)
+        else:
+            self.skipped.append(resource_id)
+
+    def __str__(self):
+        return "{} changed, {} skipped, {} failed".format(
+            len(self.changed), len(self.skipped), len(self.failed))
+
+
+def update_resources_visibility(resources, get_uploader, concurrency=1):
+    ''' Update the visibility of the S3 objects for each resource.
+
+    :param resources: iterable of (resource dict, target ACL) pairs;
+        it is consumed lazily, so it may be a generator
+    :param get_uploader: function returning the uploader for a resource
+    :param concurrency: number of resources to update in parallel
+
+    Uploaders are created on the calling thread, and only the S3 work
+    runs in the worker threads. An error for one resource is logged
+    and recorded in the summary without affecting the others.
+
+    :returns: a VisibilityUpdateSummary
+    '''
+    summary = VisibilityUpdateSummary()
+
+    def _update(resource_id, uploader, target_acl):
+        try:
+            summary.add(resource_id, uploader.update_visibility(resource_id, target_acl=target_acl))
+        except Exception as e:
+            log.error("Failed to update visibility of resource %s: %s", resource_id, e)
+            summary.failed[resource_id] = e
+
+    def _uploaders():
+        for resource, target_acl in resources:
+            uploader = get_uploader(resource)
+            if hasattr(uploader, 'update_visibility'):
+                yield resource['id'], uploader, target_acl
+
+    with get_executor(concurrency, 'resources') as executor:
+        pending = set()
+        for resource_id, uploader, target_acl in _uploaders():
+            # bound the work queued ahead of the workers
+            if len(pending) >= concurrency * 2:
+                pending = wait(pending, return_when=FIRST_COMPLETED).not_done
+            pending.add(executor.submit(_update, resource_id, uploader, target_acl))
+    return summary
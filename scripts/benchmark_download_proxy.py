@@ -0,0 +1,106 @@
+'''
+This script measures the throughput and memory use of streaming S3
+objects through the download proxy (`ckanext.s3filestore.proxy_downloads`),
+with several concurrent connections.
+
+The proxy view is served by a local threaded WSGI server, and objects are
+downloaded from it with the given number of clients in parallel. Peak
+Python memory, including the clients' 64 KB read buffers, is measured
+with tracemalloc and divided by the number of connections. The test object is generated from a sparse file, so it takes
+no local disk space.
+
+It must be run in the CKAN virtualenv, under Python 3, against an
+S3-compatible endpoint, eg a moto server::
+
+    python scripts/benchmark_download_proxy.py --endpoint-url http://localhost:5000 \\
+        --bucket my-bucket --size 512 --connections 1,4,16
+
+'''
+from __future__ import print_function
+
+import argparse
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import boto3
+import flask
+import requests
+from werkzeug.serving import make_server
+
+from ckan.common import config
+
+from ckanext.s3filestore.views import stream_object
+
+MB = 1024 * 1024
+KEY = 'benchmark/download-proxy.bin'
+
+
+def _client(args):
+    return boto3.client('s3', endpoint_url=args.endpoint_url,
+                        region_name=args.region,
+                        aws_access_key_id=args.access_key,
+                        aws_secret_access_key=args.secret_key)
+
+
+def _download(url, received):
+    response = requests.get(url, stream=True)
+    total = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        total += len(chunk)
+    received.append(total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--access-key', default='access-key-id')
+    parser.add_argument('--secret-key', default='secret-key')
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--size', type=int, default=256, help='Object size in MB')
+    parser.add_argument('--connections', default='1,4,16')
+    parser.add_argument('--chunk-size', type=int, default=64, help='Proxy chunk size in KB')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    client = _client(args)
+    with tempfile.TemporaryFile() as sparse_file:
+        sparse_file.truncate(args.size * MB)
+        client.upload_fileobj(sparse_file, args.bucket, KEY)
+
+    config['ckanext.s3filestore.proxy_chunk_size'] = str(args.chunk_size * 1024)
+    app = flask.Flask(__name__)
+    app.add_url_rule('/download', 'download', lambda: stream_object(client, args.bucket, KEY))
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = 'http://127.0.0.1:{}/download'.format(args.port)
+
+    print('{:>12} {:>12} {:>12} {:>24}'.format(
+        'connections', 'time (s)', 'MB/s', 'peak memory/conn (MB)'))
+    try:
+        for connections in [int(value) for value in args.connections.split(',')]:
+            received = []
+            threads = [threading.Thread(target=_download, args=(url, received)) for _ in range(connections)]
+            tracemalloc.start()
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert received == [args.size * MB] * connections
+            print('{:>12} {:>12.2f} {:>12.1f} {:>24.2f}'.format(
+                connections, elapsed, sum(received) / MB / elapsed, peak / MB / connections))
+    finally:
+        server.shutdown()
+        client.delete_object(Bucket=args.bucket, Key=KEY)
+
+
+if __name__ == '__main__':
+    main()
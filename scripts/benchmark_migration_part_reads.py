@@ -0,0 +1,94 @@
+'''
+This script compares the CPU time and peak memory (RSS) of migrating
+large local files to S3 by reading each part into a buffer, as the
+`ckan s3 upload` migration did before, against sending each part as
+a slice of a memory mapping of the file, as it does now.
+
+Each upload runs in a fresh child process so that it is measured in
+isolation. Test files are sparse, so they take no disk space.
+
+It must be run in the CKAN virtualenv, against an S3-compatible
+endpoint, eg a moto server::
+
+    python scripts/benchmark_migration_part_reads.py --endpoint-url http://localhost:5000 \\
+        --bucket my-bucket --sizes 1024,4096
+
+'''
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from ckanext.s3filestore.migration import HashingReader, upload_mapped_file
+
+MB = 1024 * 1024
+
+
+def _client(args):
+    return boto3.client('s3', endpoint_url=args.endpoint_url,
+                        region_name=args.region,
+                        aws_access_key_id=args.access_key,
+                        aws_secret_access_key=args.secret_key)
+
+
+def _upload(args, mode, path, queue):
+    client = _client(args)
+    key = 'benchmark/{}-{}'.format(mode, os.path.basename(path))
+    part_size = args.chunksize * MB
+    start = time.time()
+    with open(path, 'rb') as upload_file:
+        if mode == 'copying':
+            transfer_config = TransferConfig(
+                multipart_threshold=part_size, multipart_chunksize=part_size,
+                max_concurrency=args.concurrency)
+            transfer_config.max_in_memory_upload_chunks = args.concurrency
+            client.upload_fileobj(HashingReader(upload_file, part_size), args.bucket, key, Config=transfer_config)
+        else:
+            upload_mapped_file(client, args.bucket, key, upload_file, part_size, concurrency=args.concurrency)
+    elapsed = time.time() - start
+    client.delete_object(Bucket=args.bucket, Key=key)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss // 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--access-key', default='access-key-id')
+    parser.add_argument('--secret-key', default='secret-key')
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--sizes', default='1024,4096', help='File sizes in MB')
+    parser.add_argument('--chunksize', type=int, default=8, help='Part size in MB')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--modes', default='copying,mmap')
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>14}'.format(
+        'mode', 'size (MB)', 'time (s)', 'CPU (s)', 'peak RSS (MB)'))
+    for size in [int(value) for value in args.sizes.split(',')]:
+        handle, path = tempfile.mkstemp(prefix='s3filestore-benchmark-')
+        try:
+            os.ftruncate(handle, size * MB)
+            for mode in args.modes.split(','):
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=_upload, args=(args, mode, path, queue))
+                process.start()
+                elapsed, cpu_time, peak_rss = queue.get()
+                process.join()
+                print('{:>10} {:>10} {:>10.2f} {:>10.2f} {:>14}'.format(mode, size, elapsed, cpu_time, peak_rss))
+        finally:
+            os.close(handle)
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+This script compares the number of Redis round trips, and the time taken,
+for the cache maintenance done on each upload, delete and visibility
+update, using the single-key RedisHelper calls made before against the
+batched calls now made by the uploader.
+
+It must be run in the CKAN virtualenv, against a running Redis server::
+
+    python scripts/benchmark_redis_round_trips.py --redis-url redis://localhost:6379/1
+
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+from redis.connection import Connection
+
+from ckan.common import config
+
+from ckanext.s3filestore import redis_helper
+
+KEY = 'benchmark/resources/0123/data.csv'
+VISIBILITY = '/visibility'
+OBJECT_KEYS = ['benchmark/resources/0123/data-{}.csv'.format(i) for i in range(20)]
+
+round_trips = [0]
+_send_packed_command = Connection.send_packed_command
+
+
+def _counting_send_packed_command(self, *args, **kwargs):
+    round_trips[0] += 1
+    return _send_packed_command(self, *args, **kwargs)
+
+
+def upload_before(redis):
+    redis.delete(KEY)
+    redis.delete(KEY + VISIBILITY + '/all')
+    redis.put(KEY + VISIBILITY, 'private', expiry=60)
+
+
+def upload_after(redis):
+    with redis.batch() as cache_updates:
+        cache_updates.delete(KEY)
+        cache_updates.delete(KEY + VISIBILITY + '/all')
+        cache_updates.put(KEY + VISIBILITY, 'private', expiry=60)
+
+
+def clear_before(redis):
+    redis.delete(KEY)
+    redis.delete(KEY + VISIBILITY)
+
+
+def clear_after(redis):
+    redis.delete_many([KEY, KEY + VISIBILITY])
+
+
+def visibility_before(redis):
+    for key in OBJECT_KEYS:
+        redis.get(key + VISIBILITY)
+        redis.delete(key)
+        redis.put(key + VISIBILITY, 'public-read', expiry=60)
+    redis.put(KEY + VISIBILITY + '/all', 'public-read', expiry=60)
+
+
+def visibility_after(redis):
+    redis.get_many([key + VISIBILITY for key in OBJECT_KEYS])
+    with redis.batch() as cache_updates:
+        for key in OBJECT_KEYS:
+            cache_updates.delete(key)
+            cache_updates.put(key + VISIBILITY, 'public-read', expiry=60)
+        cache_updates.put(KEY + VISIBILITY + '/all', 'public-read', expiry=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--redis-url', default='redis://localhost:6379/1')
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    config['ckan.redis.url'] = args.redis_url
+    Connection.send_packed_command = _counting_send_packed_command
+    redis = redis_helper.RedisHelper()
+
+    print('{:>45} {:>14} {:>12}'.format('sequence', 'round trips', 'time (ms)'))
+    for name, sequence in (
+            ('upload_to_key (before)', upload_before),
+            ('upload_to_key (after)', upload_after),
+            ('clear_key (before)', clear_before),
+            ('clear_key (after)', clear_after),
+            ('update_visibility, {} objects (before)'.format(len(OBJECT_KEYS)), visibility_before),
+            ('update_visibility, {} objects (after)'.format(len(OBJECT_KEYS)), visibility_after)):
+        round_trips[0] = 0
+        start = time.time()
+        for _ in range(args.iterations):
+            sequence(redis)
+        elapsed = (time.time() - start) * 1000 / args.iterations
+        print('{:>45} {:>14} {:>12.3f}'.format(
+            name, round_trips[0] // args.iterations, elapsed))
+
+
+if __name__ == '__main__':
+    main()
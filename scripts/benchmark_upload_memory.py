@@ -0,0 +1,89 @@
+'''
+This script compares the peak memory (RSS) of uploading files of
+increasing size to S3 by reading the whole body into memory, as
+ckanext-s3filestore did before, against the streaming multipart
+transfer now used by `BaseS3Uploader.upload_to_key`.
+
+Each upload runs in a fresh child process so that its peak RSS is
+measured in isolation. Test files are sparse, so they take no disk space.
+
+It requires Boto3 and an S3-compatible endpoint, eg a moto server::
+
+    python scripts/benchmark_upload_memory.py --endpoint-url http://localhost:5000 \\
+        --bucket my-bucket --sizes 64,256,1024
+
+'''
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+
+def _client(args):
+    return boto3.client('s3', endpoint_url=args.endpoint_url,
+                        region_name=args.region,
+                        aws_access_key_id=args.access_key,
+                        aws_secret_access_key=args.secret_key)
+
+
+def _upload(args, mode, path, queue):
+    client = _client(args)
+    key = 'benchmark/{}-{}'.format(mode, os.path.basename(path))
+    start = time.time()
+    with open(path, 'rb') as upload_file:
+        if mode == 'read':
+            client.put_object(Bucket=args.bucket, Key=key, Body=upload_file.read())
+        else:
+            transfer_config = TransferConfig(
+                multipart_threshold=args.chunksize * MB,
+                multipart_chunksize=args.chunksize * MB,
+                max_concurrency=args.concurrency)
+            transfer_config.max_in_memory_upload_chunks = args.concurrency
+            client.upload_fileobj(upload_file, args.bucket, key, Config=transfer_config)
+    elapsed = time.time() - start
+    client.delete_object(Bucket=args.bucket, Key=key)
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--access-key', default='access-key-id')
+    parser.add_argument('--secret-key', default='secret-key')
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--sizes', default='16,64,256', help='File sizes in MB')
+    parser.add_argument('--chunksize', type=int, default=8, help='Part size in MB')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--modes', default='read,streaming')
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>10} {:>12}'.format('mode', 'size (MB)', 'time (s)', 'peak RSS (MB)'))
+    for size in [int(value) for value in args.sizes.split(',')]:
+        handle, path = tempfile.mkstemp(prefix='s3filestore-benchmark-')
+        try:
+            os.ftruncate(handle, size * MB)
+            for mode in args.modes.split(','):
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=_upload, args=(args, mode, path, queue))
+                process.start()
+                elapsed, peak_rss = queue.get()
+                process.join()
+                print('{:>10} {:>10} {:>10.2f} {:>12}'.format(mode, size, elapsed, peak_rss))
+        finally:
+            os.close(handle)
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
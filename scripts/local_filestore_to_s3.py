@@ -4,18 +4,32 @@ to a remote S3 bucket.
 
 **It will not work for group images**
 
-It requires SQLalchemy and Boto.
+It requires SQLalchemy and Boto, and must be run in the environment
+where ckanext-s3filestore is installed, as it uses the extension's
+hashing helper; it does not need CKAN to be running.
 
 Please update the configuration details, all keys are mandatory except
 AWS_STORAGE_PATH.
 
+Each uploaded object is checked against the MD5 (or multipart ETag) of
+the local file, computed as the file is sent, unless the bucket encrypts
+it with SSE-KMS, as the ETag is then not derived from the content. The paths of files that
+failed are written to RETRY_FILE; to upload only those files, run the
+script again with --retry.
+
 '''
 from __future__ import print_function
 
 import os
+import sys
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from s3transfer.utils import ChunksizeAdjuster
+
+from ckanext.s3filestore.hashing import HashingReader
 
 import configparser
 
@@ -38,14 +52,25 @@ else:
 AWS_BUCKET_NAME = main_config.get('ckanext.s3filestore.aws_bucket_name', 'my-bucket')
 AWS_STORAGE_PATH = ''
 AWS_S3_ACL = main_config.get('ckanext.s3filestore.acl', 'public-read')
+MULTIPART_THRESHOLD = int(main_config.get('ckanext.s3filestore.multipart_threshold', 8 * 1024 * 1024))
+MULTIPART_CHUNKSIZE = int(main_config.get('ckanext.s3filestore.multipart_chunksize', 8 * 1024 * 1024))
+RETRY_FILE = 'local_filestore_to_s3.retry'
+
 
+retry_paths = None
+if '--retry' in sys.argv[1:]:
+    with open(RETRY_FILE) as f:
+        retry_paths = set(line.strip() for line in f if line.strip())
+    print('Retrying {0} files from {1}'.format(len(retry_paths), RETRY_FILE))
 
 resource_ids_and_paths = {}
 
 for root, dirs, files in os.walk(BASE_PATH):
     if files:
         resource_id = root.split('/')[-2] + root.split('/')[-1] + files[0]
-        resource_ids_and_paths[resource_id] = os.path.join(root, files[0])
+        path = os.path.join(root, files[0])
+        if retry_paths is None or path in retry_paths:
+            resource_ids_and_paths[resource_id] = path
 
 print('Found {0} resource files in the file system'.format(
     len(list(resource_ids_and_paths.keys()))))
@@ -77,16 +102,45 @@ print('{0} resources matched on the database'.format(
 # todo: move to plugin initi so we don't need to reinit secrets
 s3_connection = boto3.resource('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 bucket = s3_connection.Bucket(AWS_BUCKET_NAME)
+transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE)
 
 uploaded_resources = []
+failed_resources = []
 for resource_id, file_name in resource_ids_and_names.items():
     key = 'resources/{resource_id}/{file_name}'.format(
         resource_id=resource_id, file_name=file_name)
     if AWS_STORAGE_PATH:
         key = AWS_STORAGE_PATH + '/' + key
 
-    s3_connection.Object(AWS_BUCKET_NAME, key).put(Body=open(resource_ids_and_paths[resource_id]), ACL=AWS_S3_ACL)
+    # upload_file streams the file in binary mode, in parts if it is large
+    path = resource_ids_and_paths[resource_id]
+    s3_object = s3_connection.Object(AWS_BUCKET_NAME, key)
+    size = os.path.getsize(path)
+    # hash the file as it is sent, split as the transfer manager splits it
+    part_size = ChunksizeAdjuster().adjust_chunksize(MULTIPART_CHUNKSIZE, size)
+    try:
+        with open(path, 'rb') as upload_file:
+            reader = HashingReader(upload_file, part_size)
+            s3_object.upload_fileobj(reader, ExtraArgs={'ACL': AWS_S3_ACL}, Config=transfer_config)
+        s3_object.load()
+    except (BotoCoreError, ClientError) as e:
+        failed_resources.append(path)
+        print('Failed to upload resource {0} ({1}): {2}'.format(resource_id, file_name, e))
+        continue
+    # the ETag of an object encrypted with KMS is not derived from its content
+    if not (s3_object.server_side_encryption or '').startswith('aws:kms') \
+            and s3_object.e_tag != reader.expected_etag(size >= MULTIPART_THRESHOLD):
+        failed_resources.append(path)
+        print('Uploaded resource {0} ({1}) does not match the local file'.format(resource_id, file_name))
+        continue
     uploaded_resources.append(resource_id)
     print('Uploaded resource {0} ({1}) to S3'.format(resource_id, file_name))
 
 print('Done, uploaded {0} resources to S3'.format(len(uploaded_resources)))
+with open(RETRY_FILE, 'w') as f:
+    for path in failed_resources:
+        f.write(path + '\n')
+if failed_resources:
+    print('{0} resources failed; run again with --retry to upload them from {1}'.format(
+        len(failed_resources), RETRY_FILE))